@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import os
+import time
+
+from trac.admin.api import IAdminCommandProvider, IAdminPanelProvider
+from trac.core import Component, implements
+from trac.util.presentation import to_json
+from trac.util.text import print_table, printout
+
+from announcer.api import AnnouncementSystem
+from announcer.api import _
+from announcer.util.journal import read_journal
+from announcer.util.settings import rebuild_setting_index
+
+class AnnouncerAdmin(Component):
+    """trac-admin commands and admin panels for the announcement system."""
+
+    implements(IAdminCommandProvider, IAdminPanelProvider)
+
+    # IAdminPanelProvider
+    def get_admin_panels(self, req):
+        if 'TRAC_ADMIN' in req.perm:
+            yield ('announcer', _('Announcer'), 'stats', _('Statistics'))
+
+    def render_admin_panel(self, req, category, page, path_info):
+        req.perm.require('TRAC_ADMIN')
+        announcer = AnnouncementSystem(self.env)
+        stats = announcer.stats
+        if req.method == 'POST' and req.args.get('reset'):
+            stats.reset()
+            announcer.breaker.reset()
+            req.redirect(req.href.admin(category, page))
+        data = stats.snapshot()
+        data['breakers'] = announcer.breaker.snapshot()
+        if req.args.get('format') == 'json':
+            req.send(to_json(data), 'application/json')
+        data['json_href'] = req.href.admin(category, page, format='json')
+        return 'admin_announcer_stats.html', data
+
+    # IAdminCommandProvider
+    def get_admin_commands(self):
+        yield ('announcer queue', '',
+               'Show the number of events in the announcement queue',
+               None, self._do_queue_status)
+        yield ('announcer queue process', '',
+               'Announce all events waiting in the announcement queue',
+               None, self._do_queue_process)
+        yield ('announcer queue retry', '',
+               'Requeue events that failed too often',
+               None, self._do_queue_retry)
+        yield ('announcer index rebuild', '',
+               'Rebuild the index of subscription settings',
+               None, self._do_index_rebuild)
+        yield ('announcer digest send', '',
+               'Send the hourly and daily digests that are due',
+               None, self._do_digest_send)
+        yield ('announcer digest retry', '',
+               'Send digests that failed too often again',
+               None, self._do_digest_retry)
+        yield ('announcer journal replay', '<path>',
+               """Announce the events of a journal file again
+
+               Messages are counted instead of being sent.  Prints the
+               throughput, the latencies of each pipeline stage and the
+               events that now reach other recipients than journaled.""",
+               None, self._do_journal_replay)
+
+    def _do_queue_status(self):
+        waiting, claimed, dead = AnnouncementSystem(self.env).get_queue_status()
+        printout(_("Waiting: %(waiting)s, claimed: %(claimed)s, "
+                   "failed: %(dead)s", waiting=waiting, claimed=claimed,
+                   dead=dead))
+
+    def _do_queue_process(self):
+        count = AnnouncementSystem(self.env).process_queue()
+        printout(_("Announced %(count)s events.", count=count))
+
+    def _do_queue_retry(self):
+        count = AnnouncementSystem(self.env).retry_dead_events()
+        printout(_("Requeued %(count)s events.", count=count))
+
+    def _do_index_rebuild(self):
+        db = self.env.get_db_cnx()
+        count = rebuild_setting_index(self.env, db)
+        db.commit()
+        printout(_("Indexed %(count)s subscription settings.", count=count))
+
+    def _do_digest_send(self):
+        from announcer.distributors.digest import EmailDigester
+        digester = self.env[EmailDigester]
+        if digester is None:
+            printout(_("The email digest component is disabled."))
+            return
+        count = digester.send_digests()
+        printout(_("Sent %(count)s digests.", count=count))
+
+    def _do_digest_retry(self):
+        from announcer.distributors.digest import EmailDigester
+        digester = self.env[EmailDigester]
+        if digester is None:
+            printout(_("The email digest component is disabled."))
+            return
+        count = digester.retry_dead_digests()
+        printout(_("Requeued %(count)s digest entries.", count=count))
+
+    def _do_journal_replay(self, path):
+        from announcer.distributors.mail import CaptureEmailSender
+        announcer = AnnouncementSystem(self.env)
+        path = os.path.join(self.env.get_log_dir(), path)
+        sender = CaptureEmailSender()
+        announcer.stats.reset()
+        count = 0
+        differences = []
+        start = time.time()
+        for evt, journaled, replayed in announcer.replay(
+                read_journal(path, self.log), sender):
+            count += 1
+            if journaled != replayed:
+                differences.append((evt, replayed - journaled,
+                                    journaled - replayed))
+        elapsed = time.time() - start
+        printout(_("Replayed %(count)s events in %(seconds).1f seconds "
+                   "(%(rate).1f events per second).", count=count,
+                   seconds=elapsed, rate=count / max(elapsed, 0.001)))
+        printout(_("Captured %(messages)s messages to %(recipients)s "
+                   "recipients.", messages=sender.messages,
+                   recipients=sender.recipients))
+        print_table([(t['stage'], t['component'], t['count'],
+                      '%.1f' % (t['p50'] * 1000), '%.1f' % (t['p95'] * 1000),
+                      '%.1f' % (t['p99'] * 1000), '%.1f' % (t['max'] * 1000))
+                     for t in announcer.stats.snapshot()['timings']],
+                    [_("Stage"), _("Component"), _("Calls"), _("50% ms"),
+                     _("95% ms"), _("99% ms"), _("Max ms")])
+        if not differences:
+            printout(_("All events reach the journaled recipients."))
+            return
+        printout(_("%(count)s events reach other recipients:",
+                   count=len(differences)))
+        for evt, added, removed in differences:
+            target = getattr(evt.target, 'id', None) or \
+                     getattr(evt.target, 'name', None) or evt.target
+            printout("  %s %s %s: %s" % (evt.realm, evt.category, target,
+                ', '.join(['+%s' % (s[1] or s[3]) for s in sorted(added)] +
+                          ['-%s' % (s[1] or s[3]) for s in sorted(removed)])))
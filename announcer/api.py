@@ -33,13 +33,29 @@
 
 import pkg_resources
 
+import atexit
+import base64
+import cPickle
+import os
+import random
+import threading
 import time
 
 from trac.core import *
+from trac.config import BoolOption, FloatOption, IntOption, Option
 from trac.util.compat import set
+from trac.util.translation import domain_functions
 from trac.db import Table, Column, Index
 from trac.db import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
+from trac.web.api import IRequestFilter
+
+from announcer.util.breaker import CircuitBreaker
+from announcer.util.journal import EventJournal
+from announcer.util.queries import QueryCounter
+from announcer.util.session import SessionSnapshot
+from announcer.util.stats import PipelineStats, component_name, timed_iter
+from announcer.util.templates import TemplateCache
 
 class IAnnouncementProducer(Interface):
     """blah."""
@@ -67,6 +83,8 @@ class IAnnouncementSubscriber(Interface):
 
         Each subscription that is returned is in the form of:
             ('transport', 'name', authenticated, 'address')
+        and is turned into a `Subscription`, so that the same recipient
+        returned by several subscribers is announced to only once.
 
         The transport should be one that a distributor (and formatter) can
         handle, but if not? The events will be dropped later at the
@@ -78,6 +96,14 @@ class IAnnouncementSubscriber(Interface):
         entirely.
         """
 
+    def subscription_events():
+        """Optional.  Returns an iterable of (realm, category) tuples of the
+        events the subscriber may return subscriptions for, with a category
+        of None matching every category of the realm.
+
+        Subscribers without this method are asked about every event.
+        """
+
 class IAnnouncementSubscriptionFilter(Interface):
     """IAnnouncementSubscriptionFilter provides an interface where a component
     can filter subscribers from the final distribution list.
@@ -88,6 +114,11 @@ class IAnnouncementSubscriptionFilter(Interface):
         after all get_subscriptions_for_event calls are made to allow
         components to remove addresses from the distribution list.  This can
         be used for things like "never notify updater" functionality.
+
+        If a filter fails or is skipped by the circuit breaker, the
+        subscriptions are passed on unfiltered, unless the component sets
+        `fail_closed = True` because it enforces an opt-out.  In that case
+        no subscription passes.
         """
 
 class IAnnouncementFormatter(Interface):
@@ -119,6 +150,9 @@ class IAnnouncementFormatter(Interface):
 
         Formatters retain the ability to descriminate by transport, but don't
         need to.
+
+        The styles are looked up once for each transport and realm and
+        should not change while the environment is loaded.
         """
 
     def alternative_style_for(transport, realm, style):
@@ -158,6 +192,10 @@ class IAnnouncementDistributor(Interface):
         If it is passed a transport it does not support, it should return
         silently and without error.
 
+        The recipients of an event with many subscribers are passed in
+        several calls, each with at most `[announcer] distribute_chunk_size`
+        recipients.
+
         The recipients is a list of (name, address) pairs with either (but not
         both) being allowed to be None. If name is provided but address isn't,
         then the distributor should defer to IAnnouncementAddressResolver
@@ -179,6 +217,14 @@ class IAnnouncementDistributor(Interface):
         user preference would be a dandy idea.
         """
 
+    def distribute_many(transport, batch):
+        """Optional.  Distributes several events at once, `batch` being a
+        list of (event, recipients) tuples as passed to `distribute()`.
+
+        Distributors without this method get `distribute()` called for each
+        event of a batch.
+        """
+
 class IAnnouncementPreferenceProvider(Interface):
     """Represents a single 'box' in the Announcements preference panel.
 
@@ -233,6 +279,50 @@ class IAnnouncementAddressResolver(Interface):
         returned. The next resolver will be attempted in the chain.
         """
 
+class Subscription(tuple):
+    """A subscription as returned by `IAnnouncementSubscriber`, in a
+    canonical form.
+
+    It is a (transport, sid, authenticated, address) tuple whose transport
+    string is interned, whose `authenticated` flag is 0 or 1 and whose
+    empty sid or address are None.  Subscriptions of the same recipient
+    therefore compare equal whichever subscriber produced them.
+
+    >>> Subscription('email', 'bob', True, None) == ('email', 'bob', 1, '')
+    False
+    >>> Subscription('email', 'bob', True, None) == \\
+    ...     Subscription('email', 'bob', 1, '')
+    True
+    >>> Subscription('email', None, None, ' bob@example.org ')
+    ('email', None, 0, 'bob@example.org')
+    >>> Subscription('email', 'bob', None, None).authenticated
+    0
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, transport, sid, authenticated, address):
+        if isinstance(transport, str):
+            transport = intern(transport)
+        if address:
+            address = address.strip()
+        return tuple.__new__(cls, (transport, sid or None,
+                                   authenticated and 1 or 0,
+                                   address or None))
+
+    transport = property(lambda self: self[0])
+    sid = property(lambda self: self[1])
+    authenticated = property(lambda self: self[2])
+    address = property(lambda self: self[3])
+
+    def canonical(cls, subscription):
+        """Returns `subscription` as a `Subscription`."""
+        if isinstance(subscription, cls):
+            return subscription
+        return cls(*subscription)
+    canonical = classmethod(canonical)
+
+
 class AnnouncementEvent(object):
     """AnnouncementEvent
 
@@ -244,6 +334,14 @@ class AnnouncementEvent(object):
     is all that matters and there's no possible data you could conceivably
     get beyond just the message.
     """
+
+    # Whether the event may be written to the announcement queue.  Events
+    # carrying secrets, like passwords, should be delivered right away.
+    persistent = True
+
+    # The events combined into this one by `merge()`, in order.
+    merged_events = ()
+
     def __init__(self, realm, category, target, author=""):
         self.realm = realm
         self.category = category
@@ -256,25 +354,77 @@ class AnnouncementEvent(object):
     def get_session_terms(self, session_id):
         return tuple()
 
+    def get_session_term_sids(self):
+        """Returns a dict of the terms `get_session_terms()` returns, each
+        with the list of sessions it is returned for, or None if the terms
+        are not known in advance.  Subscribers use it to find the sessions
+        with terms for an event without asking about every session.
+        Subclasses overriding `get_session_terms()` should override this
+        too, otherwise None is returned for them.
+        """
+        if self.__class__.get_session_terms.im_func is not \
+                AnnouncementEvent.get_session_terms.im_func:
+            return None
+        return {}
+
+    def restore(self, env):
+        """Called after an event has been read back from the announcement
+        queue.
+
+        Events are pickled when they are queued, so subclasses should hold
+        snapshots of model objects, like those of `announcer.util.snapshot`,
+        rather than the objects themselves.
+        """
+
+    def coalesce_key(self):
+        """Returns a key identifying the changed resource if successive
+        events with the same key, realm and category may be combined with
+        `merge()`, or None.
+        """
+        return None
+
+    def merge(self, event):
+        """Returns a single event announcing both this event and the later
+        `event`, which has the same realm, category and `coalesce_key()`.
+
+        The returned event should list the original events in
+        `merged_events`; subscriptions are collected for each of them.
+        Returns None if the events can't be combined, then both are
+        announced separately.
+        """
+        return None
+
+class AnnouncementBatch(AnnouncementEvent):
+    """Events announced together by `AnnouncementSystem.send_many()`."""
+
+    def __init__(self, events):
+        AnnouncementEvent.__init__(self, 'batch', 'batch', None)
+        self.events = events
+        self.persistent = not [e for e in events if not e.persistent]
+
+    def restore(self, env):
+        for evt in self.events:
+            evt.restore(env)
+
 _TRUE_VALUES = ('yes', 'true', 'enabled', 'on', 'aye', '1', 1, True)
 
 def istrue(value, otherwise=False):
     return True and (value in _TRUE_VALUES) or otherwise
 
+def chunks(iterable, size):
+    """Yields lists of at most `size` consecutive items of `iterable`."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-try:
-    from trac.util.translation import domain_functions
-
-    _, tag_, N_, add_domain = \
-        domain_functions('announcer', ('_', 'tag_', 'N_', 'add_domain'))
-
-except ImportError:
-    # fall back to 0.11 behavior, i18n functions are no-ops then
-    def add_domain():
-        pass
 
-    _ = N_ = tag_ = _noop = lambda string: string
-    pass
+_, tag_, N_, add_domain = \
+    domain_functions('announcer', ('_', 'tag_', 'N_', 'add_domain'))
 
 
 class AnnouncementSystem(Component):
@@ -304,13 +454,112 @@ class AnnouncementSystem(Component):
     subscribers can use to pick through events, all power to you.
     """
 
-    implements(IEnvironmentSetupParticipant)
+    implements(IEnvironmentSetupParticipant, IRequestFilter)
 
     subscribers = ExtensionPoint(IAnnouncementSubscriber)
     subscription_filters = ExtensionPoint(IAnnouncementSubscriptionFilter)
     distributors = ExtensionPoint(IAnnouncementDistributor)
+    formatters = ExtensionPoint(IAnnouncementFormatter)
+
+    use_event_queue = BoolOption('announcer', 'use_event_queue', 'false',
+        """Store events in the announcement queue and announce them from a
+        background worker.
+
+        Enabling this reduces the work done while saving a ticket or wiki
+        page to a single database insert.  Queued events survive a crash or
+        restart of the worker, they are picked up by the next worker or by
+        `trac-admin $ENV announcer queue process`.  The worker is started
+        by the first request the environment handles.
+        """)
+
+    queue_batch_size = IntOption('announcer', 'queue_batch_size', 50,
+        """Number of queued events a worker claims at once.""")
+
+    queue_poll_interval = IntOption('announcer', 'queue_poll_interval', 60,
+        """Seconds the queue worker sleeps before checking for events
+        queued by other processes.""")
+
+    queue_lease_timeout = IntOption('announcer', 'queue_lease_timeout', 600,
+        """Seconds after which an event or digest claimed by a worker that
+        did not finish it is considered abandoned and claimed again.""")
+
+    queue_retry_delay = IntOption('announcer', 'queue_retry_delay', 60,
+        """Seconds to wait before a queued event or digest that failed is
+        tried again.  The delay doubles with each further attempt, up to a
+        day.""")
+
+    queue_max_attempts = IntOption('announcer', 'queue_max_attempts', 5,
+        """Number of times a queued event or digest is tried before it is
+        put aside.  Events put aside can be requeued with
+        `trac-admin $ENV announcer queue retry`, digests with
+        `trac-admin $ENV announcer digest retry`.""")
+
+    coalesce_window = IntOption('announcer', 'coalesce_window', 0,
+        """Number of seconds to hold back changes of a resource, so that
+        further changes made within that time are announced together, e.g.
+        one announcement for several quick edits of a ticket.  0 announces
+        every change right away.  Held back events are lost if the process
+        is killed.
+        """)
+
+    distribute_chunk_size = IntOption('announcer', 'distribute_chunk_size',
+        500, """Number of subscriptions filtered and handed to the
+        distributors at once.  Subscriptions of an event are processed in
+        chunks of this size, so an event with many recipients does not need
+        to be held in memory for all of them at once.  Each chunk results in
+        separate messages.""")
+
+    diff_max_size = IntOption('announcer', 'diff_max_size', 1048576,
+        """Number of characters of the old and new text of a wiki page or
+        ticket field above which announcements do not show a diff of the
+        change, only the number of changed lines and a link.""")
+
+    diff_max_lines = IntOption('announcer', 'diff_max_lines', 1000,
+        """Number of lines after which diffs in announcements are cut
+        off.  0 does not limit diffs.""")
+
+    component_time_budget = FloatOption('announcer',
+        'component_time_budget', 5.0,
+        """Number of seconds a subscriber, filter, formatter or e-mail
+        decorator may take for one event.  A call taking longer is not
+        interrupted, but counts as a failure of the component.  0 disables
+        the budget.""")
+
+    breaker_threshold = IntOption('announcer', 'breaker_threshold', 3,
+        """Number of failures in a row after which a subscriber, filter,
+        formatter or e-mail decorator is skipped for `breaker_cooldown`
+        seconds.  0 never skips failing components.""")
+
+    breaker_cooldown = IntOption('announcer', 'breaker_cooldown', 300,
+        """Number of seconds a component that failed `breaker_threshold`
+        times in a row is skipped.""")
+
+    journal_file = Option('announcer', 'journal_file', '',
+        """File to which every announced event is appended together with
+        the subscriptions it was delivered to, to replay them later with
+        `trac-admin announcer journal replay`.  A relative path is relative
+        to the log directory of the environment.  Leave empty to keep no
+        journal.""")
+
+    journal_max_size = IntOption('announcer', 'journal_max_size', 10485760,
+        """Size in bytes at which the journal file is rotated.""")
+
+    journal_backups = IntOption('announcer', 'journal_backups', 5,
+        """Number of rotated journal files to keep.""")
+
+    stats_window = IntOption('announcer', 'stats_window', 1000,
+        """Number of most recent samples the pipeline statistics keep for
+        each stage and component.""")
+
+    count_queries = BoolOption('announcer', 'count_queries', 'false',
+        """Count and time the database queries issued while announcing an
+        event, for each pipeline stage and component.  The totals are
+        logged at debug level and kept in the pipeline statistics as the
+        'queries' counters and 'query' timings.""")
 
     # IEnvironmentSetupParticipant implementation
+    db_version = 5
+
     SCHEMA = [
         Table('subscriptions', key='id')[
             Column('id', auto_increment=True),
@@ -323,87 +572,817 @@ class AnnouncementSystem(Component):
             Column('transport'),
             Index(['id']),
             Index(['realm', 'category', 'enabled']),
-        ]
+        ],
+        Table('announcement_queue', key='id')[
+            Column('id', auto_increment=True),
+            Column('time', type='int'),
+            Column('realm'),
+            Column('category'),
+            Column('owner'),
+            Column('lease', type='int'),
+            Column('attempts', type='int'),
+            Column('not_before', type='int'),
+            Column('data'),
+            Index(['owner', 'lease']),
+        ],
+        Table('subscription_index', key=('name', 'token', 'sid',
+                                         'authenticated', 'transport'))[
+            Column('name'),
+            Column('token'),
+            Column('sid'),
+            Column('authenticated', type='int'),
+            Column('transport'),
+            Index(['sid', 'authenticated', 'name']),
+        ],
+        Table('announcement_digest', key='id')[
+            Column('id', auto_increment=True),
+            Column('sid'),
+            Column('authenticated', type='int'),
+            Column('address'),
+            Column('period'),
+            Column('time', type='int'),
+            Column('event', type='int'),
+            Column('owner'),
+            Column('lease', type='int'),
+            Column('attempts', type='int'),
+            Column('not_before', type='int'),
+            Index(['period', 'time']),
+            Index(['owner']),
+        ],
+        Table('announcement_digest_event', key='id')[
+            Column('id', auto_increment=True),
+            Column('time', type='int'),
+            Column('realm'),
+            Column('subject'),
+            Column('body'),
+            Column('marker'),
+        ],
     ]
 
     def __init__(self):
         # bind the 'announcer' catalog to the locale directory
         locale_dir = pkg_resources.resource_filename(__name__, 'locale')
         add_domain(self.env.path, locale_dir)
+        self._queue_worker = None
+        self._queue_worker_lock = threading.Lock()
+        self._batch = threading.local()
+        self._held_events = {}
+        self._held_lock = threading.Lock()
+        self._coalescer = None
+        self.stats = PipelineStats(self.stats_window)
+        self.breaker = CircuitBreaker(self.component_time_budget,
+                                      self.breaker_threshold,
+                                      self.breaker_cooldown, self.stats)
+        self._subscriber_map = {}
+        self._format_map = {}
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        self._capture = threading.local()
+        self._memo = threading.local()
+        self.templates = TemplateCache(self.env)
 
     def environment_created(self):
         self._upgrade_db(self.env.get_db_cnx())
 
     def environment_needs_upgrade(self, db):
+        return self._get_schema_version(db) < self.db_version
+
+    def upgrade_environment(self, db):
+        self._upgrade_db(db)
+
+    def _get_schema_version(self, db):
         cursor = db.cursor()
+        cursor.execute("""
+            SELECT value
+              FROM system
+             WHERE name='announcer_version'
+        """)
+        row = cursor.fetchone()
+        if row:
+            return int(row[0])
+        # Environments set up before the schema was versioned only have
+        # the subscriptions table.
         try:
             cursor.execute("select count(*) from subscriptions")
             cursor.fetchone()
-            return False
+            return 1
         except:
             db.rollback()
-            return True
-
-    def upgrade_environment(self, db):
-        self._upgrade_db(db)
+            return 0
 
     def _upgrade_db(self, db):
         try:
-            db_backend, _ = DatabaseManager(self.env)._get_connector()
+            version = self._get_schema_version(db)
             cursor = db.cursor()
-            for table in self.SCHEMA:
-                for stmt in db_backend.to_sql(table):
-                    self.log.debug(stmt)
-                    cursor.execute(stmt)
-                    db.commit()
+            for step in range(version + 1, self.db_version + 1):
+                self.log.info("Upgrading announcer schema to version %s",
+                              step)
+                getattr(self, '_upgrade_to_%s' % step)(db, cursor)
+            if version:
+                cursor.execute("""
+                    UPDATE system
+                       SET value=%s
+                     WHERE name='announcer_version'
+                """, (str(self.db_version),))
+            if not version or not cursor.rowcount:
+                cursor.execute("""
+                    INSERT INTO system (name, value)
+                         VALUES ('announcer_version', %s)
+                """, (str(self.db_version),))
+            db.commit()
         except Exception, e:
             db.rollback()
             self.log.error(e, exc_info=True)
             raise TracError(str(e))
+
+    def _create_table(self, cursor, name):
+        db_backend, _ = DatabaseManager(self.env)._get_connector()
+        for table in self.SCHEMA:
+            if table.name == name:
+                for stmt in db_backend.to_sql(table):
+                    self.log.debug(stmt)
+                    cursor.execute(stmt)
+
+    def _upgrade_to_1(self, db, cursor):
+        self._create_table(cursor, 'subscriptions')
+
+    def _upgrade_to_2(self, db, cursor):
+        self._create_table(cursor, 'announcement_queue')
+
+    def _upgrade_to_3(self, db, cursor):
+        from announcer.util.settings import upgrade_legacy_settings
+        count = upgrade_legacy_settings(self.env, db)
+        self.log.info("Converted %s pickled subscription settings", count)
+
+    def _upgrade_to_4(self, db, cursor):
+        from announcer.util.settings import rebuild_setting_index
+        self._create_table(cursor, 'subscription_index')
+        count = rebuild_setting_index(self.env, db)
+        self.log.info("Indexed %s subscription settings", count)
+
+    def _upgrade_to_5(self, db, cursor):
+        self._create_table(cursor, 'announcement_digest')
+        self._create_table(cursor, 'announcement_digest_event')
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        if self.use_event_queue and self._queue_worker is None:
+            # Announce the events queued before the environment was loaded.
+            self._get_queue_worker().wake()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
     # The actual AnnouncementSystem now..
 
     def send(self, evt):
+        events = getattr(self._batch, 'events', None)
+        if events is not None:
+            events.append(evt)
+            return
+        if self.coalesce_window and evt.coalesce_key() is not None:
+            try:
+                self._hold(evt)
+                return
+            except Exception:
+                self.log.error("AnnouncementSystem failed to hold event, "
+                               "sending it right away.", exc_info=True)
+        self._dispatch(evt)
+
+    def send_many(self, events):
+        """Announces several events together, e.g. the changes of a batch
+        modification or import.
+
+        Subscriptions are collected per event, but sessions are loaded once
+        for the whole batch, and distributors supporting it send each
+        recipient a single message covering all of their events.
+        """
+        events = list(events)
+        if len(events) < 2:
+            for evt in events:
+                self.send(evt)
+            return
+        self._dispatch(AnnouncementBatch(events))
+
+    def begin_batch(self):
+        """Holds back the events sent by the current thread until the
+        matching `end_batch()`, which announces them with `send_many()`.
+        Calls may be nested."""
+        if getattr(self._batch, 'events', None) is None:
+            self._batch.events = []
+            self._batch.depth = 0
+        self._batch.depth += 1
+
+    def end_batch(self):
+        if getattr(self._batch, 'events', None) is None:
+            return
+        self._batch.depth -= 1
+        if self._batch.depth <= 0:
+            events = self._batch.events
+            self._batch.events = None
+            self.send_many(events)
+
+    def _dispatch(self, evt):
+        if self.use_event_queue and evt.persistent:
+            try:
+                self._enqueue(evt)
+                return
+            except Exception:
+                self.log.error("AnnouncementSystem failed to queue event, "
+                               "sending it right away.", exc_info=True)
+        self._timed_send(evt)
+
+    def _timed_send(self, evt):
         start = time.time()
-        self._real_send(evt)
+        sent = self._real_send(evt)
         stop = time.time()
         self.log.debug("AnnouncementSystem sent event in %s seconds."\
                 %(round(stop-start,2)))
+        return sent
+
+    # Event coalescing
+
+    def _hold(self, evt):
+        key = (evt.realm, evt.category, evt.coalesce_key())
+        unmerged = None
+        self._held_lock.acquire()
+        try:
+            if key in self._held_events:
+                deadline, held = self._held_events[key]
+                merged = held.merge(evt)
+                if merged is not None:
+                    self._held_events[key] = (deadline, merged)
+                    self.log.debug("AnnouncementSystem merged %s event for "
+                                   "%s", evt.category, key[2])
+                    return
+                # The held event is announced, and the new one held instead.
+                unmerged = held
+            self._held_events[key] = (time.time() + self.coalesce_window, evt)
+            if self._coalescer is None:
+                self._coalescer = CoalescingThread(self)
+                self._coalescer.start()
+                atexit.register(self.flush_held_events, True)
+        finally:
+            self._held_lock.release()
+        if unmerged is not None:
+            try:
+                self._dispatch(unmerged)
+            except Exception:
+                self.log.error("AnnouncementSystem failed to send held "
+                               "event.", exc_info=True)
+
+    def flush_held_events(self, all=False):
+        """Announces the held events whose coalescing window has passed, or
+        all held events.  Returns the number of seconds until the next
+        window ends, or None if no events are held.
+        """
+        now = time.time()
+        due = []
+        self._held_lock.acquire()
+        try:
+            for key, (deadline, evt) in self._held_events.items():
+                if all or deadline <= now:
+                    due.append((deadline, evt))
+                    del self._held_events[key]
+            deadlines = [d for d, evt in self._held_events.values()]
+        finally:
+            self._held_lock.release()
+        due.sort()
+        for deadline, evt in due:
+            try:
+                self._dispatch(evt)
+            except Exception:
+                self.log.error("AnnouncementSystem failed to send held "
+                               "event.", exc_info=True)
+        if deadlines:
+            return max(0, min(deadlines) - now)
+        return None
+
+    # Announcement queue
+
+    def _enqueue(self, evt):
+        data = base64.b64encode(cPickle.dumps(evt, 2))
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            INSERT INTO announcement_queue
+                        (time, realm, category, owner, lease, attempts,
+                         not_before, data)
+                 VALUES (%s, %s, %s, '', 0, 0, 0, %s)
+        """, (int(time.time()), evt.realm, evt.category, data))
+        db.commit()
+        self.log.debug("AnnouncementSystem queued %s event for realm %s",
+                       evt.category, evt.realm)
+        self._get_queue_worker().wake()
+
+    def _get_queue_worker(self):
+        self._queue_worker_lock.acquire()
+        try:
+            if not self._queue_worker or not self._queue_worker.isAlive():
+                self._queue_worker = QueueWorkerThread(self)
+                self._queue_worker.start()
+            return self._queue_worker
+        finally:
+            self._queue_worker_lock.release()
+
+    def process_queue(self):
+        """Announces all events that are currently queued and not claimed
+        by another worker.  Returns the number of events announced.
+        """
+        count = 0
+        while True:
+            owner, rows = self._claim_events()
+            if not rows:
+                return count
+            for id, attempts, data in rows:
+                if self._process_queued_event(owner, id, attempts, data):
+                    count += 1
+
+    def _claim_events(self):
+        """Marks a batch of queued events as taken by a new owner token.
+
+        An event stays in the queue until it has been announced, so if the
+        worker dies the event is claimed again once its lease expired.
+        Events that failed are not claimed before their retry time.
+        """
+        owner = '%x.%x' % (os.getpid(), random.getrandbits(32))
+        now = int(time.time())
+        expired = now - self.queue_lease_timeout
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT id
+              FROM announcement_queue
+             WHERE (owner='' AND not_before<=%s)
+                OR (owner<>'' AND owner<>'dead' AND lease<%s)
+             ORDER BY id
+             LIMIT %s
+        """, (now, expired, self.queue_batch_size))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return owner, []
+        cursor.execute("""
+            UPDATE announcement_queue
+               SET owner=%%s, lease=%%s, attempts=attempts+1
+             WHERE id IN (%s)
+               AND ((owner='' AND not_before<=%%s)
+                    OR (owner<>'' AND owner<>'dead' AND lease<%%s))
+        """ % ','.join(['%s'] * len(ids)),
+            [owner, now] + ids + [now, expired])
+        db.commit()
+        cursor.execute("""
+            SELECT id, attempts, data
+              FROM announcement_queue
+             WHERE owner=%s
+             ORDER BY id
+        """, (owner,))
+        return owner, cursor.fetchall()
+
+    def _process_queued_event(self, owner, id, attempts, data):
+        try:
+            evt = cPickle.loads(base64.b64decode(data))
+            evt.restore(self.env)
+            sent = self._timed_send(evt)
+        except Exception:
+            self.log.error("AnnouncementSystem failed to announce queued "
+                           "event %s.", id, exc_info=True)
+            sent = False
+        if not sent:
+            # The event stays queued, failures of the pipeline were logged
+            # by _announce().
+            if attempts >= self.queue_max_attempts:
+                next_owner = 'dead'
+            else:
+                next_owner = ''
+            delay = min(self.queue_retry_delay * 2 ** (attempts - 1), 86400)
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE announcement_queue
+                   SET owner=%s, not_before=%s
+                 WHERE id=%s AND owner=%s
+            """, (next_owner, int(time.time()) + delay, id, owner))
+            db.commit()
+            return False
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            DELETE FROM announcement_queue
+             WHERE id=%s AND owner=%s
+        """, (id, owner))
+        db.commit()
+        return True
+
+    def get_queue_status(self):
+        """Returns a tuple of the number of waiting, claimed and dead
+        events in the announcement queue."""
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT owner, count(*)
+              FROM announcement_queue
+             GROUP BY owner
+        """)
+        waiting = claimed = dead = 0
+        for owner, count in cursor.fetchall():
+            if owner == '':
+                waiting += count
+            elif owner == 'dead':
+                dead += count
+            else:
+                claimed += count
+        return waiting, claimed, dead
+
+    def retry_dead_events(self):
+        """Puts events that failed too often back into the queue."""
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            UPDATE announcement_queue
+               SET owner='', attempts=0, not_before=0
+             WHERE owner='dead'
+        """)
+        count = cursor.rowcount
+        db.commit()
+        return count
+
+    def call_guarded(self, component, default, func, *args):
+        """Returns `func(*args)`, or `default` if it raises an exception or
+        `component` is skipped by the circuit breaker.  Failures and calls
+        exceeding the time budget are reported to the breaker."""
+        name = component_name(component)
+        if not self.breaker.allow(name):
+            return default
+        start = time.time()
+        try:
+            result = func(*args)
+        except Exception:
+            self.log.error("AnnouncementSystem: %s failed.", name,
+                           exc_info=True)
+            self.breaker.report(name, time.time() - start, failed=True)
+            return default
+        self.breaker.report(name, time.time() - start)
+        return result
+
+    def get_subscribers(self, realm, category):
+        """Returns the subscribers that may have subscriptions for events of
+        `realm` and `category`, see `subscription_events()`.
+        """
+        key = (realm, category)
+        subscribers = self._subscriber_map.get(key)
+        if subscribers is None:
+            subscribers = []
+            for sp in self.subscribers:
+                events = getattr(sp, 'subscription_events', None)
+                if events is None or key in events() or \
+                        (realm, None) in events():
+                    subscribers.append(sp)
+            self._subscriber_map[key] = subscribers
+        return subscribers
+
+    def get_formats(self, transport, realm):
+        """Returns a dict mapping the styles available for `transport` and
+        `realm` to the formatter providing them."""
+        key = (transport, realm)
+        formats = self._format_map.get(key)
+        if formats is None:
+            formats = {}
+            for f in self.formatters:
+                for style in f.styles(transport, realm):
+                    formats[style] = f
+            self._format_map[key] = formats
+        return formats
 
     def _real_send(self, evt):
         """Accepts a single AnnouncementEvent instance (or subclass), and
-        returns nothing.
+        returns False if announcing it failed, True otherwise.
 
         There is no way (intentionally) to determine what the
         AnnouncementSystem did with a particular event besides looking through
         the debug logs.
         """
+        if isinstance(evt, AnnouncementBatch):
+            return self._real_send_batch(evt)
+        journal = self.get_journal()
+        if journal is None:
+            return self._announce(evt)
+        delivered = []
+        sent = self._announce(evt, delivered)
+        self._write_journal(journal, evt, delivered)
+        return sent
+
+    def _announce(self, evt, delivered=None):
+        """Runs the pipeline for `evt`, appending the subscriptions it is
+        distributed to to `delivered` if that is a list.  Returns False if
+        the pipeline failed, e.g. because a distributor raised an error."""
+        stats = self.stats
+        counter = self.count_queries and QueryCounter().activate() or None
+        timer = stats.timer('event', evt.realm).start()
+        # Session attributes looked up while announcing this event are
+        # loaded in bulk for each chunk of candidate recipients.
+        snapshot = SessionSnapshot(self.env).activate()
+        snapshot.preload([evt.author])
+        self._memo.data = {}
         try:
-            subscriptions = set()
-            for sp in self.subscribers:
-                subscriptions.update(
-                    x for x in sp.subscriptions(evt) if x
-                )
-            for sf in self.subscription_filters:
-                subscriptions = set(
-                    sf.filter_subscriptions(evt, subscriptions)
-                )
-
-            self.log.debug(
-                "AnnouncementSystem has found the following subscriptions: " \
-                        "%s"%(', '.join(['[%s(%s) via %s]' % ((s[1] or s[3]),\
-                        s[2] and 'authenticated' or 'not authenticated',s[0])\
-                        for s in subscriptions]
-                    )
-                )
-            )
+            filter_stats = {}
+            d_timers = {}
+            for chunk in chunks(self._stream_subscriptions(evt),
+                                max(self.distribute_chunk_size, 1)):
+                sids = [s[1] for s in chunk if s[1] != evt.author]
+                snapshot.preload(sids)
+                packages = self._filter_subscriptions(evt, chunk,
+                                                      filter_stats)
+                if delivered is not None:
+                    self._add_delivered(delivered, packages)
+                for distributor in self.distributors:
+                    for transport in distributor.transports():
+                        if transport in packages:
+                            name = component_name(distributor)
+                            if name not in d_timers:
+                                d_timers[name] = stats.timer('distributor',
+                                                             name)
+                            d_timers[name].start()
+                            distributor.distribute(transport,
+                                                   packages[transport], evt)
+                            d_timers[name].stop()
+                snapshot.discard(sids)
+            self._record_filter_stats(filter_stats)
+            for d_timer in d_timers.values():
+                d_timer.record()
+        except:
+            self.log.error("AnnouncementSystem failed.", exc_info=True)
+            sent = False
+        else:
+            sent = True
+        self._memo.data = None
+        snapshot.deactivate()
+        timer.record()
+        if counter is not None:
+            counter.deactivate()
+            self._record_queries(counter, evt.realm)
+        return sent
+
+    def _real_send_batch(self, batch):
+        """Announces the events of a batch.  Sessions are loaded once for
+        all events, and distributors implementing `distribute_many()` get
+        all events of the batch at once."""
+        stats = self.stats
+        counter = self.count_queries and QueryCounter().activate() or None
+        timer = stats.timer('event', 'batch').start()
+        snapshot = SessionSnapshot(self.env).activate()
+        snapshot.preload([evt.author for evt in batch.events])
+        self._memo.data = {}
+        try:
+            collected = []
+            for evt in batch.events:
+                collected.append((evt, list(self._stream_subscriptions(evt))))
+            sids = []
+            for evt, subscriptions in collected:
+                sids.extend([s[1] for s in subscriptions])
+            snapshot.preload(sids)
             packages = {}
-            for transport, sid, authenticated, address in subscriptions:
-                if transport not in packages:
-                    packages[transport] = set()
-                packages[transport].add((sid,authenticated,address))
+            journal = self.get_journal()
+            for evt, subscriptions in collected:
+                filter_stats = {}
+                filtered = self._filter_subscriptions(evt, subscriptions,
+                                                      filter_stats)
+                for transport, recipients in filtered.items():
+                    packages.setdefault(transport, []).append((evt,
+                                                               recipients))
+                self._record_filter_stats(filter_stats)
+                if journal is not None:
+                    delivered = []
+                    self._add_delivered(delivered, filtered)
+                    self._write_journal(journal, evt, delivered)
             for distributor in self.distributors:
+                d_timer = stats.timer('distributor',
+                                      component_name(distributor))
                 for transport in distributor.transports():
-                    if transport in packages:
-                        distributor.distribute(transport, packages[transport], evt)
+                    if transport not in packages:
+                        continue
+                    d_timer.start()
+                    if hasattr(distributor, 'distribute_many'):
+                        distributor.distribute_many(transport,
+                                                    packages[transport])
+                    else:
+                        for evt, recipients in packages[transport]:
+                            distributor.distribute(transport, recipients, evt)
+                    d_timer.record()
         except:
             self.log.error("AnnouncementSystem failed.", exc_info=True)
+            sent = False
+        else:
+            sent = True
+        self._memo.data = None
+        snapshot.deactivate()
+        timer.record()
+        if counter is not None:
+            counter.deactivate()
+            self._record_queries(counter, 'batch')
+        stats.count('batch size', 'AnnouncementSystem', len(batch.events))
+        return sent
+
+    def _record_queries(self, counter, realm):
+        """Adds the queries counted while announcing an event of `realm`
+        to the pipeline statistics and logs them."""
+        stats = self.stats
+        details = []
+        for key, (n, seconds) in sorted(counter.queries.items()):
+            # Queries outside of any component belong to the event itself.
+            stage, name = key or ('event', realm)
+            stats.count('queries', name, n)
+            stats.record('query', name, seconds)
+            details.append('%s %s: %d' % (stage, name, n))
+        total, seconds = counter.total()
+        stats.count('queries per event', realm, total)
+        self.log.debug("AnnouncementSystem issued %d queries in %.3fs "
+                       "announcing a %s event (%s)", total, seconds, realm,
+                       ', '.join(details))
+
+    def _stream_subscriptions(self, evt):
+        """Yields the subscriptions of all subscribers to `evt` as they are
+        produced, as `Subscription` records and each one only once."""
+        stats = self.stats
+        seen = set()
+        for sp in self.get_subscribers(evt.realm, evt.category):
+            name = component_name(sp)
+            if not self.breaker.allow(name):
+                continue
+            produced = 0
+            failed = False
+            sp_timer = stats.timer('subscriber', name)
+            try:
+                # A merged event goes to the subscribers of each change.
+                for e in evt.merged_events or (evt,):
+                    for sub in timed_iter(sp_timer, sp.subscriptions(e)):
+                        if not sub:
+                            continue
+                        sub = Subscription.canonical(sub)
+                        if sub not in seen:
+                            seen.add(sub)
+                            produced += 1
+                            yield sub
+            except Exception:
+                # Subscriptions yielded before the failure are kept.
+                self.log.error("AnnouncementSystem: %s failed.", name,
+                               exc_info=True)
+                failed = True
+            self.breaker.report(name, sp_timer.record(), failed)
+            stats.count('subscriptions produced', name, produced)
+
+    def _filter_subscriptions(self, evt, subscriptions, filter_stats):
+        """Applies the subscription filters to a chunk of subscriptions and
+        returns a dict mapping each transport to a set of (sid,
+        authenticated, address) tuples.
+
+        The time spent in each filter and the number of subscriptions it
+        dropped are summed up in `filter_stats`, to be recorded with
+        `_record_filter_stats()` once all chunks are filtered.
+        """
+        stats = self.stats
+        for sf in self.subscription_filters:
+            name = component_name(sf)
+            if name not in filter_stats:
+                filter_stats[name] = [stats.timer('filter', name), 0]
+            before = len(subscriptions)
+            filter_stats[name][0].start()
+            filtered = self.call_guarded(sf, None,
+                lambda: list(sf.filter_subscriptions(evt, subscriptions)))
+            if filtered is not None:
+                subscriptions = filtered
+            elif getattr(sf, 'fail_closed', False):
+                self.log.error("AnnouncementSystem: %s did not filter %s, "
+                               "dropping all subscriptions.", name, evt)
+                subscriptions = []
+            else:
+                self.log.error("AnnouncementSystem: %s did not filter %s, "
+                               "passing subscriptions unfiltered.", name, evt)
+            filter_stats[name][0].stop()
+            filter_stats[name][1] += before - len(subscriptions)
+
+        self.log.debug(
+            "AnnouncementSystem has found the following subscriptions: " \
+                    "%s"%(', '.join(['[%s(%s) via %s]' % ((s[1] or s[3]),\
+                    s[2] and 'authenticated' or 'not authenticated',s[0])\
+                    for s in subscriptions]
+                )
+            )
+        )
+        packages = {}
+        for transport, sid, authenticated, address in subscriptions:
+            if transport not in packages:
+                packages[transport] = set()
+            packages[transport].add((sid,authenticated,address))
+        return packages
+
+    def _add_delivered(self, delivered, packages):
+        for transport, recipients in packages.items():
+            for sid, authenticated, address in recipients:
+                delivered.append(Subscription(transport, sid, authenticated,
+                                              address))
+
+    # Journal and replay
+
+    def get_journal(self):
+        """Returns the `EventJournal` events are written to, or None if
+        `journal_file` is not set."""
+        if not self.journal_file:
+            return None
+        self._journal_lock.acquire()
+        try:
+            path = os.path.join(self.env.get_log_dir(), self.journal_file)
+            if self._journal is None or self._journal.path != path:
+                self._journal = EventJournal(path, self.journal_max_size,
+                                             self.journal_backups)
+            return self._journal
+        finally:
+            self._journal_lock.release()
+
+    def _write_journal(self, journal, evt, delivered):
+        try:
+            journal.write(evt, delivered)
+        except Exception:
+            self.log.error("AnnouncementSystem failed to write to the "
+                           "journal %s.", journal.path, exc_info=True)
+
+    def get_memo(self):
+        """Returns a dict in which distributors can keep results for the
+        events being announced, like formatted messages, so they are reused
+        for all chunks of recipients.  Returns None outside of an
+        announcement."""
+        return getattr(self._memo, 'data', None)
+
+    def get_capture(self):
+        """Returns the sender capturing the messages of events being
+        replayed in this thread, or None.  Distributors should hand their
+        messages to it instead of delivering them, and must not have other
+        side effects, like storing digests."""
+        return getattr(self._capture, 'sender', None)
+
+    def replay(self, records, capture):
+        """Announces journaled events again, for benchmarking.  `records`
+        are (time, event, subscriptions) tuples as read by
+        `announcer.util.journal.read_journal()`; messages are handed to
+        `capture`.  Yields (event, journaled, replayed) tuples with the
+        sets of subscriptions each event was and is now distributed to.
+        """
+        self._capture.sender = capture
+        try:
+            for t, evt, journaled in records:
+                evt.restore(self.env)
+                delivered = []
+                self._announce(evt, delivered)
+                yield (evt, set([Subscription.canonical(s)
+                                 for s in journaled]), set(delivered))
+        finally:
+            self._capture.sender = None
+
+    def _record_filter_stats(self, filter_stats):
+        for name, (timer, dropped) in filter_stats.items():
+            timer.record()
+            self.stats.count('subscriptions dropped', name, dropped)
+
+
+class CoalescingThread(threading.Thread):
+    """Announces held events when their coalescing window has passed."""
+
+    def __init__(self, system):
+        threading.Thread.__init__(self)
+        self._system = system
+        self.setDaemon(True)
+
+    def run(self):
+        while 1:
+            try:
+                wait = self._system.flush_held_events()
+            except Exception:
+                self._system.log.error("Announcement coalescing failed.",
+                                       exc_info=True)
+                wait = None
+            if wait is None:
+                wait = self._system.coalesce_window
+            time.sleep(max(wait, 0.1))
+
+
+class QueueWorkerThread(threading.Thread):
+    """Announces events from the announcement queue in the background."""
+
+    def __init__(self, system):
+        threading.Thread.__init__(self)
+        self._system = system
+        self._wakeup = threading.Event()
+        self.setDaemon(True)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run(self):
+        while 1:
+            self._wakeup.wait(self._system.queue_poll_interval)
+            self._wakeup.clear()
+            try:
+                self._system.process_queue()
+            except Exception:
+                self._system.log.error("Announcement queue worker failed.",
+                                       exc_info=True)
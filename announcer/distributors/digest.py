@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import os
+import random
+import threading
+import time
+
+from trac.config import IntOption
+from trac.core import *
+from trac.web.api import IRequestFilter
+
+from announcer.api import AnnouncementSystem
+from announcer.distributors.mail import EmailDistributor
+from announcer.util.session import get_session_attribute
+
+class EmailDigester(Component):
+    """Collects the email announcements of users that chose to receive
+    them as an hourly or daily digest, and sends one message per user and
+    period.
+
+    Each announcement is formatted as plain text once, when it is
+    distributed, and stored in the announcement_digest_event table.  The
+    announcement_digest table lists the recipients waiting for it.
+
+    The background thread sending the digests is started by the first
+    request the environment handles.
+    """
+    implements(IRequestFilter)
+
+    digest_interval = IntOption('announcer', 'digest_interval', 300,
+        """Seconds between checks for digests that are due.  Digests can
+        also be sent by `trac-admin $ENV announcer digest send`, e.g. from
+        cron.""")
+
+    # Delivery periods and the session attribute holding them per realm.
+    PERIODS = ('hourly', 'daily')
+    PREFERENCE = 'announcer_email_delivery_%s'
+
+    def __init__(self):
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get_delivery_period(self, realm, sid, authenticated):
+        """Returns 'immediate', 'hourly' or 'daily'."""
+        if not sid:
+            return 'immediate'
+        row = get_session_attribute(self.env, sid, self.PREFERENCE % realm,
+                                    int(authenticated or 0))
+        if row and row[0] in self.PERIODS:
+            return row[0]
+        return 'immediate'
+
+    def collect(self, transport, event, fmtdict, msgdict, entry=None):
+        """Removes the recipients that receive `event` in a digest from the
+        sets in `msgdict`, and stores the announcement for them.  `entry` is
+        the (subject, body, marker) of the event, if already formatted.
+        """
+        held = []
+        for fmt, recipients in msgdict.items():
+            for rcpt in list(recipients):
+                period = self.get_delivery_period(event.realm, rcpt[0],
+                                                  rcpt[1])
+                if period != 'immediate':
+                    recipients.discard(rcpt)
+                    held.append((fmt, rcpt, period))
+        if not held:
+            return 0
+        if entry is None:
+            entry = EmailDistributor(self.env).format_digest_entry(
+                transport, event, fmtdict)
+        if entry is None:
+            self.log.error("EmailDigester found no plain text format for "
+                           "%s, sending right away.", event.realm)
+            for fmt, rcpt, period in held:
+                msgdict[fmt].add(rcpt)
+            return 0
+        now = int(time.time())
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        # The announcement is stored once, the recipients of all chunks
+        # refer to it.
+        memo = AnnouncementSystem(self.env).get_memo()
+        key = ('digest event', id(event), transport)
+        if memo is not None and key in memo:
+            event_id = memo[key]
+        else:
+            subject, body, marker = entry
+            cursor.execute("""
+                INSERT INTO announcement_digest_event
+                            (time, realm, subject, body, marker)
+                     VALUES (%s, %s, %s, %s, %s)
+            """, (now, event.realm, subject, body, marker))
+            event_id = db.get_last_id(cursor, 'announcement_digest_event')
+            if memo is not None:
+                memo[key] = event_id
+        cursor.executemany("""
+            INSERT INTO announcement_digest
+                        (sid, authenticated, address, period, time, event,
+                         owner, lease, attempts, not_before)
+                 VALUES (%s, %s, %s, %s, %s, %s, '', 0, 0, 0)
+        """, [(name, authed and 1 or 0, addr, period, now, event_id)
+              for fmt, (name, authed, addr), period in held])
+        db.commit()
+        self.log.debug("EmailDigester stored %s event for %s recipients",
+                       event.category, len(held))
+        self.start()
+        return len(held)
+
+    def send_digests(self, now=None):
+        """Sends the digests that are due.  Hourly digests include the
+        announcements made before the start of the current hour, daily
+        digests those made before midnight.  Returns the number of digests
+        sent.
+        """
+        now = now or time.time()
+        distributor = EmailDistributor(self.env)
+        count = 0
+        for period in self.PERIODS:
+            cutoff = self._cutoff(period, now)
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT DISTINCT sid, authenticated, address
+                  FROM announcement_digest
+                 WHERE period=%s AND time<%s
+            """, (period, cutoff))
+            for sid, authenticated, address in cursor.fetchall():
+                owner, entries = self._claim_entries(sid, authenticated,
+                                                     address, period, cutoff)
+                if not entries:
+                    continue
+                try:
+                    distributor.send_digest(address, period, entries)
+                except Exception:
+                    self.log.error("EmailDigester failed to send the %s "
+                                   "digest of %s.", period, sid,
+                                   exc_info=True)
+                    self._release_entries(owner, False)
+                    continue
+                self._release_entries(owner, True)
+                count += 1
+        self._purge_events()
+        return count
+
+    def retry_dead_digests(self):
+        """Puts the entries of digests that failed too often back to be
+        sent the next time.  Returns the number of entries."""
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            UPDATE announcement_digest
+               SET owner='', attempts=0, not_before=0
+             WHERE owner='dead'
+        """)
+        count = cursor.rowcount
+        db.commit()
+        return count
+
+    def start(self):
+        """Starts the thread sending digests in the background."""
+        self._lock.acquire()
+        try:
+            if not self._thread or not self._thread.isAlive():
+                self._thread = DigestThread(self)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _claim_entries(self, sid, authenticated, address, period, cutoff):
+        """Marks the entries of a digest as taken by a new owner token and
+        returns the token and the (time, realm, subject, body, marker)
+        tuples of the entries.
+
+        Entries claimed by another process are skipped, unless its lease
+        expired because it died before sending them.  Entries of a digest
+        that failed are not claimed before their retry time.
+        """
+        owner = '%x.%x' % (os.getpid(), random.getrandbits(32))
+        now = int(time.time())
+        expired = now - AnnouncementSystem(self.env).queue_lease_timeout
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            UPDATE announcement_digest
+               SET owner=%s, lease=%s, attempts=attempts+1
+             WHERE sid=%s AND authenticated=%s AND address=%s
+               AND period=%s AND time<%s
+               AND ((owner='' AND not_before<=%s)
+                    OR (owner<>'' AND owner<>'dead' AND lease<%s))
+        """, (owner, now, sid, authenticated, address, period, cutoff,
+              now, expired))
+        db.commit()
+        cursor.execute("""
+            SELECT e.time, e.realm, e.subject, e.body, e.marker
+              FROM announcement_digest d
+              JOIN announcement_digest_event e ON (e.id=d.event)
+             WHERE d.owner=%s
+             ORDER BY e.time, e.id
+        """, (owner,))
+        return owner, cursor.fetchall()
+
+    def _release_entries(self, owner, sent):
+        """Removes the entries claimed by `owner` once they were sent, or
+        returns them to be sent again after a delay growing with the number
+        of attempts.  Entries that failed too often are put aside."""
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        if sent:
+            cursor.execute("""
+                DELETE FROM announcement_digest
+                 WHERE owner=%s
+            """, (owner,))
+            db.commit()
+            return
+        cursor.execute("""
+            SELECT MAX(attempts)
+              FROM announcement_digest
+             WHERE owner=%s
+        """, (owner,))
+        attempts = cursor.fetchone()[0] or 1
+        announcer = AnnouncementSystem(self.env)
+        if attempts >= announcer.queue_max_attempts:
+            next_owner = 'dead'
+        else:
+            next_owner = ''
+        delay = min(announcer.queue_retry_delay * 2 ** (attempts - 1), 86400)
+        cursor.execute("""
+            UPDATE announcement_digest
+               SET owner=%s, not_before=%s
+             WHERE owner=%s
+        """, (next_owner, int(time.time()) + delay, owner))
+        db.commit()
+
+    def _purge_events(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            DELETE FROM announcement_digest_event
+             WHERE id NOT IN (SELECT event FROM announcement_digest)
+        """)
+        db.commit()
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        if self._thread is None:
+            self.start()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    def _cutoff(self, period, now):
+        t = time.localtime(now)
+        if period == 'hourly':
+            return int(time.mktime(t[:4] + (0, 0) + t[6:]))
+        return int(time.mktime(t[:3] + (0, 0, 0) + t[6:]))
+
+
+class DigestThread(threading.Thread):
+    """Sends the digests that are due in the background."""
+
+    def __init__(self, digester):
+        threading.Thread.__init__(self)
+        self._digester = digester
+        self.setDaemon(True)
+
+    def run(self):
+        while 1:
+            time.sleep(self._digester.digest_interval)
+            try:
+                self._digester.send_digests()
+            except Exception:
+                self._digester.log.error("Sending digests failed.",
+                                         exc_info=True)
@@ -31,9 +31,11 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 import Queue
+import atexit
 import random
 import re
 import smtplib
+import socket
 import sys
 import threading
 import time
@@ -54,9 +56,11 @@ from trac.util.compat import set, sorted
 from trac.config import Option, BoolOption, IntOption, OrderedExtensionsOption
 from trac.config import ExtensionOption
 from trac.util import get_pkginfo, md5
-from trac.util.datefmt import to_timestamp
+from trac.util.datefmt import format_datetime, to_timestamp
 from trac.util.text import to_unicode, CRLF
 
+from genshi.template import NewTextTemplate
+
 from announcer.api import AnnouncementSystem
 from announcer.api import IAnnouncementAddressResolver
 from announcer.api import IAnnouncementDistributor
@@ -65,8 +69,11 @@ from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import IAnnouncementProducer
 from announcer.api import _
 
-from announcer.util.mail import set_header
+from announcer.util.mail import begin_slots, end_slots, fill_slots, \
+                                has_slots, next_decorator, set_header
 from announcer.util.mail_crypto import CryptoTxt
+from announcer.util.session import get_session_attribute
+from announcer.util.stats import component_name
 
 
 class IEmailSender(Interface):
@@ -160,6 +167,20 @@ class EmailDistributor(Component):
         if it raises an error.
         """)
 
+    delivery_threads = IntOption('announcer', 'delivery_threads', 2,
+        """Number of threads delivering messages when
+        `use_threaded_delivery` is enabled.""")
+
+    delivery_queue_size = IntOption('announcer', 'delivery_queue_size', 1000,
+        """Maximum number of messages waiting for a delivery thread.  When
+        the queue is full, messages are delivered by the thread that
+        created them.""")
+
+    delivery_shutdown_timeout = IntOption('announcer',
+        'delivery_shutdown_timeout', 30,
+        """Seconds to wait on process exit for the delivery threads to
+        send the queued messages.""")
+
     default_email_format = Option('announcer', 'default_email_format',
         'text/plain',
         """The default mime type of the email notifications.
@@ -219,15 +240,25 @@ class EmailDistributor(Component):
 
 
     def __init__(self):
-        self.delivery_queue = None
+        self._delivery_pool = None
+        self._delivery_lock = threading.Lock()
         self._init_pref_encoding()
 
+    def get_delivery_pool(self):
+        self._delivery_lock.acquire()
+        try:
+            if not self._delivery_pool:
+                self._delivery_pool = DeliveryPool(self.log, self.send,
+                    self.delivery_threads, self.delivery_queue_size,
+                    AnnouncementSystem(self.env).stats)
+                atexit.register(self._delivery_pool.shutdown,
+                                self.delivery_shutdown_timeout)
+            return self._delivery_pool
+        finally:
+            self._delivery_lock.release()
+
     def get_delivery_queue(self):
-        if not self.delivery_queue:
-            self.delivery_queue = Queue.Queue()
-            thread = DeliveryThread(self.delivery_queue, self.send)
-            thread.start()
-        return self.delivery_queue
+        return self.get_delivery_pool().queue
 
     # IAnnouncementDistributor
     def transports(self):
@@ -235,10 +266,7 @@ class EmailDistributor(Component):
 
     def formats(self, transport, realm):
         "Find valid formats for transport and realm"
-        formats = {}
-        for f in self.formatters:
-            for style in f.styles(transport, realm):
-                formats[style] = f
+        formats = AnnouncementSystem(self.env).get_formats(transport, realm)
         self.log.debug(
             "EmailDistributor has found the following formats capable "
             "of handling '%s' of '%s': %s"%(transport, realm,
@@ -262,6 +290,39 @@ class EmailDistributor(Component):
                 "EmailDistributer No formats found for %s %s"%(
                     transport, event.realm))
             return
+        if self.crypto != '':
+            self.log.debug("EmailDistributor attempts crypto operation.")
+            self.enigma = CryptoTxt(self.gpg_binary, self.gpg_home)
+        msgdict, msgdict_encrypt, msg_pubkey_ids = self._sort_recipients(
+            transport, event, recipients, fmtdict)
+        digester = self._get_digester()
+        if digester is not None:
+            digester.collect(transport, event, fmtdict, msgdict)
+        for k, v in msgdict.items():
+            if not v or not fmtdict.get(k):
+                continue
+            self.log.debug(
+                "EmailDistributor is sending event as '%s' to: %s"%(
+                    k, ', '.join(x[2] for x in v)))
+            self._do_send(transport, event, k, v, fmtdict[k])
+        for k, v in msgdict_encrypt.items():
+            if not v or not fmtdict.get(k):
+                continue
+            self.log.debug(
+                "EmailDistributor is sending encrypted info on event " \
+                "as '%s' to: %s"%(k, ', '.join(x[2] for x in v)))
+            self._do_send(transport, event, k, v, fmtdict[k], msg_pubkey_ids)
+
+    def _sort_recipients(self, transport, event, recipients, fmtdict,
+                         addresses=None):
+        """Resolves the addresses of `recipients` and picks the format
+        each of them gets `event` in.  Returns a dict mapping formats to
+        sets of (sid, authenticated, address) tuples, a dict of the
+        recipients of encrypted messages, and the ids of their public keys.
+
+        Addresses resolved for sessions are kept in `addresses`, if given,
+        to resolve them once for several events.
+        """
         msgdict = {}
         msgdict_encrypt = {}
         msg_pubkey_ids = []
@@ -269,14 +330,17 @@ class EmailDistributor(Component):
         RCPT_ALLOW_RE = re.compile(self.rcpt_allow_regexp)
         RCPT_LOCAL_RE = re.compile(self.rcpt_local_regexp)
 
-        if self.crypto != '':
-            self.log.debug("EmailDistributor attempts crypto operation.")
-            self.enigma = CryptoTxt(self.gpg_binary, self.gpg_home)
-
+        stats = AnnouncementSystem(self.env).stats
+        pref_timer = stats.timer('resolver', 'preferred format')
+        resolver_timers = {}
+        if addresses is None:
+            addresses = {}
         for name, authed, addr in recipients:
+            pref_timer.start()
             fmt = name and \
                 self._get_preferred_format(event.realm, name, authed) or \
                 self._get_default_format()
+            pref_timer.stop()
             if fmt not in fmtdict:
                 self.log.debug(("EmailDistributer format %s not available " +
                     "for %s %s, looking for an alternative")%(
@@ -292,15 +356,16 @@ class EmailDistributor(Component):
             if not fmt:
                 self.log.error(
                     "EmailDistributer was unable to find a formatter " +
-                    "for format %s"%k
+                    "for format %s"%oldfmt
                 )
                 continue
             rslvr = None
             if name and not addr:
                 # figure out what the addr should be if it's not defined
-                for rslvr in self.resolvers:
-                    addr = rslvr.get_address_for_name(name, authed)
-                    if addr: break
+                if (name, authed) not in addresses:
+                    addresses[(name, authed)] = self._resolve_address(
+                        name, authed, resolver_timers)
+                addr, rslvr = addresses[(name, authed)]
             if addr:
                 self.log.debug("EmailDistributor found the " \
                         "address '%s' for '%s (%s)' via: %s"%(
@@ -341,20 +406,178 @@ class EmailDistributor(Component):
                 self.log.debug("EmailDistributor was unable to find an " \
                         "address for: %s (%s)"%(name, authed and \
                         'authenticated' or 'not authenticated'))
-        for k, v in msgdict.items():
-            if not v or not fmtdict.get(k):
+        pref_timer.record()
+        for timer in resolver_timers.values():
+            timer.record()
+        return msgdict, msgdict_encrypt, msg_pubkey_ids
+
+    def distribute_many(self, transport, batch):
+        """Sends every recipient reading plain text a single message
+        announcing all events of `batch` they are subscribed to.
+
+        Addresses and formats are picked like for single events, but
+        addresses are resolved once per recipient for the whole batch.
+        Recipients preferring another format get a message per event in
+        that format, those preferring a digest get the events in their
+        digest.  Batches of a single event, and all batches if messages
+        are encrypted or list their recipients in Cc, are distributed
+        event by event.
+        """
+        if not self.enabled or transport not in self.transports():
+            return
+        if len(batch) < 2 or self.crypto != '' or self.use_public_cc:
+            for event, recipients in batch:
+                self.distribute(transport, recipients, event)
+            return
+        digester = self._get_digester()
+        addresses = {}
+        entries = {}
+        for event, recipients in batch:
+            fmtdict = self.formats(transport, event.realm)
+            if not fmtdict:
                 continue
-            self.log.debug(
-                "EmailDistributor is sending event as '%s' to: %s"%(
-                    fmt, ', '.join(x[2] for x in v)))
-            self._do_send(transport, event, k, v, fmtdict[k])
-        for k, v in msgdict_encrypt.items():
-            if not v or not fmtdict.get(k):
+            msgdict = self._sort_recipients(transport, event, recipients,
+                                            fmtdict, addresses)[0]
+            if digester is not None:
+                digester.collect(transport, event, fmtdict, msgdict)
+            plain = msgdict.pop('text/plain', None)
+            for fmt, rcpts in msgdict.items():
+                if rcpts:
+                    self._do_send(transport, event, fmt, rcpts, fmtdict[fmt])
+            if not plain:
                 continue
-            self.log.debug(
-                "EmailDistributor is sending encrypted info on event " \
-                "as '%s' to: %s"%(fmt, ', '.join(x[2] for x in v)))
-            self._do_send(transport, event, k, v, fmtdict[k], msg_pubkey_ids)
+            entry = self.format_digest_entry(transport, event, fmtdict)
+            if entry is None:
+                self.log.error("EmailDistributor could not format %s %s as "
+                               "text/plain", event.realm, event.category)
+                continue
+            for name, authed, addr in plain:
+                entries.setdefault(addr, []).append((time.time(),
+                                                     event.realm) + entry)
+        for addr, items in entries.items():
+            self.send_digest(addr, 'batch', items)
+
+    def _resolve_address(self, name, authed, resolver_timers):
+        """Returns the address of a session and the resolver that found it,
+        timing each resolver in `resolver_timers`."""
+        stats = AnnouncementSystem(self.env).stats
+        addr = rslvr = None
+        for rslvr in self.resolvers:
+            rslvr_name = component_name(rslvr)
+            if rslvr_name not in resolver_timers:
+                resolver_timers[rslvr_name] = stats.timer('resolver',
+                                                          rslvr_name)
+            resolver_timers[rslvr_name].start()
+            addr = rslvr.get_address_for_name(name, authed)
+            resolver_timers[rslvr_name].stop()
+            if addr: break
+        return addr, rslvr
+
+    def _get_digester(self):
+        if AnnouncementSystem(self.env).get_capture() is not None:
+            # Replayed events must not be stored for digests.
+            return None
+        from announcer.distributors.digest import EmailDigester
+        return self.env[EmailDigester]
+
+    def format_digest_entry(self, transport, event, fmtdict):
+        """Returns the subject and plain text body announcing `event` in a
+        digest, or None if no formatter provides plain text."""
+        memo = AnnouncementSystem(self.env).get_memo()
+        key = ('digest entry', id(event), transport)
+        if memo is not None and key in memo:
+            return memo[key]
+        entry = self._format_digest_entry(transport, event, fmtdict)
+        if memo is not None:
+            memo[key] = entry
+        return entry
+
+    def _format_digest_entry(self, transport, event, fmtdict):
+        formatter = fmtdict.get('text/plain')
+        if formatter is None:
+            return None
+        announcer = AnnouncementSystem(self.env)
+        format_timer = announcer.stats.timer('format',
+                                             component_name(formatter))
+        format_timer.start()
+        marker = begin_slots()
+        try:
+            body = announcer.call_guarded(formatter, None, formatter.format,
+                transport, event.realm, 'text/plain', event)
+        finally:
+            end_slots()
+        format_timer.record()
+        if body is None:
+            return None
+        # The subject is set by the decorators of the immediate message.
+        message = MIMEMultipart()
+        message.set_charset(self._charset)
+        self._decorate(event, message)
+        if message['Subject']:
+            subject = to_unicode(unicode(message['Subject']))
+        else:
+            subject = u'%s %s' % (event.realm, event.category)
+        return subject, to_unicode(body), marker
+
+    def send_digest(self, address, period, entries):
+        """Sends a digest of the announcements in `entries`, a list of
+        (time, realm, subject, body, marker) tuples, to `address`.  `period`
+        is 'hourly', 'daily' or 'batch'.  The slots in each body are
+        filled in for `address`."""
+        values = self._recipient_values(None, 0, address)
+        data = dict(
+            period = period,
+            entries = [dict(time=format_datetime(t), realm=realm,
+                            subject=subject,
+                            body=fill_slots(body, values, marker))
+                       for t, realm, subject, body, marker in entries],
+            project_name = self.env.project_name,
+            project_desc = self.env.project_description,
+            project_link = self.env.project_url or self.env.abs_href(),
+        )
+        templates = AnnouncementSystem(self.env).templates
+        template = templates.load('email_digest_plaintext.txt',
+                cls=NewTextTemplate)
+        output = template.generate(**data).render('text')
+
+        message = MIMEText(output, 'plain')
+        del message['Content-Transfer-Encoding']
+        message.set_charset(self._charset)
+        from_header = formataddr((
+            self.from_name or self.env.project_name,
+            self.email_from
+        ))
+        prefix = self.subject_prefix
+        if prefix == '__default__':
+            prefix = '[%s] ' % self.env.project_name
+        if period == 'hourly':
+            subject = _("Hourly announcement digest (%(count)s)",
+                        count=len(entries))
+        elif period == 'daily':
+            subject = _("Daily announcement digest (%(count)s)",
+                        count=len(entries))
+        else:
+            subject = _("Announcements of %(count)s changes",
+                        count=len(entries))
+        headers = {
+            'Message-ID': self._message_id('digest'),
+            'Date': formatdate(),
+            'From': from_header,
+            'To': address,
+            'Reply-To': self.replyto,
+            'Subject': '%s%s' % (prefix or '', subject),
+            'Auto-Submitted': 'auto-generated',
+        }
+        for k, v in headers.iteritems():
+            set_header(message, k, v)
+        self._deliver((from_header, [address], message.as_string()))
+
+    def _deliver(self, package):
+        if AnnouncementSystem(self.env).get_capture() is not None:
+            self.send(*package)
+        elif not self.use_threaded_delivery or \
+                not self.get_delivery_pool().put(package):
+            self.send(*package)
 
     def _get_default_format(self):
         return self.default_email_format
@@ -362,16 +585,8 @@ class EmailDistributor(Component):
     def _get_preferred_format(self, realm, sid, authenticated):
         if authenticated is None:
             authenticated = 0
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT value
-              FROM session_attribute
-             WHERE sid=%s
-               AND authenticated=%s
-               AND name=%s
-        """, (sid, int(authenticated), 'announcer_email_format_%s' % realm))
-        result = cursor.fetchone()
+        result = get_session_attribute(self.env, sid,
+            'announcer_email_format_%s' % realm, int(authenticated))
         if result:
             chosen = result[0]
             self.log.debug("EmailDistributor determined the preferred format" \
@@ -422,11 +637,85 @@ class EmailDistributor(Component):
 
     def _do_send(self, transport, event, format, recipients, formatter,
                  pubkey_ids=[]):
+        announcer = AnnouncementSystem(self.env)
+        memo = announcer.get_memo()
+        # Messages that don't depend on the recipients are formatted and
+        # decorated once per event, and reused for its other chunks.
+        if memo is None or pubkey_ids or self.use_public_cc:
+            key = None
+        else:
+            key = ('message', id(event), transport, format)
+        built = key and memo.get(key)
+        if built is None:
+            built = self._build_message(transport, event, format, recipients,
+                                        formatter, pubkey_ids)
+            if key:
+                memo[key] = built or False
+        elif built:
+            rootMessage, bodies, msgid, marker = built
+            # Unless a decorator set a Message-ID for threading, each copy
+            # gets its own.
+            if rootMessage['Message-ID'] == msgid:
+                set_header(rootMessage, 'Message-ID',
+                           self._message_id(event.realm))
+                memo[key] = (rootMessage, bodies, rootMessage['Message-ID'],
+                             marker)
+        if not built:
+            return
+        rootMessage, bodies, msgid, marker = built
+        from_header = formataddr((
+            self.from_name or self.env.project_name,
+            self.email_from
+        ))
+
+        recip_adds = [x[2] for x in recipients if x]
+        # Append any to, cc or bccs added to the recipient list
+        for field in ('To', 'Cc', 'Bcc'):
+            if rootMessage[field] and \
+                    len(str(rootMessage[field]).split(',')) > 0:
+                for addy in str(rootMessage[field]).split(','):
+                    self._add_recipient(recip_adds, addy)
+
+        self.log.debug("Content of recip_adds: %s" %(recip_adds))
+        start = time.time()
+        if [text for part, text in bodies if has_slots(text, marker)]:
+            self._send_personalized(rootMessage, bodies, marker, from_header,
+                                    recipients, recip_adds, event.realm)
+        else:
+            package = (from_header, recip_adds, rootMessage.as_string())
+            self._deliver(package)
+        stop = time.time()
+        self.log.debug("EmailDistributor took %s seconds to send."\
+                %(round(stop-start,2)))
 
-        output = formatter.format(transport, event.realm, format, event)
+    def _build_message(self, transport, event, format, recipients,
+                       formatter, pubkey_ids):
+        """Formats and decorates the message announcing `event` in
+        `format`.  Returns the message, the body parts with their texts,
+        the Message-ID header it was given and the marker of the slots in
+        the texts, or None if formatting failed."""
+        announcer = AnnouncementSystem(self.env)
+        stats = announcer.stats
+        format_timer = stats.timer('format', component_name(formatter))
+        format_timer.start()
+        marker = begin_slots()
+        try:
+            output = announcer.call_guarded(formatter, None, formatter.format,
+                                            transport, event.realm, format,
+                                            event)
+        finally:
+            end_slots()
+        format_timer.stop()
+        if output is None:
+            format_timer.record()
+            self.log.error("EmailDistributor could not format %s %s as %s"
+                           % (event.realm, event.category, format))
+            return None
 
         # DEVEL: force message body plaintext style for crypto operations
         if self.crypto != '' and pubkey_ids != []:
+            # Encrypted messages are shared by all recipients.
+            output = fill_slots(output, {}, marker)
             if self.crypto == 'sign':
                 output = self.enigma.sign(output, self.private_key)
             elif self.crypto == 'encrypt':
@@ -445,14 +734,23 @@ class EmailDistributor(Component):
                 format
             )
             if alternate_style:
-                alternate_output = formatter.format(
-                    transport,
-                    event.realm,
-                    alternate_style,
-                    event
-                )
+                format_timer.start()
+                begin_slots(marker)
+                try:
+                    alternate_output = announcer.call_guarded(formatter,
+                        None,
+                        formatter.format,
+                        transport,
+                        event.realm,
+                        alternate_style,
+                        event
+                    )
+                finally:
+                    end_slots()
+                format_timer.stop()
             else:
                 alternate_output = None
+        format_timer.record()
 
         # sanity check
         if not self._charset.body_encoding:
@@ -479,6 +777,7 @@ class EmailDistributor(Component):
         headers['Reply-To'] = self.replyto
         for k, v in headers.iteritems():
             set_header(rootMessage, k, v)
+        msgid = rootMessage['Message-ID']
 
         rootMessage.preamble = 'This is a multi-part message in MIME format.'
         if alternate_output:
@@ -488,46 +787,86 @@ class EmailDistributor(Component):
             alt_msg_format = 'html' in alternate_style and 'html' or 'plain'
             msgText = MIMEText(alternate_output, alt_msg_format)
             parentMessage.attach(msgText)
+            bodies = [(msgText, alternate_output)]
         else:
             parentMessage = rootMessage
+            bodies = []
 
         msg_format = 'html' in format and 'html' or 'plain'
         msgText = MIMEText(output, msg_format)
         del msgText['Content-Transfer-Encoding']
         msgText.set_charset(self._charset)
         parentMessage.attach(msgText)
-        decorators = self._get_decorators()
-        if len(decorators) > 0:
-            decorator = decorators.pop()
-            decorator.decorate_message(event, rootMessage, decorators)
-
-        recip_adds = [x[2] for x in recipients if x]
-        # Append any to, cc or bccs added to the recipient list
-        for field in ('To', 'Cc', 'Bcc'):
-            if rootMessage[field] and \
-                    len(str(rootMessage[field]).split(',')) > 0:
-                for addy in str(rootMessage[field]).split(','):
-                    self._add_recipient(recip_adds, addy)
+        bodies.append((msgText, output))
+        decorate_timer = stats.timer('decorate', 'chain').start()
+        self._decorate(event, rootMessage)
+        decorate_timer.record()
         # replace with localized bcc hint
         if headers['To'] == 'undisclosed-recipients: ;':
             set_header(rootMessage, 'To', _('undisclosed-recipients: ;'))
-
-        self.log.debug("Content of recip_adds: %s" %(recip_adds))
-        package = (from_header, recip_adds, rootMessage.as_string())
-        start = time.time()
-        if self.use_threaded_delivery:
-            self.get_delivery_queue().put(package)
-        else:
-            self.send(*package)
-        stop = time.time()
-        self.log.debug("EmailDistributor took %s seconds to send."\
-                %(round(stop-start,2)))
+        return rootMessage, bodies, msgid, marker
+
+
+    def _send_personalized(self, message, bodies, marker, from_header,
+                           recipients, recip_adds, realm):
+        """Sends each recipient its own copy of `message`, with the slots
+        of `marker` in the texts of the body parts in `bodies` filled in
+        for them.  The message is formatted and decorated once, only the
+        bodies and the Message-ID differ."""
+        timer = AnnouncementSystem(self.env).stats.timer('format',
+                                                         'personalize')
+        rcpts = [([addr], self._recipient_values(name, authed, addr))
+                 for name, authed, addr in recipients if addr]
+        # Addresses added by the decorators get an impersonal copy.
+        known = set([addrs[0] for addrs, values in rcpts])
+        others = [addr for addr in recip_adds if addr not in known]
+        if others:
+            rcpts.append((others, {}))
+        for addrs, values in rcpts:
+            timer.start()
+            for part, text in bodies:
+                charset = part.get_charset()
+                html = part.get_content_subtype() == 'html'
+                del part['Content-Transfer-Encoding']
+                part.set_payload(fill_slots(text, values, marker, html),
+                                 charset)
+            set_header(message, 'Message-ID', self._message_id(realm))
+            package = (from_header, addrs, message.as_string())
+            timer.stop()
+            self._deliver(package)
+        timer.record()
+
+    def _recipient_values(self, name, authed, addr):
+        """Returns the values of the personalization slots for a
+        recipient."""
+        values = dict(sid=name, email=addr,
+                      prefs_link=self.env.abs_href.prefs('announcer'))
+        realname = name and get_session_attribute(self.env, name, 'name',
+                                                  int(authed or 0))
+        values['name'] = realname and realname[0] or name or addr
+        return values
 
     def send(self, from_addr, recipients, message):
         """Send message to recipients via e-mail."""
         # Ensure the message complies with RFC2822: use CRLF line endings
         message = CRLF.join(re.split("\r?\n", message))
-        self.email_sender.send(from_addr, recipients, message)
+        sender = AnnouncementSystem(self.env).get_capture() or \
+                 self.email_sender
+        timer = AnnouncementSystem(self.env).stats.timer('send',
+            component_name(sender)).start()
+        sender.send(from_addr, recipients, message)
+        timer.record()
+
+    def _decorate(self, event, message):
+        """Runs the chain of e-mail decorators on `message`.  Each decorator
+        is wrapped in a `GuardedDecorator`, so that one failing or being
+        skipped by the circuit breaker passes the message on to the rest of
+        the chain."""
+        announcer = AnnouncementSystem(self.env)
+        timing = [0.0]
+        decorators = [GuardedDecorator(announcer, d, timing)
+                      for d in self._get_decorators()]
+        next_decorator(event, message, decorators)
 
     def _get_decorators(self):
         return self.decorators[:]
@@ -542,27 +881,37 @@ class EmailDistributor(Component):
 
     def render_announcement_preference_box(self, req, panel):
         supported_realms = {}
+        announcer = AnnouncementSystem(self.env)
         for producer in self.producers:
             for realm in producer.realms():
                 for distributor in self.distributors:
                     for transport in distributor.transports():
-                        for fmtr in self.formatters:
-                            for style in fmtr.styles(transport, realm):
-                                if realm not in supported_realms:
-                                    supported_realms[realm] = set()
-                                supported_realms[realm].add(style)
+                        for style in announcer.get_formats(transport, realm):
+                            if realm not in supported_realms:
+                                supported_realms[realm] = set()
+                            supported_realms[realm].add(style)
 
+        digester = self._get_digester()
         if req.method == "POST":
             for realm in supported_realms:
                 opt = req.args.get('email_format_%s'%realm, False)
                 if opt:
                     req.session['announcer_email_format_%s'%realm] = opt
+                opt = req.args.get('email_delivery_%s'%realm, False)
+                if digester and opt:
+                    req.session[digester.PREFERENCE%realm] = opt
         prefs = {}
+        delivery = {}
         for realm in supported_realms:
             prefs[realm] = req.session.get('announcer_email_format_%s'%realm, None)
+            if digester:
+                delivery[realm] = req.session.get(digester.PREFERENCE%realm,
+                                                  'immediate')
         data = dict(
             realms = supported_realms,
             preferences = prefs,
+            delivery = delivery,
+            periods = digester and ('immediate',) + digester.PERIODS or (),
         )
         return "prefs_announcer_email.html", data
 
@@ -596,8 +945,80 @@ class SmtpEmailSender(Component):
     debuglevel = IntOption('smtp', 'debuglevel', 0,
         """Set to 1 for useful smtp debugging on stdout.""")
 
+    max_connections = IntOption('smtp', 'max_connections', 2,
+        """Number of authenticated SMTP connections kept open for reuse by
+        later messages.  Set to 0 to open a new connection for every
+        message.""")
+
+    idle_timeout = IntOption('smtp', 'idle_timeout', 60,
+        """Seconds an unused SMTP connection is kept open.  This should be
+        shorter than the idle timeout of the SMTP server.""")
+
+    def __init__(self):
+        self._pool = []
+        self._pool_lock = threading.Lock()
 
     def send(self, from_addr, recipients, message):
+        smtp, reused = self._get_connection()
+        try:
+            try:
+                smtp.sendmail(from_addr, recipients, message)
+            except (smtplib.SMTPServerDisconnected, socket.error), e:
+                if not reused:
+                    raise
+                # The server dropped the pooled connection in the meantime.
+                self.log.debug("SmtpEmailSender reconnecting after: %s", e)
+                self._close(smtp)
+                smtp = self._connect()
+                smtp.sendmail(from_addr, recipients, message)
+        except:
+            self._close(smtp)
+            raise
+        self._release(smtp)
+
+    def _get_connection(self):
+        """Returns a tuple of a connected SMTP session and whether it was
+        taken from the pool."""
+        while True:
+            self._pool_lock.acquire()
+            try:
+                if not self._pool:
+                    break
+                smtp, last_used = self._pool.pop()
+            finally:
+                self._pool_lock.release()
+            if time.time() - last_used > self.idle_timeout:
+                self._close(smtp)
+                continue
+            try:
+                # RSET verifies the connection and clears any state left
+                # from the previous transaction.
+                if smtp.rset()[0] == 250:
+                    return smtp, True
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._close(smtp)
+        return self._connect(), False
+
+    def _release(self, smtp):
+        now = time.time()
+        expired = []
+        self._pool_lock.acquire()
+        try:
+            for item in self._pool[:]:
+                if now - item[1] > self.idle_timeout:
+                    self._pool.remove(item)
+                    expired.append(item[0])
+            if len(self._pool) < self.max_connections:
+                self._pool.append((smtp, now))
+            else:
+                expired.append(smtp)
+        finally:
+            self._pool_lock.release()
+        for smtp in expired:
+            self._close(smtp)
+
+    def _connect(self):
         # use defaults to make sure connect() is called in the constructor
         smtpclass = smtplib.SMTP
         if self.use_ssl:
@@ -626,17 +1047,16 @@ class SmtpEmailSender(Component):
                 self.user.encode('utf-8'),
                 self.password.encode('utf-8')
             )
-        smtp.sendmail(from_addr, recipients, message)
-        if self.use_tls or self.use_ssl:
-            # avoid false failure detection when the server closes
-            # the SMTP connection with TLS/SSL enabled
-            import socket
-            try:
-                smtp.quit()
-            except socket.sslerror:
-                pass
-        else:
+        return smtp
+
+    def _close(self, smtp):
+        try:
             smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            # avoid false failure detection when the server closes
+            # the SMTP connection with TLS/SSL enabled, or has already
+            # dropped it
+            smtp.close()
 
 
 class SendmailEmailSender(Component):
@@ -664,15 +1084,124 @@ class SendmailEmailSender(Component):
                             % (child.returncode, err.strip(), cmdline))
 
 
+class CaptureEmailSender(object):
+    """Counts the messages it is given instead of sending them, used when
+    replaying the event journal."""
+
+    def __init__(self):
+        self.messages = 0
+        self.recipients = 0
+        self.size = 0
+
+    def send(self, from_addr, recipients, message):
+        self.messages += 1
+        self.recipients += len(recipients)
+        self.size += len(message)
+
+
+class GuardedDecorator(object):
+    """Calls an e-mail decorator through the circuit breaker of the
+    announcement system, keeping the chain going if it fails or is skipped.
+
+    The decorators of a chain share `timing`, the time spent in the
+    decorators further down the chain, so that the time each one takes on
+    its own is reported to the breaker.
+    """
+
+    def __init__(self, announcer, decorator, timing):
+        self.announcer = announcer
+        self.decorator = decorator
+        self.name = component_name(decorator)
+        self.timing = timing
+
+    def decorate_message(self, event, message, decorates=None):
+        breaker = self.announcer.breaker
+        if not breaker.allow(self.name):
+            return next_decorator(event, message, decorates)
+        before = self.timing[0]
+        start = time.time()
+        failed = False
+        try:
+            try:
+                return self.decorator.decorate_message(event, message,
+                                                       decorates)
+            except Exception:
+                self.announcer.log.error("AnnouncementSystem: %s failed.",
+                                         self.name, exc_info=True)
+                failed = True
+                # The rest of the chain, unless the decorator called it.
+                return next_decorator(event, message, decorates)
+        finally:
+            elapsed = time.time() - start
+            nested = self.timing[0] - before
+            self.timing[0] = before + elapsed
+            breaker.report(self.name, elapsed - nested, failed)
+
+
+class DeliveryPool(object):
+    """Delivers messages from a bounded queue with a number of threads.
+
+    `put()` returns False when the queue is full, leaving delivery to the
+    caller.  A failing message is logged and does not affect the others.
+    """
+
+    def __init__(self, log, sender, workers, size, stats):
+        self.log = log
+        self.stats = stats
+        self.queue = Queue.Queue(max(1, size))
+        self.threads = []
+        for i in range(max(1, workers)):
+            thread = DeliveryThread(self, sender)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, package):
+        try:
+            self.queue.put_nowait(package)
+        except Queue.Full:
+            self.stats.count('delivery queue full', 'EmailDistributor')
+            return False
+        self.stats.sample('delivery queue depth', 'EmailDistributor',
+                          self.queue.qsize())
+        return True
+
+    def shutdown(self, timeout=None):
+        """Stops the threads after the queued messages are delivered,
+        waiting at most `timeout` seconds."""
+        deadline = time.time() + (timeout or 0)
+        def remaining():
+            if timeout is None:
+                return None
+            return max(0, deadline - time.time())
+        try:
+            for thread in self.threads:
+                # Blocks while the queue is full, the threads are draining it.
+                self.queue.put(None, True, remaining())
+        except Queue.Full:
+            pass
+        for thread in self.threads:
+            thread.join(remaining())
+        if self.queue.qsize():
+            self.log.warning("%s messages were not delivered on shutdown.",
+                             self.queue.qsize())
+
+
 class DeliveryThread(threading.Thread):
-    def __init__(self, queue, sender):
+    def __init__(self, pool, sender):
         threading.Thread.__init__(self)
+        self._pool = pool
         self._sender = sender
-        self._queue = queue
         self.setDaemon(True)
 
     def run(self):
         while 1:
-            sendfrom, recipients, message = self._queue.get()
-            self._sender(sendfrom, recipients, message)
-
+            package = self._pool.queue.get()
+            if package is None:
+                return
+            sendfrom, recipients, message = package
+            try:
+                self._sender(sendfrom, recipients, message)
+            except Exception:
+                self._pool.stats.count('delivery failed', 'EmailDistributor')
+                self._pool.log.error("Failed to deliver message to %s.",
+                                     ', '.join(recipients), exc_info=True)
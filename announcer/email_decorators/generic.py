@@ -45,7 +45,7 @@ class ThreadingEmailDecorator(Component):
 
     supported_realms = ListOption('announcer', 'email_threaded_realms',
         ['ticket', 'wiki'],
-        """These are realms with announcements that should be threaded
+        doc="""These are realms with announcements that should be threaded
         emails.  In order for email threads to work, the announcer
         system needs to give the email recreatable Message-IDs based
         on the resources in the realm.  The resources must have a unique
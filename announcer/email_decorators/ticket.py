@@ -31,10 +31,10 @@
 from trac.core import * 
 from trac.config import Option 
 from trac.util.text import to_unicode
-from genshi.template import NewTextTemplate
 
 from announcer.distributors.mail import IAnnouncementEmailDecorator 
 from announcer.util.mail import next_decorator, set_header
+from announcer.util.templates import text_template
  
 class TicketSubjectEmailDecorator(Component):
 
@@ -52,7 +52,7 @@ class TicketSubjectEmailDecorator(Component):
             if event.changes:
                 if 'status' in event.changes:
                     action = 'Status -> %s' % (event.target['status'])
-            template = NewTextTemplate(self.ticket_email_subject)
+            template = text_template(self.ticket_email_subject)
             subject = to_unicode(template.generate(
                 ticket=event.target, 
                 event=event, 
@@ -30,10 +30,10 @@
 # ----------------------------------------------------------------------------
 from trac.core import *
 from trac.config import Option
-from genshi.template import NewTextTemplate
 
 from announcer.distributors.mail import IAnnouncementEmailDecorator
 from announcer.util.mail import next_decorator, set_header
+from announcer.util.templates import text_template
 
 class WikiSubjectEmailDecorator(Component):
 
@@ -47,7 +47,7 @@ class WikiSubjectEmailDecorator(Component):
 
     def decorate_message(self, event, message, decorates=None):
         if event.realm == 'wiki':
-            template = NewTextTemplate(self.wiki_email_subject)
+            template = text_template(self.wiki_email_subject)
             subject = template.generate(
                 page=event.target, 
                 event=event, 
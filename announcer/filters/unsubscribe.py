@@ -43,6 +43,9 @@ from announcer.util.settings import BoolSubscriptionSetting
 class UnsubscribeFilter(Component):
     implements(IAnnouncementSubscriptionFilter, IAnnouncementPreferenceProvider)
 
+    # Nobody gets an announcement if it is unknown who unsubscribed.
+    fail_closed = True
+
     never_announce = BoolOption('announcer', 'never_announce', False,
             """Default value for user overridable never_announce setting.
 
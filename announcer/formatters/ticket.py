@@ -30,40 +30,32 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 
-from announcer.api import IAnnouncementFormatter
+from announcer.api import AnnouncementSystem, IAnnouncementFormatter
+from announcer.util.cache import LRUCache
+from announcer.util.diff import line_diff
+from announcer.util.mail import slot
 
 from genshi import HTML
 from genshi.template import NewTextTemplate, MarkupTemplate
-from genshi.template import TemplateLoader
 
 from trac.config import Option, IntOption, ListOption
 from trac.core import *
 from trac.mimeview import Context
 from trac.test import Mock, MockPerm
 from trac.ticket.api import TicketSystem
+from trac.util.compat import sha1
 from trac.util.text import wrap, to_unicode, exception_to_unicode
 from trac.versioncontrol.diff import diff_blocks
-from trac.web.chrome import Chrome
 from trac.web.href import Href
 from trac.wiki.formatter import HtmlFormatter
 
-import difflib
-
-def diff_cleanup(gen):
-    for value in gen:
-        if value.startswith('---'):
-            continue
-        if value.startswith('+++'):
-            continue
-        if value.startswith('@@'):
-            yield '\n'
-        else:
-            yield value
-
 def lineup(gen):
     for value in gen:
         yield ' ' + value
 
+# Comments rendered as HTML, keyed by a hash of the comment and its context.
+_comment_cache = LRUCache(200)
+
 class TicketFormatter(Component):
     implements(IAnnouncementFormatter)
         
@@ -116,13 +108,10 @@ class TicketFormatter(Component):
             has_changes = short_changes or long_changes,
             long_changes = long_changes,
             short_changes = short_changes,
-            attachment= event.attachment
+            attachment= event.attachment,
+            slot = slot
         )
-        chrome = Chrome(self.env)        
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
+        templates = AnnouncementSystem(self.env).templates
         template = templates.load('ticket_email_plaintext.txt', 
                 cls=NewTextTemplate)
         if template:
@@ -130,6 +119,37 @@ class TicketFormatter(Component):
             output = stream.render('text')
         return output
 
+    def render_comment(self, event):
+        """Returns the comment of `event` rendered as HTML.  Rendered
+        comments are kept in a cache shared by all environments of the
+        process, keyed by the comment, ticket, author and project URL."""
+        key = sha1(u'\0'.join([to_unicode(v) for v in (
+            self.env.abs_href(), event.realm, event.target.id,
+            event.author or '', event.comment or '')]).encode('utf-8'))
+        key = key.hexdigest()
+        html = _comment_cache.get(key)
+        if html is not None:
+            return html
+        try:
+            req = Mock(
+                href=Href(self.env.abs_href()),
+                abs_href=self.env.abs_href(),
+                authname=event.author, 
+                perm=MockPerm(),
+                chrome=dict(
+                    warnings=[],
+                    notices=[]
+                ),
+                args={}
+            )
+            context = Context.from_request(req, event.realm, event.target.id)
+            formatter = HtmlFormatter(self.env, context, event.comment)
+            html = _comment_cache[key] = formatter.generate(True)
+        except Exception, e:
+            self.log.error(exception_to_unicode(e, traceback=True))
+            html = 'Comment in plain text: %s'%event.comment
+        return html
+
     def _header_fields(self, ticket):
         headers = self.ticket_email_header_fields
         fields = TicketSystem(self.env).get_ticket_fields()
@@ -143,46 +163,29 @@ class TicketFormatter(Component):
         ticket = event.target
         short_changes = {}
         long_changes = {}
-        chrome = Chrome(self.env)        
+        announcer = AnnouncementSystem(self.env)
         for field, old_value in event.changes.items():
             new_value = ticket[field]
             if (new_value and '\n' in new_value) or \
                     (old_value and '\n' in old_value):
+                diff = line_diff(wrap(old_value, cols=60),
+                                 wrap(new_value, cols=60), context=3,
+                                 max_size=announcer.diff_max_size,
+                                 max_lines=announcer.diff_max_lines)
+                lines = [line.startswith('@@') and '\n' or line
+                         for line in diff.lines]
+                if diff.omitted:
+                    lines.append('%s%d %slines changed, see %s' % (
+                        diff.lines and '... ' or '', diff.omitted,
+                        diff.lines and 'more ' or '',
+                        self.env.abs_href('ticket', ticket.id)))
                 long_changes[field.capitalize()] = HTML(
-                    "<pre>\n%s\n</pre>" % (
-                        '\n'.join(
-                            diff_cleanup(
-                                difflib.unified_diff(
-                                    wrap(old_value, cols=60).split('\n'), 
-                                    wrap(new_value, cols=60).split('\n'),
-                                    lineterm='', n=3
-                                )
-                            )
-                        )
-                    )
-                )
+                    "<pre>\n%s\n</pre>" % '\n'.join(lines))
 
             else:
                 short_changes[field.capitalize()] = (old_value, new_value)
 
-        try:
-            req = Mock(
-                href=Href(self.env.abs_href()),
-                abs_href=self.env.abs_href(),
-                authname=event.author, 
-                perm=MockPerm(),
-                chrome=dict(
-                    warnings=[],
-                    notices=[]
-                ),
-                args={}
-            )
-            context = Context.from_request(req, event.realm, event.target.id)
-            formatter = HtmlFormatter(self.env, context, event.comment)
-            temp = formatter.generate(True)
-        except Exception, e:
-            self.log.error(exception_to_unicode(e, traceback=True))
-            temp = 'Comment in plain text: %s'%event.comment
+        temp = self.render_comment(event)
         data = dict(
             ticket = ticket,
             author = event.author,
@@ -197,13 +200,10 @@ class TicketFormatter(Component):
             long_changes = long_changes,
             short_changes = short_changes,
             attachment = event.attachment,
+            slot = slot,
             attachment_link = self.env.abs_href('attachment/ticket',ticket.id)
         )
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
+        templates = AnnouncementSystem(self.env).templates
         template = templates.load('ticket_email_mimic.html', 
                 cls=MarkupTemplate)
         if template:
@@ -31,16 +31,14 @@
 # ----------------------------------------------------------------------------
 
 from trac.core import Component, implements
-from announcer.api import IAnnouncementFormatter
+from announcer.api import AnnouncementSystem, IAnnouncementFormatter
+from announcer.util.mail import slot
 from trac.config import Option, IntOption, BoolOption
 from genshi.template import NewTextTemplate, MarkupTemplate
 from genshi import HTML
 from trac.web.href import Href
-from trac.web.chrome import Chrome
-from trac.wiki.model import WikiPage
-from genshi.template import TemplateLoader
 from trac.util.text import wrap
-from trac.versioncontrol.diff import diff_blocks, unified_diff
+from trac.versioncontrol.diff import diff_blocks
 import difflib
 
 def diff_cleanup(gen):
@@ -96,27 +94,27 @@ class WikiFormatter(Component):
             project_name = self.env.project_name,
             project_desc = self.env.project_description,
             project_link = self.env.project_url or self.env.abs_href(),
+            slot = slot,
         )
-        old_page = WikiPage(self.env, page.name, page.version - 1)
         if page.version:
             data["changed"] = True
             data["diff_link"] = self.env.abs_href('wiki', page.name, 
                     action="diff", version=page.version)
-            if self.wiki_email_diff:
+            page_diff = self.wiki_email_diff and page.get_diff()
+            if page_diff:
                 diff = "\n"
                 diff += diff_header % { 'name': page.name,
                                        'version': page.version,
                                        'oldversion': page.version - 1
                                      }
-                for line in unified_diff(old_page.text.splitlines(),
-                                         page.text.splitlines(), context=3):
+                for line in page_diff.lines:
                     diff += "%s\n" % line
+                if page_diff.omitted:
+                    diff += "%s%d %slines changed, see <URL:%s>\n" % (
+                        page_diff.lines and '... ' or '', page_diff.omitted,
+                        page_diff.lines and 'more ' or '', data["diff_link"])
                 data["diff"] = diff
-        chrome = Chrome(self.env)        
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
+        templates = AnnouncementSystem(self.env).templates
         template = templates.load('wiki_email_plaintext.txt', 
                 cls=NewTextTemplate)
         if template:
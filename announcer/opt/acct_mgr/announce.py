@@ -30,9 +30,8 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 from trac.core import *
-from trac.web.chrome import Chrome
 
-from genshi.template import NewTextTemplate, TemplateLoader
+from genshi.template import NewTextTemplate
 
 from announcer.api import AnnouncementSystem, AnnouncementEvent
 from announcer.api import IAnnouncementFormatter, IAnnouncementSubscriber
@@ -40,11 +39,15 @@ from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
 from announcer.distributors.mail import IAnnouncementEmailDecorator
 from announcer.util.mail import set_header, next_decorator
-from announcer.util.settings import BoolSubscriptionSetting
+from announcer.util.settings import BoolSubscriptionSetting, save_session
 
 from acct_mgr.api import IAccountChangeListener
 
 class AccountChangeEvent(AnnouncementEvent):
+
+    # Never write passwords and tokens to the announcement queue.
+    persistent = False
+
     def __init__(self, category, username, password=None, token=None):
         AnnouncementEvent.__init__(self, 'acct_mgr', category, None)
         self.username = username
@@ -79,6 +82,9 @@ class AccountManagerAnnouncement(Component):
         self._notify('verify', username, token=token)
 
     # IAnnouncementSubscriber interface
+    def subscription_events(self):
+        return (('acct_mgr', None),)
+
     def subscriptions(self, event):
         if event.realm == 'acct_mgr':
             for subscriber in self._get_membership(event):
@@ -120,7 +126,7 @@ class AccountManagerAnnouncement(Component):
                 setting.set_user_setting(req.session, 
                         value=req.args.get('acct_mgr_%s_subscription'%k),
                         save=False)
-            req.session.save()
+            save_session(self.env, req.session)
         data = {}
         for k, setting in settings.items():
             data[k] = setting.get_user_setting(req.session.sid)[1]
@@ -179,11 +185,7 @@ class AccountManagerAnnouncement(Component):
             data['verify'] = {
                 'link': self.env.abs_href.verify_email(token=event.token)
             }
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
+        templates = AnnouncementSystem(self.env).templates
         template = templates.load(acct_templates[event.category], 
                 cls=NewTextTemplate)
         if template:
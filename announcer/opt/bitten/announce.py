@@ -30,9 +30,8 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 from trac.core import *
-from trac.web.chrome import Chrome
 
-from genshi.template import NewTextTemplate, TemplateLoader
+from genshi.template import NewTextTemplate
 
 from announcer.api import AnnouncementSystem, AnnouncementEvent
 from announcer.api import IAnnouncementFormatter, IAnnouncementSubscriber
@@ -40,7 +39,7 @@ from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
 from announcer.distributors.mail import IAnnouncementEmailDecorator
 from announcer.util.mail import set_header, next_decorator
-from announcer.util.settings import BoolSubscriptionSetting
+from announcer.util.settings import BoolSubscriptionSetting, save_session
 
 from bitten.api import IBuildListener
 from bitten.model import Build, BuildStep, BuildLog
@@ -50,6 +49,14 @@ class BittenAnnouncedEvent(AnnouncementEvent):
     def __init__(self, build, category):
         AnnouncementEvent.__init__(self, 'bitten', category, build)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['target'] = self.target.id
+        return state
+
+    def restore(self, env):
+        self.target = Build.fetch(env, self.target)
+
 class BittenAnnouncement(Component):
     """Send announcements on build status."""
 
@@ -80,6 +87,9 @@ class BittenAnnouncement(Component):
         self._notify(build, 'completed')
 
     # IAnnouncementSubscriber interface
+    def subscription_events(self):
+        return (('bitten', None),)
+
     def subscriptions(self, event):
         if event.realm == 'bitten':
             settings = self._settings()
@@ -133,7 +143,7 @@ class BittenAnnouncement(Component):
             for k, setting in settings.items():
                 setting.set_user_setting(req.session, 
                     value=req.args.get('bitten_%s_subscription'%k), save=False)
-            req.session.save()
+            save_session(self.env, req.session)
         data = {}
         for k, setting in settings.items():
             data[k] = setting.get_user_setting(req.session.sid)[1]
@@ -189,11 +199,7 @@ class BittenAnnouncement(Component):
                 'descr': self.env.project_description
             }
         }
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
+        templates = AnnouncementSystem(self.env).templates
         template = templates.load('bitten_plaintext.txt', 
                 cls=NewTextTemplate)
         if template:
@@ -31,9 +31,8 @@
 # ----------------------------------------------------------------------------
 from trac.config import BoolOption, Option
 from trac.core import *
-from trac.web.chrome import Chrome
 
-from genshi.template import NewTextTemplate, TemplateLoader
+from genshi.template import NewTextTemplate
 
 from announcer.api import AnnouncementSystem, AnnouncementEvent
 from announcer.api import IAnnouncementFormatter, IAnnouncementSubscriber
@@ -42,7 +41,8 @@ from announcer.api import _
 from announcer.distributors.mail import IAnnouncementEmailDecorator
 from announcer.util.mail import set_header, next_decorator
 from announcer.util.settings import BoolSubscriptionSetting 
-from announcer.util.settings import SubscriptionSetting
+from announcer.util.settings import SubscriptionSetting, save_session
+from announcer.util.templates import text_template
 
 from tracfullblog.api import IBlogChangeListener
 from tracfullblog.model import BlogPost, BlogComment
@@ -68,6 +68,21 @@ class BlogChangeEvent(AnnouncementEvent):
         self.blog_post = blog_post
         self.blog_comment = blog_comment
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        post = (self.blog_post.name, self.blog_post.version)
+        state['target'] = state['blog_post'] = post
+        # Deleted comments are passed as a dict of their fields already.
+        if isinstance(self.blog_comment, BlogComment):
+            state['blog_comment'] = (self.blog_comment.post_name,
+                                     self.blog_comment.number)
+        return state
+
+    def restore(self, env):
+        self.blog_post = self.target = BlogPost(env, *self.blog_post)
+        if isinstance(self.blog_comment, tuple):
+            self.blog_comment = BlogComment(env, *self.blog_comment)
+
 
 class FullBlogAnnouncement(Component):
     """Send announcements on build status."""
@@ -168,6 +183,12 @@ class FullBlogAnnouncement(Component):
         )
 
     # IAnnouncementSubscriber interface
+    def subscription_events(self):
+        for category in ('post created', 'post changed', 'post deleted',
+                         'comment created', 'comment changed',
+                         'comment deleted'):
+            yield ('blog', category)
+
     def subscriptions(self, event):
         if event.realm != 'blog':
             return
@@ -188,7 +209,7 @@ class FullBlogAnnouncement(Component):
     # IAnnouncementEmailDecorator
     def decorate_message(self, event, message, decorates=None):
         if event.realm == "blog":
-            template = NewTextTemplate(self.blog_email_subject)
+            template = text_template(self.blog_email_subject)
             subject = template.generate(
                 blog=event.blog_post, 
                 action=event.category
@@ -221,7 +242,7 @@ class FullBlogAnnouncement(Component):
             for attr, setting in settings.items():
                 setting.set_user_setting(req.session, 
                     value=req.args.get('announcer_blog_%s'%attr), save=False)
-            req.session.save()
+            save_session(self.env, req.session)
         data = {}
         for attr, setting in settings.items():
             data[attr] = setting.get_user_setting(req.session.sid)[1]
@@ -263,12 +284,9 @@ class FullBlogAnnouncement(Component):
                 yield result + (_('New Post'),)
 
             # Watched Author Posts
-            def match(dist, value):
-                for name in [i.strip() for i in value.split(',')]:
-                    if name == event.blog_post.author:
-                        return True
-                return False
-            for result in settings['author_posts'].get_subscriptions(match):
+            author_posts = settings['author_posts']
+            for result in author_posts.get_subscriptions(
+                    token=event.blog_post.author):
                 yield result + (_('Author Post'),)
 
         # All
@@ -289,11 +307,7 @@ class FullBlogAnnouncement(Component):
             body = blog_post.body,
             comment = event.comment,
         )
-        chrome = Chrome(self.env)
-        dirs = []
-        for provider in chrome.template_providers:
-            dirs += provider.get_templates_dirs()
-        templates = TemplateLoader(dirs, variable_lookup='lenient')
+        templates = AnnouncementSystem(self.env).templates
         template = templates.load(
             'fullblog_plaintext.txt',
             cls=NewTextTemplate
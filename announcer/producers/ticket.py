@@ -31,20 +31,51 @@
 # ----------------------------------------------------------------------------
 
 from trac.core import *
-from trac.config import BoolOption
+from trac.config import BoolOption, ListOption
 from trac.ticket.api import ITicketChangeListener
+from trac.web.api import IRequestFilter
 from announcer.api import AnnouncementSystem, AnnouncementEvent, \
         IAnnouncementProducer
+from announcer.util.snapshot import AttachmentSnapshot, TicketSnapshot
 
 class TicketChangeEvent(AnnouncementEvent):
     def __init__(self, realm, category, target,
                  comment=None, author=None, changes={},
                  attachment=None):
-        AnnouncementEvent.__init__(self, realm, category, target)
+        AnnouncementEvent.__init__(self, realm, category,
+                                   TicketSnapshot.from_ticket(target))
         self.author = author
         self.comment = comment
         self.changes = changes
-        self.attachment = attachment
+        self.attachment = AttachmentSnapshot.from_attachment(attachment)
+
+    def restore(self, env):
+        for event in self.merged_events:
+            event.restore(env)
+
+    def coalesce_key(self):
+        if self.category == 'changed':
+            return self.target.id
+
+    def merge(self, event):
+        """Combines the changes of two successive saves of a ticket: fields
+        keep their value from before the first change, and comments are
+        joined.  Fields changed back to their original value are dropped.
+        """
+        events = tuple(self.merged_events or (self,)) + \
+                 tuple(event.merged_events or (event,))
+        changes = {}
+        for e in reversed(events):
+            changes.update(e.changes)
+        for field, old_value in changes.items():
+            if event.target[field] == old_value:
+                del changes[field]
+        comment = '\n\n'.join([e.comment for e in events if e.comment])
+        merged = TicketChangeEvent(self.realm, self.category, event.target,
+                                   comment or event.comment, event.author,
+                                   changes, event.attachment)
+        merged.merged_events = events
+        return merged
 
     def get_basic_terms(self):
         for term in AnnouncementEvent.get_basic_terms(self):
@@ -61,6 +92,11 @@ class TicketChangeEvent(AnnouncementEvent):
         if session_id == ticket['reporter']:
             yield "reporter"
 
+    def get_session_term_sids(self):
+        ticket = self.target
+        return {'updater': [self.author], 'owner': [ticket['owner']],
+                'reporter': [ticket['reporter']]}
+
 
 class TicketChangeProducer(Component):
     implements(ITicketChangeListener, IAnnouncementProducer)
@@ -99,3 +135,44 @@ class TicketChangeProducer(Component):
     def ticket_deleted(self, ticket):
         pass
 
+
+class BatchChangeAnnouncer(Component):
+    """Announces the changes made by a request to many tickets at once,
+    like a batch modification, with `AnnouncementSystem.send_many()`, so
+    each recipient gets one message for all of them."""
+    implements(IRequestFilter)
+
+    batch_paths = ListOption('announcer', 'batch_paths', '/batchmodify',
+        doc="""Paths of requests changing many tickets at once.  The
+        announcements of all changes made by a POST to one of these paths
+        are sent together.""")
+
+    # IRequestFilter
+    def pre_process_request(self, req, handler):
+        if handler is not None and req.method == 'POST' and \
+                req.path_info in self.batch_paths:
+            return BatchRequestHandler(AnnouncementSystem(self.env), handler)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+
+class BatchRequestHandler(object):
+    """Wraps a request handler, collecting the events it sends into a
+    batch.  The handler usually ends with a redirect, which skips
+    `post_process_request`, so the batch is ended here."""
+
+    def __init__(self, announcer, handler):
+        self._announcer = announcer
+        self._handler = handler
+
+    def __getattr__(self, name):
+        return getattr(self._handler, name)
+
+    def process_request(self, req):
+        self._announcer.begin_batch()
+        try:
+            return self._handler.process_request(req)
+        finally:
+            self._announcer.end_batch()
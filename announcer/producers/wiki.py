@@ -32,22 +32,36 @@
 
 from trac.core import *
 from trac.config import BoolOption
+from trac.util.datefmt import from_utimestamp, to_utimestamp
 from trac.wiki.api import IWikiChangeListener
 from announcer.api import AnnouncementSystem, AnnouncementEvent, \
         IAnnouncementProducer
+from announcer.util.snapshot import AttachmentSnapshot, WikiPageSnapshot
 
 class WikiChangeEvent(AnnouncementEvent):
     def __init__(self, realm, category, target, 
                  comment=None, author=None, version=None, 
                  timestamp=None, remote_addr=None,
                  attachment=None):
-        AnnouncementEvent.__init__(self, realm, category, target)
+        AnnouncementEvent.__init__(self, realm, category,
+                                   WikiPageSnapshot.from_page(target))
         self.author = author
         self.comment = comment
         self.version = version
         self.timestamp = timestamp
         self.remote_addr = remote_addr
-        self.attachment = attachment
+        self.attachment = AttachmentSnapshot.from_attachment(attachment)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.timestamp:
+            state['timestamp'] = to_utimestamp(self.timestamp)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.timestamp, (int, long)):
+            self.timestamp = from_utimestamp(self.timestamp)
 
 class WikiChangeProducer(Component):
     implements(IWikiChangeListener, IAnnouncementProducer)
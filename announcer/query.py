@@ -38,8 +38,13 @@ A generalised query parser and matcher.
 import re
 from trac.core import TracError
 
+from announcer.util.cache import LRUCache
 
-__all__ = ['Query', 'InvalidQuery']
+
+__all__ = ['Query', 'InvalidQuery', 'compile_query']
+
+# Compiled queries, keyed by phrase and attribute handlers.
+_query_cache = LRUCache(1000)
 
 
 class InvalidQuery(TracError):
@@ -287,9 +292,52 @@ class Query(QueryNode):
 
         return _convert(self)
 
+    def required_terms(self):
+        """Returns a set of terms of which at least one must be present for
+        the query to match, or None if the query may match without any of
+        its terms, e.g. because of a negation or an attribute.
+
+        >>> sorted(Query('foo (bar or baz)').required_terms())
+        ['foo']
+        >>> sorted(Query('foo or bar baz').required_terms())
+        ['bar', 'foo']
+        >>> print Query('-foo or bar').required_terms()
+        None
+        """
+        def _required(node):
+            if not node:
+                return None
+            if node.type == node.TERM:
+                return set([node.value])
+            elif node.type == node.AND:
+                left = _required(node.left)
+                right = _required(node.right)
+                if left is None or right is None:
+                    return left or right
+                return len(right) < len(left) and right or left
+            elif node.type == node.OR:
+                left = _required(node.left)
+                right = _required(node.right)
+                if left is None or right is None:
+                    return None
+                return left | right
+            return None
+        return _required(self)
+
     def __call__(self, terms, context=None):
-        """Match the query against a sequence of terms."""
-        return self.match(self, terms, context)
+        """Match the query against a sequence of terms.
+
+        The query is compiled on first use, see `compile()`.
+
+        >>> q = Query('(cheese -brie) or crackers')
+        >>> q(['cheese', 'cheddar']), q(['cheese', 'brie']), q(['crackers'])
+        (True, False, True)
+        """
+        if self._compiled is None:
+            self._compiled = self.compile()
+        if not isinstance(terms, frozenset):
+            terms = frozenset(terms)
+        return self._compiled(terms, context)
 
     def match(self, node, terms, context=None):
         """Match a node against a set of terms."""
@@ -315,38 +363,48 @@ class Query(QueryNode):
                 raise NotImplementedError(node.type)
         return _match(node)
 
+    def compile(self):
+        """Compile the parse tree into a callable `f(terms, context)` that
+        gives the same result as `match()` without walking the tree.
 
-    def _compile_call(self, text, attribute_handlers=None):
-        import compiler
-        import types
-        from compiler import ast, misc, pycodegen
+        Terms are passed in as a set.  Term values and attribute handlers
+        are bound as names rather than quoted into the generated source.
 
-        raise NotImplementedError('Incomplete')
-
-        # TODO Make this work?
+        >>> f = Query('(b or c) -d').compile()
+        >>> f(frozenset(['c']), None), f(frozenset(['c', 'd']), None)
+        (True, False)
+        """
+        namespace = {}
+        def _bind(value):
+            name = '_%d' % len(namespace)
+            namespace[name] = value
+            return name
         def _generate(node):
-            if node.type == node.TERM:
-                return ast.Compare(ast.Const(node.value),
-                                   [('in', ast.Name('text'))])
+            if not node or node.type in (node.NULL, None):
+                return 'True'
+            elif node.type == node.TERM:
+                return '(%s in terms)' % _bind(node.value)
             elif node.type == node.AND:
-                return ast.And([_generate(node.left), _generate(node.right)])
+                return '(%s and %s)' % (_generate(node.left),
+                                        _generate(node.right))
             elif node.type == node.OR:
-                return ast.Or([_generate(node.left), _generate(node.right)])
+                return '(%s or %s)' % (_generate(node.left),
+                                       _generate(node.right))
             elif node.type == node.NOT:
-                return ast.Not(_generate(node.left))
+                return '(not %s)' % _generate(node.left)
             elif node.type == node.ATTR:
-                raise NotImplementedError
-
-        qast = ast.Expression(ast.Lambda(['self', 'text',
-                                          'attribute_handlers'],
-                                         [ast.Name('None')],
-                                         0,
-                                         _generate(self)))
-        misc.set_filename('<%s compiled query>' % self.__class__.__name__,
-                          qast)
-        gen = pycodegen.ExpressionCodeGenerator(qast)
-        self.__call__ = types.MethodType(eval(gen.getCode()), self, Query)
-        return self.__call__(text)
+                name = node.left.value
+                handler = self.attribute_handlers.get(
+                    name, self.attribute_handlers['*'])
+                return 'bool(%s(%s, %s, context))' % (_bind(handler),
+                                                      _bind(name),
+                                                      _bind(node.right))
+            else:
+                raise NotImplementedError(node.type)
+        source = 'lambda terms, context=None: %s' % _generate(self)
+        code = compile(source, '<%s compiled query>' %
+                       self.__class__.__name__, 'eval')
+        return eval(code, namespace)
 
     def as_string(self, and_=' AND ', or_=' OR ', not_='NOT '):
         """Convert Query to a boolean expression. Useful for indexers with
@@ -418,6 +476,26 @@ class Query(QueryNode):
     def _invalid_handler(self, name, node, context):
         raise InvalidQuery('Invalid attribute "%s"' % name)
 
+def compile_query(phrase, attribute_handlers=None):
+    """Returns the compiled matcher `f(terms, context)` for `phrase`.
+
+    Matchers are cached, so a rule only needs to be parsed and compiled
+    the first time it is seen.  `terms` should be a frozenset.
+
+    >>> f = compile_query('ticket -closed')
+    >>> f is compile_query('ticket -closed')
+    True
+    >>> f(frozenset(['ticket', 'changed']))
+    True
+    """
+    handlers = attribute_handlers or {}
+    key = (phrase, frozenset(handlers.items()))
+    matcher = _query_cache.get(key)
+    if matcher is None:
+        matcher = Query(phrase, dict(handlers)).compile()
+        _query_cache[key] = matcher
+    return matcher
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -37,21 +37,14 @@ from trac.util.compat import sorted
 from announcer.api import IAnnouncementAddressResolver
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
+from announcer.util.session import get_session_attribute
 
 class SpecifiedEmailResolver(Component):
     implements(IAnnouncementAddressResolver, IAnnouncementPreferenceProvider)
     
     def get_address_for_name(self, name, authenticated):
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT value
-              FROM session_attribute
-             WHERE sid=%s
-               AND authenticated=1
-               AND name=%s
-        """, (name,'announcer_specified_email'))
-        result = cursor.fetchone()
+        result = get_session_attribute(self.env, name,
+                                       'announcer_specified_email', 1)
         if result:
             return result[0]
         return None    
@@ -31,6 +31,8 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 
+import threading
+
 from trac.core import Component, implements, TracError
 from trac.web.chrome import add_stylesheet
 
@@ -39,29 +41,249 @@ from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
 from announcer.query import *
 
+class RuleIndex(object):
+    """Index of rule subscriptions by the terms they require.
+
+    Only rules whose required terms (see `Query.required_terms()`) overlap
+    the terms of an event need to be evaluated.  Rules without required
+    terms, like pure negations, are always evaluated.
+
+    >>> index = RuleIndex()
+    >>> index.add(1, 'ticket', 'changed', 'bob', 1, 'email', 'defect -minor')
+    >>> index.add(2, 'ticket', 'changed', 'ann', 1, 'email', '-task')
+    >>> index.add(3, 'ticket', 'changed', 'joe', 1, 'email', 'owner')
+    >>> [r[0] for r in index.candidates('ticket', 'changed', ['defect'])]
+    [1, 2]
+    >>> [r[0] for r in index.candidates('ticket', 'changed', ['task'],
+    ...                                 {'owner': ['joe']})]
+    [2, 3]
+    >>> def session_terms(sid):
+    ...     return sid == 'joe' and ['owner'] or []
+    >>> [r[0] for r in index.candidates('ticket', 'changed', ['task'],
+    ...                                 session_terms=session_terms)]
+    [2, 3]
+    >>> index.remove(2)
+    >>> [r[0] for r in index.candidates('ticket', 'changed', ['task'])]
+    []
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # id -> (id, realm, category, sid, authenticated, transport, match,
+        #        required terms)
+        self._rules = {}
+        # (realm, category) -> {term: set of ids}
+        self._by_term = {}
+        # (realm, category) -> {sid: {term: set of ids}}
+        self._by_sid = {}
+        # (realm, category) -> set of ids without required terms
+        self._unconditional = {}
+
+    def add(self, rule_id, realm, category, sid, authenticated, transport,
+            rule):
+        """Adds or replaces a rule."""
+        match = compile_query(rule)
+        required = Query(rule).required_terms()
+        self._lock.acquire()
+        try:
+            self._remove(rule_id)
+            key = (realm, category)
+            self._rules[rule_id] = (rule_id, realm, category, sid,
+                                    authenticated, transport, match, required)
+            if required is None:
+                self._unconditional.setdefault(key, set()).add(rule_id)
+                return
+            by_term = self._by_term.setdefault(key, {})
+            by_sid = self._by_sid.setdefault(key, {}).setdefault(sid, {})
+            for term in required:
+                by_term.setdefault(term, set()).add(rule_id)
+                by_sid.setdefault(term, set()).add(rule_id)
+        finally:
+            self._lock.release()
+
+    def remove(self, rule_id):
+        self._lock.acquire()
+        try:
+            self._remove(rule_id)
+        finally:
+            self._lock.release()
+
+    def candidates(self, realm, category, terms, term_sids=None,
+                   session_terms=None):
+        """Returns the rules that may match an event with the given terms,
+        ordered by id.
+
+        `term_sids` maps the session terms of the event to the sids they
+        apply to, see `AnnouncementEvent.get_session_term_sids()`, so only
+        the rules of those sessions requiring those terms are looked up.
+        If it is None, `session_terms` is called with the sid of each rule
+        owner instead, and returns the session terms for that sid.
+        """
+        key = (realm, category)
+        self._lock.acquire()
+        try:
+            ids = set(self._unconditional.get(key, ()))
+            by_term = self._by_term.get(key, {})
+            for term in terms:
+                ids.update(by_term.get(term, ()))
+            by_sid = self._by_sid.get(key, {})
+            if term_sids is not None:
+                for term, sids in term_sids.items():
+                    for sid in sids:
+                        ids.update(by_sid.get(sid, {}).get(term, ()))
+            elif session_terms is not None:
+                for sid, sid_terms in by_sid.items():
+                    for term in session_terms(sid):
+                        ids.update(sid_terms.get(term, ()))
+            ids = list(ids)
+            ids.sort()
+            return [self._rules[i] for i in ids]
+        finally:
+            self._lock.release()
+
+    def _remove(self, rule_id):
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return
+        rule_id, realm, category, sid = rule[:4]
+        required = rule[-1]
+        key = (realm, category)
+        if required is None:
+            self._unconditional[key].discard(rule_id)
+            return
+        by_term = self._by_term[key]
+        by_sid = self._by_sid[key][sid]
+        for term in required:
+            for index in (by_term, by_sid):
+                index[term].discard(rule_id)
+                if not index[term]:
+                    del index[term]
+        if not by_sid:
+            del self._by_sid[key][sid]
+
+
 class RuleBasedTicketSubscriber(Component):
+    """Subscribes the owners of the enabled rules in the subscriptions
+    table that match an event.
+
+    The rules are kept in a `RuleIndex`, built on first use.  Code adding,
+    changing or deleting rules must call `rule_changed()`, which updates
+    the index and a version number in the `system` table.  Before each
+    event, the version is compared with the one the index was built for,
+    so changes made by other processes are picked up too.
+    """
     
     implements(IAnnouncementSubscriber, IAnnouncementPreferenceProvider)
-    
-    # IAnnouncementSubscriber
-    def subscriptions(self, event):
-        terms = self._get_basic_terms(event)
-        db = self.env.get_db_ctx()
+
+    VERSION_KEY = 'announcer_rules_version'
+
+    def __init__(self):
+        self._index = None
+        self._version = None
+        self._index_lock = threading.Lock()
+
+    def rule_changed(self, rule_id, db=None):
+        """Updates the rule index after the row `rule_id` of the
+        subscriptions table was added, changed or deleted.  The change is
+        committed unless `db` is given."""
+        handle_ta = not db
+        db = db or self.env.get_db_cnx()
         cursor = db.cursor()
         cursor.execute("""
-            SELECT id, sid, authenticated, rule
+            SELECT id, realm, category, sid, authenticated, transport, rule
               FROM subscriptions
-             WHERE enabled=1 AND managed=''
-               AND realm=%s
-               AND category=%s
-        """, (event.realm, event.category))
-        for rule_id, session_id, authenticated, rule in cursor.fetchall():
-            query = Query(rule)
-            print "For", session_id, "Rule:", rule
-            if query(terms + self._get_session_terms(session_id, event)):
-                print True
+             WHERE id=%s AND enabled=1 AND managed=''
+        """, (rule_id,))
+        row = cursor.fetchone()
+        version = self._get_version(cursor)
+        if version:
+            cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+                           (str(version + 1), self.VERSION_KEY))
+        else:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           (self.VERSION_KEY, str(version + 1)))
+        if handle_ta:
+            db.commit()
+        self._index_lock.acquire()
+        try:
+            # Without changes by others since the index was built, only
+            # this rule needs to be updated; otherwise the index is rebuilt
+            # with the next event.
+            if self._index is None or self._version != version:
+                return
+            self._version = version + 1
+            self._index.remove(rule_id)
+            if row:
+                try:
+                    self._index.add(*row)
+                except InvalidQuery, e:
+                    self.log.warning("Ignoring invalid rule %s: %s",
+                                     rule_id, e)
+        finally:
+            self._index_lock.release()
+
+    def _get_version(self, cursor):
+        cursor.execute("SELECT value FROM system WHERE name=%s",
+                       (self.VERSION_KEY,))
+        row = cursor.fetchone()
+        return row and int(row[0]) or 0
+
+    def _get_index(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        version = self._get_version(cursor)
+        self._index_lock.acquire()
+        try:
+            if self._index is None or self._version != version:
+                index = RuleIndex()
+                cursor.execute("""
+                    SELECT id, realm, category, sid, authenticated,
+                           transport, rule
+                      FROM subscriptions
+                     WHERE enabled=1 AND managed=''
+                """)
+                for row in cursor:
+                    try:
+                        index.add(*row)
+                    except InvalidQuery, e:
+                        self.log.warning("Ignoring invalid rule %s: %s",
+                                         row[0], e)
+                self._index = index
+                self._version = version
+            return self._index
+        finally:
+            self._index_lock.release()
+
+    # IAnnouncementSubscriber
+    def subscriptions(self, event):
+        """Yields a subscription of the owner of each rule matching
+        `event`, with the transport of the rule."""
+        terms = frozenset(self._get_basic_terms(event))
+        session_terms = {}
+        def _session_terms(sid):
+            if sid not in session_terms:
+                session_terms[sid] = self._get_session_terms(sid, event)
+            return session_terms[sid]
+        try:
+            term_sids = event.get_session_term_sids()
+        except AttributeError:
+            term_sids = None
+        index = self._get_index()
+        for rule in index.candidates(event.realm, event.category, terms,
+                                     term_sids, _session_terms):
+            rule_id, realm, category, sid, authenticated, transport, \
+                match = rule[:7]
+            if _session_terms(sid):
+                matched = match(terms.union(_session_terms(sid)))
             else:
-                print False
+                matched = match(terms)
+            self.log.debug("RuleBasedTicketSubscriber rule '%s' of %s "
+                           "matched: %s", rule_id, sid, matched)
+            if matched:
+                yield (transport, sid, authenticated, None)
 
     def _get_basic_terms(self, event):
         terms = [event.realm, event.category]
@@ -69,7 +291,6 @@ class RuleBasedTicketSubscriber(Component):
             terms.extend(event.get_basic_terms())
         except:
             pass
-        print "Basic terms", terms
         return terms
         
     def _get_session_terms(self, session_id, event):
@@ -78,7 +299,6 @@ class RuleBasedTicketSubscriber(Component):
             terms.extend(event.get_session_terms(session_id))
         except:
             pass
-        print "Session terms", terms
         return terms
         
     # IAnnouncementPreferenceProvider
@@ -44,7 +44,8 @@ from announcer.api import IAnnouncementSubscriber, istrue
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
 
-from announcer.util.settings import BoolSubscriptionSetting
+from announcer.util.session import preload_sessions
+from announcer.util.settings import BoolSubscriptionSetting, save_session
 
 class LegacyTicketSubscriber(Component):
     """Mimics Trac notification settings with added bonus of letting users
@@ -85,18 +86,25 @@ class LegacyTicketSubscriber(Component):
             for attr, setting in settings.items():
                 setting.set_user_setting(req.session, 
                     value=req.args.get('legacy_notify_%s'%attr), save=False)
-            req.session.save()
+            save_session(self.env, req.session)
 
         vars = {}
         for attr, setting in settings.items():
             vars[attr] = setting.get_user_setting(req.session.sid)[1]
         return "prefs_announcer_legacy.html", dict(data=vars)
 
+    def subscription_events(self):
+        for category in ('created', 'changed', 'attachment added'):
+            yield ('ticket', category)
+
     def subscriptions(self, event):
         if event.realm == "ticket":
             if event.category in ('created', 'changed', 'attachment added'):
                 settings = self._settings()
                 ticket = event.target
+                # Fetch the settings of all candidates with one query.
+                preload_sessions(self.env, (ticket['owner'],
+                    ticket['reporter'], event.author))
                 for attr, setting in settings.items():
                     getter = self.__getattribute__('_get_%s'%attr)
                     subscription = getter(event, ticket, setting)
@@ -162,6 +170,10 @@ class CarbonCopySubscriber(Component):
     """Carbon copy subscriber for cc ticket field."""
     implements(IAnnouncementSubscriber)
     
+    def subscription_events(self):
+        for category in ('created', 'changed', 'attachment added'):
+            yield ('ticket', category)
+
     def subscriptions(self, event):
         if event.realm == 'ticket':
             if event.category in ('created', 'changed', 'attachment added'):
@@ -40,11 +40,15 @@ from announcer.api import IAnnouncementSubscriber, istrue
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
 
-from announcer.util.settings import BoolSubscriptionSetting
+from announcer.util.settings import BoolSubscriptionSetting, save_session
 
 class TicketComponentSubscriber(Component):
     implements(IAnnouncementSubscriber, IAnnouncementPreferenceProvider)
     
+    def subscription_events(self):
+        for category in ('changed', 'created', 'attachment added'):
+            yield ('ticket', category)
+
     def subscriptions(self, event):
         if event.realm != 'ticket':
             return
@@ -70,7 +74,7 @@ class TicketComponentSubscriber(Component):
             for attr, setting in settings.items():
                 setting.set_user_setting(req.session, 
                     value=req.args.get('component_%s'%attr), save=False)
-            req.session.save()
+            save_session(self.env, req.session)
         d = {}
         for attr, setting in settings.items():
             d[attr]= setting.get_user_setting(req.session.sid)[1]
@@ -45,6 +45,10 @@ class TicketCustomFieldSubscriber(Component):
             doc="Field names that contain users that should be notified on "
             "ticket changes")
     
+    def subscription_events(self):
+        for category in ('changed', 'created', 'attachment added'):
+            yield ('ticket', category)
+
     def subscriptions(self, event):
         if event.realm == 'ticket':
             ticket = event.target
@@ -40,13 +40,13 @@ from trac.config import ListOption
 from announcer.api import IAnnouncementSubscriber, istrue
 from announcer.api import IAnnouncementPreferenceProvider
 from announcer.api import _
-from announcer.util.settings import BoolSubscriptionSetting
+from announcer.util.settings import BoolSubscriptionSetting, save_session
 
 class JoinableGroupSubscriber(Component):
     implements(IAnnouncementSubscriber, IAnnouncementPreferenceProvider)
     
     joinable_groups = ListOption('announcer', 'joinable_groups', [], 
-        """Joinable groups represent 'opt-in' groups that users may 
+        doc="""Joinable groups represent 'opt-in' groups that users may 
         freely join. 
         
         The name of the groups should be a simple alphanumeric string. By
@@ -55,6 +55,10 @@ class JoinableGroupSubscriber(Component):
         announcement when that ticket is changed.
         """)
     
+    def subscription_events(self):
+        for category in ('changed', 'created', 'attachment added'):
+            yield ('ticket', category)
+
     def subscriptions(self, event):
         if event.realm != 'ticket':
             return
@@ -90,7 +94,7 @@ class JoinableGroupSubscriber(Component):
             for grp, setting in settings.items():
                 setting.set_user_setting(req.session, 
                     value=req.args.get('joinable_group_%s'%grp), save=False)
-            req.session.save()
+            save_session(self.env, req.session)
         groups = {}
         for grp, setting in settings.items():
             groups[grp] = setting.get_user_setting(req.session.sid)[1]
@@ -46,14 +46,16 @@ class UserChangeSubscriber(Component):
     modifies a ticket or wiki page."""
     implements(IAnnouncementSubscriber, IAnnouncementPreferenceProvider)
 
+    def subscription_events(self):
+        for realm in ('wiki', 'ticket'):
+            for category in ('changed', 'created', 'attachment added'):
+                yield (realm, category)
+
     def subscriptions(self, event):
         if event.realm in ('wiki', 'ticket'):
             if event.category in ('changed', 'created', 'attachment added'):
-                def match(dist, val):
-                    for part in val.split(','):
-                        if part.strip() == event.author:
-                            return True
-                for sub in self._setting().get_subscriptions(match):
+                setting = self._setting()
+                for sub in setting.get_subscriptions(token=event.author):
                     self.log.debug("UserChangeSubscriber added '%s'"%sub[1])
                     yield sub
 
@@ -251,6 +251,9 @@ class WatchSubscriber(Component):
         db.commit()
     
     # IAnnouncementSubscriber    
+    def subscription_events(self):
+        return (('wiki', None), ('ticket', None))
+
     def subscriptions(self, event):
         if event.realm in ('wiki', 'ticket'):
             db = self.env.get_db_cnx()
@@ -45,6 +45,11 @@ from announcer.util.settings import SubscriptionSetting
 class GeneralWikiSubscriber(Component):
     implements(IAnnouncementSubscriber, IAnnouncementPreferenceProvider)
         
+    def subscription_events(self):
+        for category in ('changed', 'created', 'attachment added',
+                         'deleted', 'version deleted'):
+            yield ('wiki', category)
+
     def subscriptions(self, event):
         if event.realm != 'wiki':
             return
@@ -29,10 +29,38 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 
+import doctest
 import unittest
 
+import announcer.api
+import announcer.query
+import announcer.subscribers.rulefilters
+import announcer.util.breaker
+import announcer.util.cache
+import announcer.util.diff
+import announcer.util.mail
+import announcer.util.snapshot
+import announcer.util.templates
+from announcer.tests import api, digest, queries, rulefilters, settings, \
+                            smtp_sender, ticket_compat, ticket_formatter
+
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(announcer.api))
+    suite.addTest(doctest.DocTestSuite(announcer.query))
+    suite.addTest(doctest.DocTestSuite(announcer.subscribers.rulefilters))
+    suite.addTest(doctest.DocTestSuite(announcer.util.breaker))
+    suite.addTest(doctest.DocTestSuite(announcer.util.cache))
+    suite.addTest(doctest.DocTestSuite(announcer.util.diff))
+    suite.addTest(doctest.DocTestSuite(announcer.util.mail))
+    suite.addTest(doctest.DocTestSuite(announcer.util.snapshot))
+    suite.addTest(doctest.DocTestSuite(announcer.util.templates))
+    suite.addTest(api.suite())
+    suite.addTest(digest.suite())
+    suite.addTest(queries.suite())
+    suite.addTest(rulefilters.suite())
+    suite.addTest(settings.suite())
+    suite.addTest(smtp_sender.suite())
     suite.addTest(ticket_compat.suite())
     suite.addTest(ticket_formatter.suite())
     return suite
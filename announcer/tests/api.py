@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import cPickle
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from email.MIMEMultipart import MIMEMultipart
+
+from trac.core import *
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+from trac.wiki.model import WikiPage
+
+from announcer.api import *
+from announcer.distributors.mail import EmailDistributor, \
+                                       IAnnouncementEmailDecorator
+from announcer.util.mail import next_decorator, set_header
+from announcer.producers.ticket import TicketChangeEvent
+from announcer.producers.wiki import WikiChangeEvent
+from announcer.util.journal import EventJournal, read_journal
+from announcer.util.snapshot import TicketSnapshot, WikiPageSnapshot
+
+class QueuedEvent(AnnouncementEvent):
+    def restore(self, env):
+        if self.target == 'broken':
+            raise TracError('cannot restore')
+
+class UnmergedEvent(AnnouncementEvent):
+    def coalesce_key(self):
+        return self.target
+
+class RecordingSubscriber(Component):
+    implements(IAnnouncementSubscriber)
+
+    def __init__(self):
+        self.events = []
+
+    def subscriptions(self, event):
+        self.events.append((event.realm, event.category, event.target))
+        return [('email', 'user%s' % i, True, None) for i in range(3)]
+
+class WikiSubscriber(RecordingSubscriber):
+    def subscription_events(self):
+        return (('wiki', 'created'), ('wiki', 'changed'))
+
+class DroppingFilter(Component):
+    implements(IAnnouncementSubscriptionFilter)
+
+    def filter_subscriptions(self, event, subscriptions):
+        for s in subscriptions:
+            if s[1] != 'user0':
+                yield s
+
+class BrokenDistributor(Component):
+    implements(IAnnouncementDistributor)
+
+    def transports(self):
+        yield 'email'
+
+    def distribute(self, transport, recipients, event):
+        raise TracError('cannot distribute')
+
+class AnnouncementQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber])
+        self.env.config.set('announcer', 'use_event_queue', 'true')
+        self.out = AnnouncementSystem(self.env)
+        self.out.upgrade_environment(self.env.get_db_cnx())
+        # Process the queue synchronously.
+        self.out._get_queue_worker = lambda: self
+        self.recorder = RecordingSubscriber(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def wake(self):
+        pass
+
+    def _queue(self):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT owner, attempts FROM announcement_queue")
+        return cursor.fetchall()
+
+    def test_schema_version(self):
+        db = self.env.get_db_cnx()
+        self.assertEqual(self.out.db_version,
+                         self.out._get_schema_version(db))
+        self.assertFalse(self.out.environment_needs_upgrade(db))
+
+    def test_send_enqueues(self):
+        self.out.send(QueuedEvent('ticket', 'changed', 1))
+        self.assertEqual([], self.recorder.events)
+        self.assertEqual([('', 0)], self._queue())
+        self.assertEqual(1, self.out.process_queue())
+        self.assertEqual([('ticket', 'changed', 1)], self.recorder.events)
+        self.assertEqual([], self._queue())
+
+    def test_not_persistent(self):
+        evt = QueuedEvent('acct_mgr', 'reset', None)
+        evt.persistent = False
+        self.out.send(evt)
+        self.assertEqual([('acct_mgr', 'reset', None)], self.recorder.events)
+        self.assertEqual([], self._queue())
+
+    def test_abandoned_events_are_claimed_again(self):
+        self.out.send(QueuedEvent('ticket', 'changed', 1))
+        owner, rows = self.out._claim_events()
+        self.assertEqual(1, len(rows))
+        # The claiming worker died, the lease is still valid.
+        self.assertEqual(0, self.out.process_queue())
+        self.env.config.set('announcer', 'queue_lease_timeout', -1)
+        self.assertEqual(1, self.out.process_queue())
+        self.assertEqual([], self._queue())
+
+    def test_failing_events_are_retried_later(self):
+        self.out.send(QueuedEvent('ticket', 'changed', 'broken'))
+        self.assertEqual(0, self.out.process_queue())
+        self.assertEqual([('', 1)], self._queue())
+        # The event is not claimed again before its retry time.
+        owner, rows = self.out._claim_events()
+        self.assertEqual([], rows)
+        db = self.env.get_db_cnx()
+        db.cursor().execute("UPDATE announcement_queue SET not_before=0")
+        db.commit()
+        owner, rows = self.out._claim_events()
+        self.assertEqual(1, len(rows))
+
+    def test_failing_announcements_are_retried_later(self):
+        self.env.enable_component(BrokenDistributor)
+        self.out.send(QueuedEvent('ticket', 'changed', 1))
+        now = int(time.time())
+        self.assertEqual(0, self.out.process_queue())
+        self.assertEqual([('ticket', 'changed', 1)], self.recorder.events)
+        self.assertEqual([('', 1)], self._queue())
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT not_before FROM announcement_queue")
+        self.assertTrue(cursor.fetchone()[0] > now)
+
+    def test_worker_started_by_request(self):
+        workers = []
+        self.out._get_queue_worker = lambda: workers.append(1) or self
+        self.out.pre_process_request(None, None)
+        self.assertEqual([1], workers)
+
+    def test_failing_events_are_put_aside(self):
+        self.env.config.set('announcer', 'queue_max_attempts', 2)
+        self.env.config.set('announcer', 'queue_retry_delay', 0)
+        self.out.send(QueuedEvent('ticket', 'changed', 'broken'))
+        self.assertEqual(0, self.out.process_queue())
+        self.assertEqual([('dead', 2)], self._queue())
+        self.assertEqual((0, 0, 1), self.out.get_queue_status())
+        self.assertEqual(1, self.out.retry_dead_events())
+        self.assertEqual((1, 0, 0), self.out.get_queue_status())
+
+class PipelineStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber,
+                    DroppingFilter])
+        self.out = AnnouncementSystem(self.env)
+
+    def test_stages_and_counters(self):
+        self.out.send(AnnouncementEvent('ticket', 'changed', None))
+        self.out.send(AnnouncementEvent('ticket', 'changed', None))
+        data = self.out.stats.snapshot()
+        timings = dict(((t['stage'], t['component']), t)
+                       for t in data['timings'])
+        self.assertEqual(2, timings[('event', 'ticket')]['count'])
+        self.assertEqual(2, timings[('subscriber',
+                                     'RecordingSubscriber')]['count'])
+        self.assertEqual(2, timings[('filter', 'DroppingFilter')]['count'])
+        counters = dict(((c['counter'], c['component']), c)
+                        for c in data['counters'])
+        produced = counters[('subscriptions produced', 'RecordingSubscriber')]
+        self.assertEqual((2, 6), (produced['count'], produced['total']))
+        dropped = counters[('subscriptions dropped', 'DroppingFilter')]
+        self.assertEqual((2, 1), (dropped['total'], dropped['max']))
+        self.out.stats.reset()
+        self.assertEqual([], self.out.stats.snapshot()['timings'])
+
+class SubscriberRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber,
+                    WikiSubscriber])
+        self.out = AnnouncementSystem(self.env)
+
+    def test_declared_events(self):
+        self.out.send(AnnouncementEvent('ticket', 'changed', 1))
+        self.out.send(AnnouncementEvent('wiki', 'changed', 'WikiStart'))
+        self.assertEqual([('ticket', 'changed', 1),
+                          ('wiki', 'changed', 'WikiStart')],
+                         RecordingSubscriber(self.env).events)
+        self.assertEqual([('wiki', 'changed', 'WikiStart')],
+                         WikiSubscriber(self.env).events)
+
+    def test_registry_cached(self):
+        subscribers = self.out.get_subscribers('wiki', 'created')
+        self.assertEqual(2, len(subscribers))
+        self.assertTrue(subscribers is
+                        self.out.get_subscribers('wiki', 'created'))
+        self.assertEqual(1, len(self.out.get_subscribers('wiki', 'deleted')))
+
+class CoalescingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber])
+        self.env.config.set('announcer', 'coalesce_window', '60')
+        self.out = AnnouncementSystem(self.env)
+        self.recorder = RecordingSubscriber(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _ticket(self):
+        ticket = Ticket(self.env)
+        ticket.populate(dict(summary='Summary', status='new',
+                             reporter='bob', keywords='minor'))
+        ticket.insert()
+        return ticket
+
+    def _change(self, ticket, author, comment, **values):
+        old_values = {}
+        for field, value in values.items():
+            old_values[field] = ticket[field]
+            ticket[field] = value
+        ticket.save_changes(author, comment)
+        return TicketChangeEvent('ticket', 'changed', ticket, comment,
+                                 author, old_values)
+
+    def test_changes_merged(self):
+        ticket = self._ticket()
+        self.out.send(self._change(ticket, 'bob', 'typo', summary='Fixed'))
+        self.out.send(self._change(ticket, 'ann', '', keywords='major'))
+        self.out.send(self._change(ticket, 'bob', 'again', keywords='minor'))
+        self.assertEqual([], self.recorder.events)
+        self.assertTrue(self.out.flush_held_events() > 0)
+        self.assertEqual(None, self.out.flush_held_events(True))
+        # Subscriptions are collected for each of the merged changes.
+        self.assertEqual([('ticket', 'changed', ticket.id)] * 3,
+                         [(r, c, t.id) for r, c, t in self.recorder.events])
+
+    def test_merge(self):
+        ticket = self._ticket()
+        first = self._change(ticket, 'bob', 'typo', summary='Fixed')
+        second = self._change(ticket, 'ann', '', keywords='major')
+        third = self._change(ticket, 'bob', 'again', keywords='minor')
+        merged = first.merge(second).merge(third)
+        self.assertEqual({'summary': 'Summary'}, merged.changes)
+        self.assertEqual('typo\n\nagain', merged.comment)
+        self.assertEqual('bob', merged.author)
+        self.assertEqual((first, second, third), merged.merged_events)
+
+    def test_unmerged_events(self):
+        self.out.send(UnmergedEvent('wiki', 'changed', 'WikiStart'))
+        self.out.send(UnmergedEvent('wiki', 'changed', 'WikiStart'))
+        # The first event is announced when it can't be merged.
+        self.assertEqual([('wiki', 'changed', 'WikiStart')],
+                         self.recorder.events)
+        self.out.flush_held_events(True)
+        self.assertEqual(2, len(self.recorder.events))
+
+    def test_other_events_not_held(self):
+        self.out.send(AnnouncementEvent('wiki', 'changed', 'WikiStart'))
+        self.assertEqual([('wiki', 'changed', 'WikiStart')],
+                         self.recorder.events)
+
+class EventSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_ticket_event(self):
+        ticket = Ticket(self.env)
+        ticket.populate(dict(summary='Summary', reporter='bob', cc='ann'))
+        ticket.insert()
+        event = TicketChangeEvent('ticket', 'created', ticket, author='bob')
+        ticket['summary'] = 'Changed later'
+        event = cPickle.loads(cPickle.dumps(event, 2))
+        event.restore(self.env)
+        self.assertEqual(ticket.id, event.target.id)
+        self.assertEqual('Summary', event.target['summary'])
+        self.assertEqual(ticket.time_created, event.target.time_created)
+        data = TicketSnapshot.from_dict(event.target.to_dict())
+        self.assertEqual(ticket.time_created, data.time_created)
+
+    def test_wiki_event(self):
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = 'one\ntwo\n'
+        page.save('bob', 'created', '::1')
+        page.text = 'one\nthree\n'
+        page.save('ann', 'changed', '::1')
+        event = WikiChangeEvent('wiki', 'changed', page, author='ann',
+                                version=page.version, timestamp=page.time)
+        event = cPickle.loads(cPickle.dumps(event, 2))
+        self.assertEqual(page.time, event.timestamp)
+        self.assertEqual(2, event.target.version)
+        diff = event.target.get_diff()
+        self.assertTrue('-two' in diff.lines)
+        self.assertTrue('+three' in diff.lines)
+        self.assertEqual(2, diff.changed)
+        self.assertEqual(event.target.to_dict(),
+            WikiPageSnapshot.from_dict(event.target.to_dict()).to_dict())
+
+    def test_wiki_diff_limits(self):
+        self.env.config.set('announcer', 'diff_max_lines', 3)
+        page = WikiPage(self.env, 'Large')
+        page.text = '\n'.join(['line %d' % i for i in range(10)])
+        page.save('bob', 'created', '::1')
+        page.text = '\n'.join(['changed %d' % i for i in range(10)])
+        page.save('ann', 'changed', '::1')
+        diff = WikiPageSnapshot.from_page(page).get_diff()
+        self.assertEqual(['@@ -1,10 +1,10 @@', '-line 0', '-line 1'],
+                         diff.lines)
+        self.assertEqual(18, diff.omitted)
+        self.env.config.set('announcer', 'diff_max_size', 100)
+        diff = WikiPageSnapshot.from_page(page).get_diff()
+        self.assertEqual([], diff.lines)
+        self.assertEqual(20, diff.omitted)
+        # The diff is taken with the snapshot, not when it is formatted.
+        snapshot = WikiPageSnapshot.from_page(page)
+        page.text = 'edited later'
+        page.save('bob', 'changed', '::1')
+        self.assertEqual(20, snapshot.get_diff().omitted)
+        self.assertEqual(None, WikiPageSnapshot('Missing', 0).get_diff())
+
+class RecordingDistributor(Component):
+    implements(IAnnouncementDistributor)
+
+    def __init__(self):
+        self.events = []
+
+    def transports(self):
+        yield 'email'
+
+    def distribute(self, transport, recipients, event):
+        self.events.append((event.target, sorted(recipients)))
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber,
+                    RecordingDistributor])
+        self.out = AnnouncementSystem(self.env)
+        self.distributor = RecordingDistributor(self.env)
+
+    def test_nested_batch(self):
+        self.out.begin_batch()
+        self.out.send(AnnouncementEvent('ticket', 'changed', 1))
+        self.out.begin_batch()
+        self.out.send(AnnouncementEvent('ticket', 'changed', 2))
+        self.out.end_batch()
+        self.assertEqual([], self.distributor.events)
+        self.out.end_batch()
+        recipients = [('user%s' % i, True, None) for i in range(3)]
+        self.assertEqual([(1, recipients), (2, recipients)],
+                         self.distributor.events)
+        self.out.send(AnnouncementEvent('ticket', 'changed', 3))
+        self.assertEqual(3, len(self.distributor.events))
+
+class StreamingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber,
+                    WikiSubscriber, DroppingFilter, RecordingDistributor])
+        self.env.config.set('announcer', 'distribute_chunk_size', 2)
+        self.out = AnnouncementSystem(self.env)
+        self.distributor = RecordingDistributor(self.env)
+
+    def test_chunks(self):
+        self.out.send(AnnouncementEvent('wiki', 'changed', 'WikiStart'))
+        # Both subscribers yield the same subscriptions, user0 is dropped.
+        self.assertEqual([('WikiStart', [('user1', True, None)]),
+                          ('WikiStart', [('user2', True, None)])],
+                         self.distributor.events)
+        counters = dict(((c['counter'], c['component']), c['total'])
+                        for c in self.out.stats.snapshot()['counters'])
+        self.assertEqual(3, counters[('subscriptions produced',
+                                      'RecordingSubscriber')])
+        self.assertEqual(0, counters[('subscriptions produced',
+                                      'WikiSubscriber')])
+        self.assertEqual(1, counters[('subscriptions dropped',
+                                      'DroppingFilter')])
+
+class FailingSubscriber(Component):
+    implements(IAnnouncementSubscriber)
+
+    def __init__(self):
+        self.calls = 0
+
+    def subscriptions(self, event):
+        self.calls += 1
+        yield ('email', 'failing', True, None)
+        raise TracError('lookup failed')
+
+class FailingFilter(Component):
+    implements(IAnnouncementSubscriptionFilter)
+
+    failing = True
+
+    def filter_subscriptions(self, event, subscriptions):
+        if self.failing:
+            raise TracError('filter failed')
+        return subscriptions
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber,
+                    FailingSubscriber, FailingFilter, RecordingDistributor])
+        self.env.config.set('announcer', 'breaker_threshold', 2)
+        self.out = AnnouncementSystem(self.env)
+        self.distributor = RecordingDistributor(self.env)
+
+    def test_failures_are_isolated(self):
+        FailingFilter(self.env).failing = False
+        self.out.send(AnnouncementEvent('ticket', 'changed', 1))
+        self.assertEqual([(1, [('failing', True, None), ('user0', True, None),
+                               ('user1', True, None), ('user2', True, None)])],
+                         self.distributor.events)
+
+    def test_failing_filter_passes_subscriptions(self):
+        self.out.send(AnnouncementEvent('ticket', 'changed', 1))
+        self.assertEqual([(1, [('failing', True, None), ('user0', True, None),
+                               ('user1', True, None), ('user2', True, None)])],
+                         self.distributor.events)
+
+    def test_failing_opt_out_filter_drops_subscriptions(self):
+        FailingFilter(self.env).fail_closed = True
+        self.out.send(AnnouncementEvent('ticket', 'changed', 1))
+        self.assertEqual([], self.distributor.events)
+
+    def test_failing_component_is_skipped(self):
+        for i in range(3):
+            self.out.send(AnnouncementEvent('ticket', 'changed', i))
+        self.assertEqual(2, FailingSubscriber(self.env).calls)
+        # A filter skipped by the breaker lets all subscriptions pass.
+        self.assertEqual([0, 1, 2],
+                         [e[0] for e in self.distributor.events])
+        self.assertEqual([('user0', True, None), ('user1', True, None),
+                          ('user2', True, None)],
+                         self.distributor.events[2][1])
+        counters = dict(((c['counter'], c['component']), c['total'])
+                        for c in self.out.stats.snapshot()['counters'])
+        self.assertEqual(2, counters[('component failed',
+                                      'FailingSubscriber')])
+        self.assertEqual(1, counters[('component skipped',
+                                      'FailingSubscriber')])
+        self.assertEqual(1, counters[('component skipped', 'FailingFilter')])
+        self.assertEqual(['FailingFilter', 'FailingSubscriber'],
+                         [b['component'] for b in self.out.breaker.snapshot()
+                          if b['open']])
+
+class ChainedDecorator(Component):
+    implements(IAnnouncementEmailDecorator)
+
+    def decorate_message(self, event, message, decorates=None):
+        set_header(message, 'X-Remaining', str(len(decorates)))
+        return next_decorator(event, message, decorates)
+
+class FailingDecorator(Component):
+    implements(IAnnouncementEmailDecorator)
+
+    def decorate_message(self, event, message, decorates=None):
+        raise TracError('decorator failed')
+
+class DecoratorChainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, EmailDistributor,
+                    ChainedDecorator, FailingDecorator])
+
+    def test_failing_decorator_keeps_chain(self):
+        distributor = EmailDistributor(self.env)
+        for i in range(3):
+            message = MIMEMultipart()
+            distributor._decorate(AnnouncementEvent('ticket', 'changed', 1),
+                                  message)
+            self.assertEqual('0', message['X-Remaining'])
+        # The failing decorator is skipped after breaker_threshold calls.
+        self.assertEqual(['FailingDecorator'],
+                         [b['component'] for b in
+                          AnnouncementSystem(self.env).breaker.snapshot()
+                          if b['open']])
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RecordingSubscriber,
+                    RecordingDistributor])
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+        self.env.config.set('announcer', 'journal_file', self.path)
+        self.out = AnnouncementSystem(self.env)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+        self.out.send(AnnouncementEvent('ticket', 'changed', 1))
+        self.out.send(AnnouncementEvent('ticket', 'created', 2))
+        records = list(read_journal(self.path))
+        self.assertEqual([1, 2], [evt.target for t, evt, s in records])
+        self.assertEqual(3, len(records[0][2]))
+        # Pretend user2 was not subscribed when the event was journaled.
+        t, evt, subscriptions = records[1]
+        records[1] = (t, evt, [s for s in subscriptions if s[1] != 'user2'])
+        results = list(self.out.replay(records, None))
+        self.assertEqual(set(), results[0][1] ^ results[0][2])
+        self.assertEqual(set([('email', 'user2', 1, None)]),
+                         results[1][2] - results[1][1])
+        # Replayed events are not journaled again.
+        self.assertEqual(2, len(list(read_journal(self.path))))
+
+    def test_rotation(self):
+        journal = EventJournal(self.path, 400, 2)
+        for i in range(10):
+            journal.write(AnnouncementEvent('ticket', 'changed', i), [])
+        self.assertEqual(['journal', 'journal.1', 'journal.2'],
+                         sorted(os.listdir(self.dir)))
+        self.assertEqual(9, list(read_journal(self.path))[-1][1].target)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AnnouncementQueueTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(PipelineStatsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SubscriberRegistryTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CoalescingTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(BatchTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(StreamingTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CircuitBreakerTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DecoratorChainTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(EventSnapshotTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(JournalTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+"""Load test of the announcement pipeline.
+
+Builds an in-memory environment with generated users, subscriptions and
+tickets, announces ticket and wiki changes to them and delivers the
+e-mail to an SMTP sink on a loopback port.  Run it with
+
+    python -m announcer.tests.benchmark --users 1000 --events 200 \\
+        --output results.json
+
+and compare the JSON results of different runs.
+"""
+
+import asyncore
+import random
+import resource
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from trac.test import EnvironmentStub
+from trac.ticket import model
+from trac.util.presentation import to_json
+from trac.web.session import DetachedSession
+from trac.wiki.model import WikiPage
+
+from announcer.api import AnnouncementSystem
+from announcer.distributors.mail import EmailDistributor, SmtpEmailSender
+from announcer.producers.ticket import TicketChangeEvent
+from announcer.producers.wiki import WikiChangeEvent
+from announcer.query import Query, compile_query
+from announcer.subscribers.rulefilters import RuleBasedTicketSubscriber
+from announcer.subscribers.watchers import WatchSubscriber
+from announcer.tests.smtp_sender import SmtpSink
+from announcer.util.settings import BoolSubscriptionSetting, \
+                                    SubscriptionSetting, save_session
+from announcer.util.stats import Histogram
+
+# Modules of the components taking part.  Producers are left out, so that
+# populating the environment announces nothing.
+MODULES = ('api', 'distributors.mail', 'distributors.digest', 'email_decorators.generic',
+           'email_decorators.ticket', 'email_decorators.wiki',
+           'filters.change_author', 'filters.unsubscribe',
+           'formatters.ticket', 'formatters.wiki', 'pref',
+           'resolvers.defaultdomain',
+           'resolvers.sessionemail', 'resolvers.specified',
+           'subscribers.rulefilters', 'subscribers.ticket_compat',
+           'subscribers.ticket_components', 'subscribers.ticket_custom',
+           'subscribers.ticket_groups', 'subscribers.watchers',
+           'subscribers.wiki')
+
+GROUPS = ('dev', 'qa', 'docs')
+
+def create_environment(options, sink_port):
+    for name in MODULES:
+        __import__('announcer.' + name)
+    env = EnvironmentStub(enable=['trac.*'] +
+                          ['announcer.%s.*' % name for name in MODULES])
+    config = env.config
+    config.set('announcer', 'email_enabled', 'true')
+    config.set('announcer', 'email_sender', 'SmtpEmailSender')
+    config.set('announcer', 'use_threaded_delivery',
+               options.threaded and 'true' or 'false')
+    config.set('announcer', 'joinable_groups',
+               ','.join(['@' + g for g in GROUPS]))
+    config.set('smtp', 'server', '127.0.0.1')
+    config.set('smtp', 'port', sink_port)
+    AnnouncementSystem(env).upgrade_environment(env.get_db_cnx())
+    return env
+
+def populate(env, options, rand):
+    """Creates users with sessions and subscriptions, components, tickets
+    and wiki pages, and returns the tickets and pages."""
+    components = []
+    for i in range(options.components):
+        component = model.Component(env)
+        component.name = 'component%d' % i
+        component.insert()
+        components.append(component.name)
+    users = ['user%d' % i for i in range(options.users)]
+    tickets = []
+    for i in range(options.tickets):
+        ticket = model.Ticket(env)
+        ticket.populate(dict(summary='Ticket %d' % i, status='new',
+            type='defect', priority='major',
+            component=rand.choice(components),
+            owner=rand.choice(users), reporter=rand.choice(users),
+            cc=', '.join(rand.sample(users, min(3, len(users))) +
+                         ['@' + rand.choice(GROUPS)]),
+            description='Description of ticket %d' % i))
+        ticket.insert()
+        tickets.append(ticket)
+    pages = []
+    for i in range(options.pages):
+        page = WikiPage(env, 'Page%d' % i)
+        page.text = '\n'.join(['Line %d of page %d' % (j, i)
+                               for j in range(20)])
+        page.save(rand.choice(users), 'created', '127.0.0.1')
+        pages.append(page)
+
+    watcher = WatchSubscriber(env)
+    wiki_setting = SubscriptionSetting(env, 'wiki_pattern')
+    group_settings = [BoolSubscriptionSetting(env, 'group_%s' % g)
+                      for g in GROUPS]
+    rules = RuleBasedTicketSubscriber(env)
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    for sid in users:
+        session = DetachedSession(env, sid)
+        session['email'] = '%s@example.org' % sid
+        for name in rand.sample(components, min(2, len(components))):
+            BoolSubscriptionSetting(env, 'component_%s' % name) \
+                .set_user_setting(session, value='1', save=False)
+        rand.choice(group_settings).set_user_setting(session, value='1',
+                                                     save=False)
+        if rand.random() < 0.2:
+            wiki_setting.set_user_setting(session, value='Page1*',
+                                          save=False)
+        save_session(env, session)
+        for ticket in rand.sample(tickets, min(options.watches,
+                                               len(tickets))):
+            watcher.set_watch(sid, 1, 'ticket', str(ticket.id))
+        for j in range(options.rules):
+            cursor.execute("""
+                INSERT INTO subscriptions
+                            (sid, authenticated, enabled, managed, realm,
+                             category, rule, transport)
+                     VALUES (%s, 1, 1, '', 'ticket', 'changed', %s, 'email')
+            """, (sid, rand.choice(['owner', 'reporter -minor',
+                                    '%s defect' % rand.choice(components)])))
+            rules.rule_changed(db.get_last_id(cursor, 'subscriptions'), db)
+    db.commit()
+    return tickets, pages
+
+def match_rules(rules, events):
+    """Matches `rules` distinct rules against `events` term sets with the
+    tree walking `Query.match()` and with compiled queries, and returns
+    the seconds taken by both."""
+    words = ['ticket', 'wiki', 'changed', 'created', 'defect',
+             'enhancement', 'task', 'major', 'minor', 'closed']
+    phrases = []
+    for i in range(rules):
+        phrases.append('%s (%s or "%s") -%s rule%d' % (
+            words[i % 10], words[(i * 3) % 10], words[(i * 7) % 10],
+            words[(i + 5) % 10], i % 50))
+    term_sets = []
+    for i in range(events):
+        term_sets.append(words[i % 10:] + words[:i % 3] + ['rule%d' % i])
+    queries = [Query(p) for p in phrases]
+    matchers = [compile_query(p) for p in phrases]
+
+    start = time.time()
+    expected = [[q.match(q, terms) for q in queries] for terms in term_sets]
+    interpreted = time.time() - start
+
+    start = time.time()
+    result = []
+    for terms in term_sets:
+        terms = frozenset(terms)
+        result.append([m(terms) for m in matchers])
+    compiled = time.time() - start
+    assert result == expected
+    return dict(rules=rules, events=events, interpreted_seconds=interpreted,
+                compiled_seconds=compiled)
+
+def run(options):
+    rand = random.Random(options.seed)
+    sink = SmtpSink()
+    loop = threading.Thread(target=asyncore.loop, kwargs=dict(timeout=0.05))
+    loop.setDaemon(True)
+    loop.start()
+    try:
+        env = create_environment(options, sink.port)
+        setup_start = time.time()
+        tickets, pages = populate(env, options, rand)
+        setup_time = time.time() - setup_start
+
+        announcer = AnnouncementSystem(env)
+        announcer.stats.reset()
+        latency = Histogram(size=max(options.events, 1))
+        start = time.time()
+        for i in range(options.events):
+            if rand.random() < options.wiki_ratio:
+                page = rand.choice(pages)
+                event = WikiChangeEvent('wiki', 'changed', page,
+                                        comment='Edit %d' % i,
+                                        author=page.author,
+                                        version=page.version)
+            else:
+                ticket = rand.choice(tickets)
+                event = TicketChangeEvent('ticket', 'changed', ticket,
+                                          comment='Comment %d' % i,
+                                          author=ticket['reporter'],
+                                          changes={'priority': 'minor'})
+            t = time.time()
+            announcer.send(event)
+            latency.add(time.time() - t)
+        pool = EmailDistributor(env)._delivery_pool
+        if pool is not None:
+            pool.shutdown(60)
+        elapsed = time.time() - start
+        # Wait for the sink to receive what was sent.
+        time.sleep(0.2)
+        messages = len(sink.messages)
+        recipients = sum([len(m[1]) for m in sink.messages])
+        sender = SmtpEmailSender(env)
+        for smtp, last_used in sender._pool:
+            sender._close(smtp)
+    finally:
+        sink.close()
+        loop.join()
+
+    summary = latency.summary()
+    return dict(
+        parameters=dict(users=options.users, events=options.events,
+                        tickets=options.tickets, pages=options.pages,
+                        components=options.components,
+                        watches=options.watches, rules=options.rules,
+                        wiki_ratio=options.wiki_ratio,
+                        threaded=options.threaded, seed=options.seed),
+        setup_seconds=setup_time,
+        seconds=elapsed,
+        messages=messages,
+        recipients=recipients,
+        events_per_second=options.events / max(elapsed, 0.001),
+        messages_per_second=messages / max(elapsed, 0.001),
+        latency=dict(p50=summary['p50'], p95=summary['p95'],
+                     p99=summary['p99'], max=summary['max'],
+                     mean=summary['mean']),
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        pipeline=announcer.stats.snapshot(),
+        rule_matching=match_rules(options.match_rules, options.events),
+    )
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--users', type='int', default=200)
+    parser.add_option('--events', type='int', default=100)
+    parser.add_option('--tickets', type='int', default=50)
+    parser.add_option('--pages', type='int', default=20)
+    parser.add_option('--components', type='int', default=10)
+    parser.add_option('--watches', type='int', default=2,
+                      help='tickets watched by each user')
+    parser.add_option('--rules', type='int', default=1,
+                      help='rule subscriptions of each user')
+    parser.add_option('--match-rules', type='int', default=2000,
+                      dest='match_rules',
+                      help='distinct rules to match with and without '
+                      'compiling them')
+    parser.add_option('--wiki-ratio', type='float', default=0.3,
+                      dest='wiki_ratio',
+                      help='share of wiki events among the events')
+    parser.add_option('--threaded', action='store_true', default=False,
+                      help='deliver e-mail with the delivery threads')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--output', help='file to write the results to, '
+                      'instead of standard output')
+    options, args = parser.parse_args(args)
+    results = to_json(run(options))
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(results)
+        finally:
+            f.close()
+    else:
+        print results
+
+if __name__ == '__main__':
+    main()
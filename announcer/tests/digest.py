@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import email
+import time
+import unittest
+from email.Header import decode_header
+
+from trac.core import *
+from trac.test import EnvironmentStub
+from trac.web.session import DetachedSession
+
+from announcer.api import *
+from announcer.distributors.digest import EmailDigester
+from announcer.distributors.mail import EmailDistributor, IEmailSender
+from announcer.pref import AnnouncerPreferences
+from announcer.resolvers.sessionemail import SessionEmailResolver
+from announcer.util.mail import slot
+
+class RecordingSender(Component):
+    implements(IEmailSender)
+
+    def __init__(self):
+        self.messages = []
+        self.failing = False
+
+    def send(self, from_addr, recipients, message):
+        if self.failing:
+            raise IOError('Connection refused')
+        self.messages.append((recipients, message))
+
+class StaticSubscriber(Component):
+    implements(IAnnouncementSubscriber)
+
+    def subscriptions(self, event):
+        yield ('email', 'ann', True, None)
+        yield ('email', 'bob', True, None)
+
+class TestFormatter(Component):
+    implements(IAnnouncementFormatter)
+
+    def styles(self, transport, realm):
+        yield 'text/plain'
+        if realm == 'html':
+            yield 'text/html'
+
+    def alternative_style_for(self, transport, realm, style):
+        return None
+
+    def __init__(self):
+        self.calls = 0
+
+    def format(self, transport, realm, style, event):
+        self.calls += 1
+        return 'Body of %s' % event.target
+
+class SlotFormatter(Component):
+    implements(IAnnouncementFormatter)
+
+    def styles(self, transport, realm):
+        if realm == 'personal':
+            yield 'text/plain'
+
+    def alternative_style_for(self, transport, realm, style):
+        return None
+
+    def format(self, transport, realm, style, event):
+        return 'Dear %s, %s changed.' % (slot('name'), event.target)
+
+class EmailDigestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, EmailDistributor,
+                    EmailDigester, AnnouncerPreferences, RecordingSender,
+                    SessionEmailResolver, StaticSubscriber, TestFormatter])
+        self.env.config.set('announcer', 'email_enabled', 'true')
+        self.env.config.set('announcer', 'email_sender', 'RecordingSender')
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        for sid in ('ann', 'bob'):
+            session = DetachedSession(self.env, sid)
+            session['email'] = '%s@example.org' % sid
+            if sid == 'bob':
+                session[EmailDigester.PREFERENCE % 'test'] = 'hourly'
+            session.save()
+        self.sender = RecordingSender(self.env)
+        self.digester = EmailDigester(self.env)
+        # Digests are sent explicitly by the tests.
+        self.digester.start = lambda: None
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_digest(self):
+        announcer = AnnouncementSystem(self.env)
+        announcer.send(AnnouncementEvent('test', 'changed', 'first'))
+        announcer.send(AnnouncementEvent('test', 'changed', 'second'))
+        self.assertEqual([['ann@example.org']] * 2,
+                         [m[0] for m in self.sender.messages])
+        self.assertEqual(0, self.digester.send_digests())
+        self.assertEqual(1, self.digester.send_digests(time.time() + 3600))
+        recipients, message = self.sender.messages[-1]
+        self.assertEqual(['bob@example.org'], recipients)
+        message = email.message_from_string(message)
+        subject = decode_header(message['Subject'])[0][0]
+        self.assertTrue(subject.endswith('Hourly announcement digest (2)'))
+        body = message.get_payload(decode=True)
+        self.assertTrue(body.index('Body of first') <
+                        body.index('Body of second'))
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT COUNT(*) FROM announcement_digest_event")
+        self.assertEqual(0, cursor.fetchone()[0])
+
+    def test_failed_digest_is_kept(self):
+        AnnouncementSystem(self.env).send(
+            AnnouncementEvent('test', 'changed', 'first'))
+        self.sender.failing = True
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+        self.sender.failing = False
+        # The digest is not sent again before its retry time.
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+        db = self.env.get_db_cnx()
+        db.cursor().execute("UPDATE announcement_digest SET not_before=0")
+        db.commit()
+        self.assertEqual(1, self.digester.send_digests(time.time() + 3600))
+        recipients, message = self.sender.messages[-1]
+        self.assertEqual(['bob@example.org'], recipients)
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+
+    def test_failing_digest_is_put_aside(self):
+        self.env.config.set('announcer', 'queue_max_attempts', 2)
+        self.env.config.set('announcer', 'queue_retry_delay', 0)
+        AnnouncementSystem(self.env).send(
+            AnnouncementEvent('test', 'changed', 'first'))
+        self.sender.failing = True
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT owner, attempts FROM announcement_digest")
+        self.assertEqual([('dead', 2)], cursor.fetchall())
+        self.sender.failing = False
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+        self.assertEqual(1, self.digester.retry_dead_digests())
+        self.assertEqual(1, self.digester.send_digests(time.time() + 3600))
+
+    def test_claimed_digest_is_skipped(self):
+        AnnouncementSystem(self.env).send(
+            AnnouncementEvent('test', 'changed', 'first'))
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("UPDATE announcement_digest SET owner='other', "
+                       "lease=%s", (int(time.time()),))
+        db.commit()
+        self.assertEqual(0, self.digester.send_digests(time.time() + 3600))
+        cursor.execute("UPDATE announcement_digest SET lease=0")
+        db.commit()
+        self.assertEqual(1, self.digester.send_digests(time.time() + 3600))
+
+    def test_send_many(self):
+        announcer = AnnouncementSystem(self.env)
+        announcer.send_many([AnnouncementEvent('test', 'changed', 'first'),
+                             AnnouncementEvent('test', 'changed', 'second')])
+        self.assertEqual(1, len(self.sender.messages))
+        recipients, message = self.sender.messages[0]
+        self.assertEqual(['ann@example.org'], recipients)
+        body = email.message_from_string(message).get_payload(decode=True)
+        self.assertTrue(body.index('Body of first') <
+                        body.index('Body of second'))
+        self.assertEqual(1, self.digester.send_digests(time.time() + 3600))
+
+    def test_send_many_formats(self):
+        session = DetachedSession(self.env, 'ann')
+        session['announcer_email_format_html'] = 'text/html'
+        session.save()
+        AnnouncementSystem(self.env).send_many(
+            [AnnouncementEvent('html', 'changed', 'first'),
+             AnnouncementEvent('html', 'changed', 'second')])
+        types = {}
+        for recipients, message in self.sender.messages:
+            message = email.message_from_string(message)
+            types.setdefault(recipients[0], []).extend(
+                [part.get_content_type() for part in message.walk()
+                 if part.get_content_maintype() == 'text'])
+        # ann gets a message per event in their format, bob one message.
+        self.assertEqual({'ann@example.org': ['text/html', 'text/html'],
+                          'bob@example.org': ['text/plain']}, types)
+
+    def test_distribute_many_single_event(self):
+        EmailDistributor(self.env).distribute_many('email',
+            [(AnnouncementEvent('other', 'changed', 'first'),
+              [('ann', True, None)])])
+        recipients, message = self.sender.messages[0]
+        message = email.message_from_string(message)
+        subject = decode_header(message['Subject'])[0][0]
+        self.assertFalse('Announcements of' in subject)
+
+    def test_formatted_once_for_all_chunks(self):
+        self.env.config.set('announcer', 'distribute_chunk_size', 1)
+        AnnouncementSystem(self.env).send(
+            AnnouncementEvent('other', 'changed', 'first'))
+        self.assertEqual(1, TestFormatter(self.env).calls)
+        self.assertEqual([['ann@example.org'], ['bob@example.org']],
+                         sorted([m[0] for m in self.sender.messages]))
+        message_ids = set([email.message_from_string(m[1])['Message-ID']
+                           for m in self.sender.messages])
+        self.assertEqual(2, len(message_ids))
+
+    def test_stored_once_for_all_chunks(self):
+        self.env.config.set('announcer', 'distribute_chunk_size', 1)
+        session = DetachedSession(self.env, 'ann')
+        session[EmailDigester.PREFERENCE % 'test'] = 'daily'
+        session.save()
+        AnnouncementSystem(self.env).send(
+            AnnouncementEvent('test', 'changed', 'first'))
+        self.assertEqual([], self.sender.messages)
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT count(*) FROM announcement_digest_event")
+        self.assertEqual(1, cursor.fetchone()[0])
+        cursor.execute("SELECT count(DISTINCT event) FROM announcement_digest")
+        self.assertEqual(1, cursor.fetchone()[0])
+        self.assertEqual(2, self.digester.send_digests(time.time() + 86400))
+
+    def test_delivery_period(self):
+        self.assertEqual('hourly',
+                         self.digester.get_delivery_period('test', 'bob', 1))
+        self.assertEqual('immediate',
+                         self.digester.get_delivery_period('wiki', 'bob', 1))
+        self.assertEqual('immediate',
+                         self.digester.get_delivery_period('test', None, 0))
+
+class PersonalizeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, EmailDistributor,
+                    AnnouncerPreferences, RecordingSender,
+                    SessionEmailResolver, StaticSubscriber, SlotFormatter])
+        self.env.config.set('announcer', 'email_enabled', 'true')
+        self.env.config.set('announcer', 'email_sender', 'RecordingSender')
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        for sid, name in (('ann', 'Ann'), ('bob', None)):
+            session = DetachedSession(self.env, sid)
+            session['email'] = '%s@example.org' % sid
+            if name:
+                session['name'] = name
+            session.save()
+        self.sender = RecordingSender(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_personalized(self):
+        AnnouncementSystem(self.env).send(
+            AnnouncementEvent('personal', 'changed', 'page'))
+        bodies = {}
+        message_ids = set()
+        for recipients, message in self.sender.messages:
+            message = email.message_from_string(message)
+            body = [part.get_payload(decode=True) for part in message.walk()
+                    if part.get_content_type() == 'text/plain'][0]
+            bodies[tuple(recipients)] = body
+            message_ids.add(message['Message-ID'])
+        self.assertEqual({('ann@example.org',): 'Dear Ann, page changed.',
+                          ('bob@example.org',): 'Dear bob, page changed.'},
+                         bodies)
+        self.assertEqual(2, len(message_ids))
+
+    def test_forged_slot(self):
+        AnnouncementSystem(self.env).send(
+            AnnouncementEvent('personal', 'changed', '{{announcer:email}}'))
+        bodies = []
+        for recipients, message in self.sender.messages:
+            message = email.message_from_string(message)
+            bodies.extend([part.get_payload(decode=True)
+                           for part in message.walk()
+                           if part.get_content_type() == 'text/plain'])
+        self.assertEqual(['Dear Ann, {{announcer:email}} changed.',
+                          'Dear bob, {{announcer:email}} changed.'],
+                         sorted(bodies))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(EmailDigestTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(PersonalizeTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
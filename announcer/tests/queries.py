@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+from trac.test import EnvironmentStub
+from trac.ticket import model
+from trac.web.session import DetachedSession
+
+from announcer.api import AnnouncementSystem
+from announcer.producers.ticket import TicketChangeEvent
+from announcer.tests.benchmark import MODULES
+from announcer.tests.digest import RecordingSender
+from announcer.util.queries import QueryCounter
+
+class QueryBudgetTestCase(unittest.TestCase):
+    """Checks that announcing an event issues a number of queries that
+    does not grow with the number of its recipients."""
+
+    recipients = 200
+
+    def setUp(self):
+        for name in MODULES:
+            __import__('announcer.' + name)
+        self.env = EnvironmentStub(enable=['trac.*', RecordingSender] +
+            ['announcer.%s.*' % name for name in MODULES])
+        config = self.env.config
+        config.set('announcer', 'email_enabled', 'true')
+        config.set('announcer', 'email_sender', 'RecordingSender')
+        config.set('announcer', 'use_threaded_delivery', 'false')
+        config.set('announcer', 'count_queries', 'true')
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        users = ['user%d' % i for i in range(self.recipients)]
+        for sid in users + ['author']:
+            session = DetachedSession(self.env, sid)
+            session['email'] = '%s@example.org' % sid
+            session.save()
+        self.ticket = model.Ticket(self.env)
+        self.ticket.populate(dict(summary='Summary', status='new',
+                                  type='defect', reporter='author',
+                                  cc=', '.join(users)))
+        self.ticket.insert()
+        self.sender = RecordingSender(self.env)
+        self.announcer = AnnouncementSystem(self.env)
+        self.announcer.stats.reset()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _count(self, event):
+        counter = QueryCounter().activate()
+        try:
+            self.announcer.send(event)
+        finally:
+            counter.deactivate()
+        return counter.total()[0]
+
+    def test_ticket_change(self):
+        event = TicketChangeEvent('ticket', 'changed', self.ticket,
+                                  comment='Comment', author='author',
+                                  changes={'priority': 'minor'})
+        queries = self._count(event)
+        recipients = sum([len(m[0]) for m in self.sender.messages])
+        self.assertEqual(self.recipients, recipients)
+        self.assertTrue(queries <= 10, '%d queries' % queries)
+
+    def test_statistics(self):
+        event = TicketChangeEvent('ticket', 'changed', self.ticket,
+                                  comment='Comment', author='author')
+        queries = self._count(event)
+        counters = dict([((c['counter'], c['component']), c['total'])
+                         for c in self.announcer.stats.snapshot()['counters']])
+        self.assertEqual(queries, counters[('queries per event', 'ticket')])
+        self.assertEqual(queries, sum([n for (name, component), n
+                                       in counters.items()
+                                       if name == 'queries']))
+
+    def test_inactive(self):
+        counter = QueryCounter()
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT 1")
+        self.assertEqual((0, 0.0), counter.total())
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(QueryBudgetTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+
+from announcer.api import AnnouncementSystem
+from announcer.producers.ticket import TicketChangeEvent
+from announcer.subscribers.rulefilters import RuleBasedTicketSubscriber
+
+class RuleBasedTicketSubscriberTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RuleBasedTicketSubscriber])
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.subscriber = RuleBasedTicketSubscriber(self.env)
+        self.ticket = Ticket(self.env)
+        self.ticket.populate(dict(summary='Summary', reporter='ann',
+                                  owner='bob'))
+        self.ticket.insert()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _add_rule(self, sid, rule, subscriber=None):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            INSERT INTO subscriptions
+                        (sid, authenticated, enabled, managed, realm,
+                         category, rule, transport)
+                 VALUES (%s, 1, 1, '', 'ticket', 'changed', %s, 'email')
+        """, (sid, rule))
+        rule_id = db.get_last_id(cursor, 'subscriptions')
+        (subscriber or self.subscriber).rule_changed(rule_id, db)
+        db.commit()
+        return rule_id
+
+    def _set_rule(self, rule_id, rule, subscriber=None):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("UPDATE subscriptions SET rule=%s WHERE id=%s",
+                       (rule, rule_id))
+        (subscriber or self.subscriber).rule_changed(rule_id, db)
+        db.commit()
+
+    def _subscribers(self):
+        event = TicketChangeEvent('ticket', 'changed', self.ticket,
+                                  author='joe')
+        return sorted([s[1] for s in self.subscriber.subscriptions(event)])
+
+    def test_session_terms(self):
+        self._add_rule('ann', 'reporter')
+        self._add_rule('bob', 'reporter')
+        self._add_rule('joe', 'updater changed')
+        self.assertEqual(['ann', 'joe'], self._subscribers())
+
+    def test_rule_changed(self):
+        rule_id = self._add_rule('ann', 'owner')
+        self.assertEqual([], self._subscribers())
+        self._set_rule(rule_id, 'reporter')
+        self.assertEqual(['ann'], self._subscribers())
+        self._add_rule('bob', 'owner')
+        self.assertEqual(['ann', 'bob'], self._subscribers())
+
+    def test_changed_by_other_process(self):
+        other_env = EnvironmentStub(
+            enable=['trac.*', AnnouncementSystem, RuleBasedTicketSubscriber])
+        other_env.db = self.env.db
+        other = RuleBasedTicketSubscriber(other_env)
+        rule_id = self._add_rule('ann', 'owner')
+        self.assertEqual([], self._subscribers())
+        self._set_rule(rule_id, 'reporter', other)
+        self.assertEqual(['ann'], self._subscribers())
+
+    def test_invalid_rule(self):
+        self._add_rule('ann', 'reporter')
+        self.assertEqual(['ann'], self._subscribers())
+        self._add_rule('bob', '(owner')
+        self.assertEqual(['ann'], self._subscribers())
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RuleBasedTicketSubscriberTestCase,
+                                     'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
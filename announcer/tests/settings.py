@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import doctest
+import pickle
+import unittest
+
+from trac.core import TracError
+from trac.test import EnvironmentStub, Mock
+from trac.web.session import DetachedSession
+
+import announcer.util.settings
+from announcer.api import AnnouncementSystem
+from announcer.subscribers.ticket_groups import JoinableGroupSubscriber
+
+from announcer.util.session import *
+from announcer.util.settings import *
+
+class SessionSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub()
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("""
+            INSERT INTO session_attribute (sid, authenticated, name, value)
+                 VALUES (%s, %s, %s, %s)
+        """, [('bob', 1, 'email', 'bob@example.org'),
+              ('bob', 0, 'email', 'anon@example.org'),
+              ('ann', 1, 'email', 'ann@example.org')])
+        db.commit()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _update(self, sid, value):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            UPDATE session_attribute SET value=%s WHERE sid=%s
+        """, (value, sid))
+        db.commit()
+
+    def test_without_snapshot(self):
+        self.assertEqual(('anon@example.org', 0),
+                         get_session_attribute(self.env, 'bob', 'email', 0))
+        self.assertEqual(None,
+                         get_session_attribute(self.env, 'ann', 'email', 0))
+        self._update('ann', 'new@example.org')
+        self.assertEqual(('new@example.org', 1),
+                         get_session_attribute(self.env, 'ann', 'email'))
+
+    def test_snapshot(self):
+        snapshot = SessionSnapshot(self.env).activate()
+        try:
+            snapshot.preload(['bob', 'ann', None])
+            self.assertEqual(('bob@example.org', 1),
+                             get_session_attribute(self.env, 'bob', 'email'))
+            # Both sessions were loaded by the first lookup.
+            self._update('ann', 'new@example.org')
+            self.assertEqual(('ann@example.org', 1),
+                get_session_attribute(self.env, 'ann', 'email', True))
+            self.assertEqual(None,
+                get_session_attribute(self.env, 'joe', 'email'))
+            self.assertEqual(None,
+                get_session_attribute(self.env, None, 'email'))
+        finally:
+            snapshot.deactivate()
+        self.assertEqual(None, get_snapshot(self.env))
+        self.assertEqual(('new@example.org', 1),
+                         get_session_attribute(self.env, 'ann', 'email'))
+
+    def test_settings_use_snapshot(self):
+        setting = BoolSubscriptionSetting(self.env, 'never_announce', False)
+        snapshot = SessionSnapshot(self.env).activate()
+        try:
+            self.assertEqual((('email',), None, False),
+                             setting.get_user_setting('bob'))
+        finally:
+            snapshot.deactivate()
+
+class SettingEncodingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', AnnouncementSystem])
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _insert(self, rows):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("""
+            INSERT INTO session_attribute (sid, authenticated, name, value)
+                 VALUES (%s, 1, %s, %s)
+        """, rows)
+        db.commit()
+
+    def test_roundtrip(self):
+        for dists, value in [(('email',), u'bob'), (('email',), u''),
+                             (('email', 'xmpp'), None),
+                             (('email',), u'x:y\u00e9')]:
+            self.assertEqual((dists, value), decode(encode(dists, value)))
+
+    def test_legacy_values(self):
+        legacy = pickle.dumps((('email',), u'bob, ann'))
+        self.assertEqual((('email',), u'bob, ann'), decode(legacy))
+        self.assertEqual((('email',), '1'),
+                         decode(pickle.dumps((('email',), '1'), 2)))
+
+    def test_no_unpickling(self):
+        evil = "cos\nsystem\n(S'echo'\ntR."
+        self.assertEqual(((), None), decode(evil))
+
+    def test_bool_subscriptions(self):
+        sec = BoolSubscriptionSetting(self.env, 'group_sec')
+        dev = BoolSubscriptionSetting(self.env, 'group_dev')
+        sec.set_user_setting(DetachedSession(self.env, 'bob'), '1')
+        sec.set_user_setting(DetachedSession(self.env, 'ann'), '0')
+        dev.set_user_setting(DetachedSession(self.env, 'joe'), '1')
+        self.assertEqual([('email', 'bob', True, None)],
+                         list(sec.get_subscriptions()))
+
+    def test_upgrade_legacy_settings(self):
+        self._insert([
+            ('bob', 'sub_watch_users', pickle.dumps((('email',), u'ann'))),
+            ('ann', 'sub_watch_users', encode(('email',), u'bob')),
+            ('joe', 'sub_watch_users', "cos\nsystem\n(S'echo'\ntR."),
+            ('joe', 'subXwatch_users', pickle.dumps((('email',), u'ann')))])
+        db = self.env.get_db_cnx()
+        self.assertEqual(1, upgrade_legacy_settings(self.env, db))
+        db.commit()
+        setting = SubscriptionSetting(self.env, 'watch_users')
+        subs = setting.get_subscriptions(lambda dist, value: True)
+        self.assertEqual(['ann', 'bob'], sorted([s[1] for s in subs]))
+
+class SettingIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', AnnouncementSystem])
+        AnnouncementSystem(self.env).upgrade_environment(
+            self.env.get_db_cnx())
+        self.setting = SubscriptionSetting(self.env, 'watch_users')
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _watch(self, sid, value, dists=('email',)):
+        session = DetachedSession(self.env, sid)
+        self.setting.set_user_setting(session, value, dists)
+
+    def _watchers(self, token):
+        return sorted(self.setting.get_subscriptions(token=token))
+
+    def test_token_lookup(self):
+        self._watch('ann', u'bob, joe', ('email', 'xmpp'))
+        self._watch('joe', u'bobby')
+        self.assertEqual([('email', 'ann', True, None),
+                          ('xmpp', 'ann', True, None)],
+                         self._watchers('bob'))
+        self.assertEqual([], self._watchers('ann'))
+
+    def test_update_replaces_tokens(self):
+        self._watch('ann', u'bob')
+        self._watch('ann', u'joe')
+        self.assertEqual([], self._watchers('bob'))
+        self.assertEqual([('email', 'ann', True, None)],
+                         self._watchers('joe'))
+
+    def test_removed_session(self):
+        self._watch('ann', u'bob')
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM session_attribute WHERE sid='ann'")
+        db.commit()
+        self.assertEqual([], self._watchers('bob'))
+
+    def test_index_saved_with_session(self):
+        session = DetachedSession(self.env, 'ann')
+        self.setting.set_user_setting(session, u'bob', save=False)
+        def save_and_fail(db):
+            save_session(self.env, session)
+            raise TracError('failed')
+        self.assertRaises(TracError, self.env.with_transaction(),
+                          save_and_fail)
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT COUNT(*) FROM subscription_index")
+        self.assertEqual(0, cursor.fetchone()[0])
+        self._watch('ann', u'bob')
+        self.assertEqual([('email', 'ann', True, None)],
+                         self._watchers('bob'))
+
+    def test_preference_panel(self):
+        self.env.config.set('announcer', 'joinable_groups', '@sec')
+        req = Mock(method='POST', args={'joinable_group_sec': 'on'},
+                   session=DetachedSession(self.env, 'bob'))
+        JoinableGroupSubscriber(self.env) \
+            .render_announcement_preference_box(req, 'joinable_groups')
+        setting = BoolSubscriptionSetting(self.env, 'group_sec')
+        self.assertEqual([('email', 'bob', True, None)],
+                         list(setting.get_subscriptions()))
+
+    def test_rebuild(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            INSERT INTO session_attribute (sid, authenticated, name, value)
+                 VALUES ('ann', 1, 'sub_watch_users', %s)
+        """, (encode(('email',), u'bob'),))
+        self.assertEqual(1, rebuild_setting_index(self.env, db))
+        db.commit()
+        self.assertEqual([('email', 'ann', True, None)],
+                         self._watchers('bob'))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(announcer.util.settings))
+    suite.addTest(unittest.makeSuite(SettingEncodingTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SettingIndexTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SessionSnapshotTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
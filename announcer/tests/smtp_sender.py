@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import asyncore
+import smtpd
+import threading
+import unittest
+
+from trac.core import *
+from trac.test import EnvironmentStub
+
+from announcer.distributors.mail import DeliveryPool, SmtpEmailSender
+from announcer.util.stats import PipelineStats
+
+class SmtpSink(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+class SmtpEmailSenderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sink = SmtpSink()
+        self.loop = threading.Thread(target=asyncore.loop,
+                                     kwargs=dict(timeout=0.05))
+        self.loop.setDaemon(True)
+        self.loop.start()
+        self.env = EnvironmentStub(enable=['trac.*', SmtpEmailSender])
+        self.env.config.set('smtp', 'port', self.sink.port)
+        self.env.config.set('smtp', 'server', '127.0.0.1')
+        self.out = SmtpEmailSender(self.env)
+
+    def tearDown(self):
+        for smtp, last_used in self.out._pool:
+            self.out._close(smtp)
+        self.sink.close()
+        self.loop.join()
+
+    def _send(self, n):
+        for i in range(n):
+            self.out.send('trac@localhost', ['user%s@localhost' % i],
+                          'Subject: test %s\r\n\r\nbody\r\n' % i)
+
+    def test_connection_reused(self):
+        self._send(3)
+        self.assertEqual(3, len(self.sink.messages))
+        self.assertEqual(1, self.sink.connections)
+        self.assertEqual(1, len(self.out._pool))
+
+    def test_idle_connection_replaced(self):
+        self._send(1)
+        self.env.config.set('smtp', 'idle_timeout', -1)
+        self._send(1)
+        self.assertEqual(2, len(self.sink.messages))
+        self.assertEqual(2, self.sink.connections)
+
+    def test_no_pooling(self):
+        self.env.config.set('smtp', 'max_connections', 0)
+        self._send(2)
+        self.assertEqual(2, self.sink.connections)
+        self.assertEqual([], self.out._pool)
+
+    def test_reconnect_after_disconnect(self):
+        self._send(1)
+        # Simulate the server dropping the idle connection.
+        self.out._pool[0][0].sock.close()
+        self._send(1)
+        self.assertEqual(2, len(self.sink.messages))
+        self.assertEqual(2, self.sink.connections)
+
+class DeliveryPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub()
+        self.stats = PipelineStats()
+        self.sent = []
+        self.blocked = threading.Event()
+        self.blocked.set()
+
+    def _send(self, from_addr, recipients, message):
+        self.blocked.wait()
+        if message == 'fail':
+            raise ValueError(message)
+        self.sent.append(message)
+
+    def _counter(self, name):
+        for c in self.stats.snapshot()['counters']:
+            if c['counter'] == name:
+                return c['total']
+        return 0
+
+    def test_failure_isolated(self):
+        pool = DeliveryPool(self.env.log, self._send, 2, 10, self.stats)
+        for message in ('one', 'fail', 'two', 'three'):
+            self.assertTrue(pool.put(('trac@localhost', ['a'], message)))
+        pool.shutdown(5)
+        self.assertEqual(['one', 'three', 'two'], sorted(self.sent))
+        self.assertEqual(1, self._counter('delivery failed'))
+        gauges = self.stats.snapshot()['gauges']
+        self.assertEqual([('delivery queue depth', 4)],
+                         [(g['gauge'], g['count']) for g in gauges])
+        self.assertTrue(gauges[0]['max'] <= 4)
+
+    def test_queue_full(self):
+        self.blocked.clear()
+        pool = DeliveryPool(self.env.log, self._send, 1, 2, self.stats)
+        results = [pool.put(('trac@localhost', ['a'], str(i)))
+                   for i in range(5)]
+        self.assertFalse(results[-1])
+        self.assertTrue(self._counter('delivery queue full') >= 1)
+        self.blocked.set()
+        pool.shutdown(5)
+        self.assertEqual(results.count(True), len(self.sent))
+        self.assertEqual(0, pool.queue.qsize())
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SmtpEmailSenderTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DeliveryPoolTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
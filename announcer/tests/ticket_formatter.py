@@ -32,9 +32,11 @@
 import unittest
 
 from trac.core import *
-from trac.test import EnvironmentStub
+from trac.test import EnvironmentStub, Mock
 
+from announcer.api import AnnouncementSystem
 from announcer.formatters.ticket import *
+from announcer.pref import AnnouncerPreferences
 
 class TicketFormatTestCase(unittest.TestCase):
     def setUp(self):
@@ -49,6 +51,23 @@ class TicketFormatTestCase(unittest.TestCase):
         self.assertEqual('text/plain', self.out.alternative_style_for('email', 'ticket', 'text/html'))
         self.assertEqual(None, self.out.alternative_style_for('email', 'ticket', 'text/plain'))
 
+    def test_render_comment(self):
+        event = Mock(realm='ticket', target=Mock(id=1), author='ann',
+                     comment="''Rendered'' once")
+        html = self.out.render_comment(event)
+        self.assertTrue('<em>Rendered</em> once' in html)
+        self.assertTrue(html is self.out.render_comment(event))
+        event.comment = "''Rendered'' twice"
+        self.assertFalse(html is self.out.render_comment(event))
+
+    def test_templates_cached(self):
+        env = EnvironmentStub(enable=['trac.*', AnnouncerPreferences])
+        templates = AnnouncementSystem(env).templates
+        template = templates.load('ticket_email_plaintext.txt',
+                                  cls=NewTextTemplate)
+        self.assertTrue(template is templates.load(
+            'ticket_email_plaintext.txt', cls=NewTextTemplate))
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TicketFormatTestCase, 'test'))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import threading
+import time
+
+class CircuitBreaker(object):
+    """Keeps track of failing and slow components of the announcement
+    pipeline and tells when to skip them.
+
+    A call raising an exception or taking longer than `budget` seconds is a
+    failure.  After `threshold` failures in a row, the component is skipped
+    for `cooldown` seconds.  After that a single call is let through as a
+    trial, and others are skipped until it is reported.  A failed trial
+    opens the circuit again right away.  A trial not reported within
+    `cooldown` seconds is given up and another one is allowed.
+
+    >>> breaker = CircuitBreaker(budget=1.0, threshold=2, cooldown=60)
+    >>> breaker.allow('Slow', now=0)
+    True
+    >>> breaker.report('Slow', 5.0, now=0)
+    >>> breaker.report('Slow', 0.1, failed=True, now=1)
+    >>> breaker.allow('Slow', now=30)
+    False
+    >>> breaker.allow('Slow', now=61), breaker.allow('Slow', now=61)
+    (True, False)
+    >>> breaker.report('Slow', 0.1, now=61)
+    >>> breaker.allow('Slow', now=62)
+    True
+    """
+
+    def __init__(self, budget, threshold, cooldown, stats=None):
+        self.budget = budget
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.stats = stats
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._open_until = {}
+        # name -> start of the trial call
+        self._trials = {}
+
+    def allow(self, name, now=None):
+        """Returns whether the component called `name` may be called."""
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            until = self._open_until.get(name)
+            if until is None:
+                return True
+            if now >= until:
+                trial = self._trials.get(name)
+                if trial is None or now >= trial + self.cooldown:
+                    self._trials[name] = now
+                    return True
+        finally:
+            self._lock.release()
+        self._count('component skipped', name)
+        return False
+
+    def report(self, name, elapsed, failed=False, now=None):
+        """Records the outcome of a call of the component called `name`
+        that took `elapsed` seconds."""
+        if now is None:
+            now = time.time()
+        if not failed and self.budget and elapsed > self.budget:
+            self._count('component over budget', name)
+            failed = True
+        elif failed:
+            self._count('component failed', name)
+        self._lock.acquire()
+        try:
+            self._trials.pop(name, None)
+            if not failed:
+                self._failures.pop(name, None)
+                self._open_until.pop(name, None)
+                return
+            failures = self._failures.get(name, 0) + 1
+            self._failures[name] = failures
+            if self.threshold and (failures >= self.threshold or
+                                   name in self._open_until):
+                self._open_until[name] = now + self.cooldown
+        finally:
+            self._lock.release()
+
+    def snapshot(self, now=None):
+        """Returns a sorted list of dicts describing the components that
+        failed recently."""
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            result = []
+            for name, failures in sorted(self._failures.items()):
+                until = self._open_until.get(name)
+                result.append(dict(component=name, failures=failures,
+                                   open=until is not None and now < until,
+                                   until=until))
+            return result
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._failures.clear()
+            self._open_until.clear()
+            self._trials.clear()
+        finally:
+            self._lock.release()
+
+    def _count(self, counter, name):
+        if self.stats is not None:
+            self.stats.count(counter, name)
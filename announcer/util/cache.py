@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import threading
+
+class LRUCache(object):
+    """A dictionary like cache holding at most `size` items, discarding the
+    least recently used item when full.  It is safe to use from several
+    threads.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache['a']
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache, 'a' in cache, len(cache)
+    (False, True, 2)
+    >>> cache.get('b', 0)
+    0
+    """
+
+    # Indices into the entries of the linked list.
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map = {}
+            # Circular doubly linked list; the newest entry follows the root.
+            self._root = root = []
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __getitem__(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._map[key]
+            self._unlink(entry)
+            self._link(entry)
+            return entry[self.VALUE]
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            entry = self._map.get(key)
+            if entry is not None:
+                self._unlink(entry)
+                entry[self.VALUE] = value
+            else:
+                if len(self._map) >= self.size:
+                    oldest = self._root[self.PREV]
+                    self._unlink(oldest)
+                    del self._map[oldest[self.KEY]]
+                entry = [None, None, key, value]
+                self._map[key] = entry
+            self._link(entry)
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            self._unlink(self._map.pop(key))
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        root = self._root
+        entry[self.PREV] = root
+        entry[self.NEXT] = root[self.NEXT]
+        root[self.NEXT][self.PREV] = entry
+        root[self.NEXT] = entry
+
+    def _unlink(self, entry):
+        entry[self.PREV][self.NEXT] = entry[self.NEXT]
+        entry[self.NEXT][self.PREV] = entry[self.PREV]
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+from difflib import SequenceMatcher
+
+class LineDiff(object):
+    """A unified diff of two texts, limited in size.
+
+    `lines` are the lines of the diff, in the format of
+    `trac.versioncontrol.diff.unified_diff()`.  `changed` is the number of
+    lines removed and added and `omitted` the number of those that are
+    not in `lines`, because the texts were too large to compare or the
+    diff was cut off.
+
+    >>> diff = line_diff(u'one\\ntwo\\nthree', u'one\\n2\\nthree', context=1)
+    >>> diff.lines
+    [u'@@ -1,3 +1,3 @@', u' one', u'-two', u'+2', u' three']
+    >>> diff.changed, diff.omitted
+    (2, 0)
+    >>> diff = line_diff(u'a\\nb\\nc', u'x\\ny\\nz', max_lines=3)
+    >>> diff.lines, diff.changed, diff.omitted
+    ([u'@@ -1,3 +1,3 @@', u'-a', u'-b'], 6, 4)
+    >>> line_diff(u'a\\nb', u'b\\nc', max_size=2).lines
+    []
+    """
+
+    def __init__(self, lines, changed, omitted=0):
+        self.lines = lines
+        self.changed = changed
+        self.omitted = omitted
+
+
+def line_diff(old_text, new_text, context=3, max_size=None, max_lines=None):
+    """Returns a `LineDiff` of two texts.
+
+    Texts larger than `max_size` characters together are not compared,
+    only their changed lines are counted.  The diff is cut off after
+    `max_lines` lines.
+    """
+    old_lines = (old_text or u'').splitlines()
+    new_lines = (new_text or u'').splitlines()
+    if max_size and len(old_text or u'') + len(new_text or u'') > max_size:
+        changed = count_changed(old_lines, new_lines)
+        return LineDiff([], changed, changed)
+    return _unified_diff(old_lines, new_lines, context, max_lines)
+
+def count_changed(old_lines, new_lines):
+    """Counts the lines removed and added between two lists of lines,
+    regardless of their order, without comparing the lists."""
+    counts = {}
+    for line in old_lines:
+        counts[line] = counts.get(line, 0) + 1
+    for line in new_lines:
+        counts[line] = counts.get(line, 0) - 1
+    return sum([abs(n) for n in counts.itervalues()])
+
+def _unified_diff(old_lines, new_lines, context, max_lines):
+    lines = []
+    changed = 0
+    for group in _grouped_opcodes(old_lines, new_lines, context):
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        if i1 == 0 and i2 == 0:
+            i1, i2 = -1, -1
+        lines.append(u'@@ -%d,%d +%d,%d @@' % (i1 + 1, i2 - i1, j1 + 1,
+                                               j2 - j1))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines.extend([u' ' + line for line in old_lines[i1:i2]])
+                continue
+            if tag in ('replace', 'delete'):
+                lines.extend([u'-' + line for line in old_lines[i1:i2]])
+                changed += i2 - i1
+            if tag in ('replace', 'insert'):
+                lines.extend([u'+' + line for line in new_lines[j1:j2]])
+                changed += j2 - j1
+    if max_lines and len(lines) > max_lines:
+        lines = lines[:max_lines]
+        shown = len([l for l in lines if l[:1] in ('-', '+')])
+        return LineDiff(lines, changed, changed - shown)
+    return LineDiff(lines, changed)
+
+def _grouped_opcodes(old_lines, new_lines, context):
+    """Groups the opcodes of the differences between two lists of lines
+    into hunks with `context` lines around the changes.
+
+    The common lines at the start and end are left out of the comparison,
+    which is what makes comparing long texts with a few changes fast.
+    """
+    old, new = old_lines, new_lines
+    n = min(len(old), len(new))
+    prefix = 0
+    while prefix < n and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    matcher = SequenceMatcher(None, old[prefix:len(old) - suffix],
+                              new[prefix:len(new) - suffix])
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, i1 + prefix, i2 + prefix, j1 + prefix,
+                        j2 + prefix))
+    if suffix:
+        opcodes.append(('equal', len(old) - suffix, len(old),
+                        len(new) - suffix, len(new)))
+    opcodes = _merge_equal(opcodes)
+    if not [op for op in opcodes if op[0] != 'equal']:
+        return
+    # Same as SequenceMatcher.get_grouped_opcodes().
+    if opcodes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if opcodes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, \
+                      min(j2, j1 + context)
+    nn = context + context
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + context), j1,
+                          min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def _merge_equal(opcodes):
+    merged = []
+    for op in opcodes:
+        if op[1] == op[2] and op[3] == op[4]:
+            continue
+        if merged and op[0] == 'equal' and merged[-1][0] == 'equal':
+            last = merged[-1]
+            merged[-1] = ('equal', last[1], op[2], last[3], op[4])
+        else:
+            merged.append(op)
+    return merged
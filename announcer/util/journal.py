@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import base64
+import cPickle
+import os
+import threading
+import time
+
+class EventJournal(object):
+    """Appends announced events, with the subscriptions they were
+    delivered to, to a file that is rotated when it grows larger than
+    `max_size` bytes, keeping `backups` older files.
+
+    Each line holds one base64 encoded pickle of a (time, event,
+    subscriptions) tuple, so the journal can be read while it is written.
+    """
+
+    def __init__(self, path, max_size, backups):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self._lock = threading.Lock()
+
+    def write(self, evt, subscriptions):
+        record = (time.time(), evt, [tuple(s) for s in subscriptions])
+        line = base64.b64encode(cPickle.dumps(record, 2)) + '\n'
+        self._lock.acquire()
+        try:
+            if self.max_size and os.path.exists(self.path) and \
+                    os.path.getsize(self.path) + len(line) > self.max_size:
+                self._rotate()
+            f = open(self.path, 'ab')
+            try:
+                f.write(line)
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            older = '%s.%d' % (self.path, i)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+def read_journal(path, log=None):
+    """Yields the (time, event, subscriptions) records of a journal file.
+    Records that can't be read, e.g. of events whose class is gone, are
+    skipped."""
+    f = open(path, 'rb')
+    try:
+        for number, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield cPickle.loads(base64.b64decode(line))
+            except Exception:
+                if log is not None:
+                    log.warning("Skipping unreadable record on line %d of "
+                                "%s", number + 1, path, exc_info=True)
+    finally:
+        f.close()
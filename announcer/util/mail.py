@@ -28,12 +28,17 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
+import random
+import re
+import threading
 from base64 import b32encode, b32decode
 try:
     from email.header import Header
 except:
     from email.Header import Header
 
+from trac.util.html import escape
+
 MAXHEADERLEN = 76
 
 def next_decorator(event, message, decorates):
@@ -86,3 +91,67 @@ def msgid(uid, host='localhost'):
     """
     return "<%s@%s>"%(uid, host)
 
+
+_slots = threading.local()
+
+def begin_slots(marker=None):
+    """
+    Starts rendering a text whose slots are filled in for each recipient,
+    and returns the random marker `slot()` uses for this render in the
+    current thread.  Texts can't contain the slots of a render before it
+    started, so slots can't be forged by the content of an announcement.
+    Pass the `marker` of an earlier render to render another part of the
+    same message.
+    """
+    _slots.marker = marker or '%016x' % random.getrandbits(64)
+    return _slots.marker
+
+def end_slots():
+    _slots.marker = None
+
+def slot(name):
+    """
+    Marks a place in the output of a formatter that is filled in for each
+    recipient, like `${slot('name')}` in a template.  The e-mail
+    distributor knows the slots 'sid', 'name', 'email' and 'prefs_link'.
+    Outside of a render started by `begin_slots()` this returns an empty
+    string.
+
+    A message with slots is sent as one copy per recipient instead of one
+    copy for all of them, which is why the shipped templates don't use any.
+    """
+    marker = getattr(_slots, 'marker', None)
+    if not marker:
+        return u''
+    return u'{{announcer:%s:%s}}' % (marker, name)
+
+def _slot_re(marker):
+    return re.compile(r'\{\{announcer:%s:(\w+)\}\}' % re.escape(marker))
+
+def has_slots(text, marker):
+    return bool(text and marker) and _slot_re(marker).search(text) is not None
+
+def fill_slots(text, values, marker, html=False):
+    """
+    Replaces the slots of the render with `marker` in `text` by their value
+    in the dict `values`, or by an empty string.  Values are escaped if
+    `text` is `html`.
+
+    >>> marker = begin_slots()
+    >>> text = u'Hello %s, {{announcer:name}}' % slot('name')
+    >>> end_slots()
+    >>> fill_slots(text, {'name': u'Ann'}, marker)
+    u'Hello Ann, {{announcer:name}}'
+    >>> fill_slots(text, {'name': u'<Ann>'}, marker, html=True)
+    u'Hello &lt;Ann&gt;, {{announcer:name}}'
+    >>> fill_slots(slot('name') + u'.', {'name': u'Ann'}, marker)
+    u'.'
+    """
+    if not text or not marker:
+        return text
+    def replace(match):
+        value = values.get(match.group(1)) or u''
+        if html:
+            value = unicode(escape(value))
+        return value
+    return _slot_re(marker).sub(replace, text)
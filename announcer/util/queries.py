@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import threading
+import time
+
+from trac.db.util import IterableCursor
+
+_active = threading.local()
+_install_lock = threading.Lock()
+
+class QueryCounter(object):
+    """Counts and times the SQL queries issued by the current thread while
+    the counter is active.
+
+    Queries are attributed to the innermost (stage, component) entered,
+    which `announcer.util.stats.StageTimer` does while it runs, or to None
+    outside of any component.  Counting works by wrapping the `execute()`
+    methods of Trac's `IterableCursor`, which all database backends use;
+    the wrapper is installed with the first counter activated.  Counters
+    activated while another one is active count for both.
+    """
+
+    def __init__(self):
+        # (stage, component) or None -> [queries, seconds]
+        self.queries = {}
+        self._stack = []
+        self._previous = None
+
+    def activate(self):
+        install()
+        self._previous = getattr(_active, 'counter', None)
+        _active.counter = self
+        return self
+
+    def deactivate(self):
+        _active.counter = self._previous
+        self._previous = None
+
+    def enter(self, key):
+        self._stack.append(key)
+        if self._previous is not None:
+            self._previous.enter(key)
+
+    def leave(self, key):
+        # Entries are removed from the top in the usual, nested case.
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i] == key:
+                del self._stack[i]
+                break
+        if self._previous is not None:
+            self._previous.leave(key)
+
+    def add(self, seconds):
+        key = self._stack and self._stack[-1] or None
+        entry = self.queries.get(key)
+        if entry is None:
+            entry = self.queries[key] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+        if self._previous is not None:
+            self._previous.add(seconds)
+
+    def total(self):
+        """Returns the number of queries and the seconds they took."""
+        count, seconds = 0, 0.0
+        for n, t in self.queries.values():
+            count += n
+            seconds += t
+        return count, seconds
+
+
+def get_counter():
+    """Returns the query counter active in this thread, or None."""
+    return getattr(_active, 'counter', None)
+
+def install():
+    """Wraps the `execute()` and `executemany()` methods of Trac's
+    `IterableCursor` to count queries.  Does nothing if already done."""
+    _install_lock.acquire()
+    try:
+        if getattr(IterableCursor, '_announcer_counted', False):
+            return
+        IterableCursor.execute = _counted(IterableCursor.execute.im_func)
+        IterableCursor.executemany = \
+            _counted(IterableCursor.executemany.im_func)
+        IterableCursor._announcer_counted = True
+    finally:
+        _install_lock.release()
+
+def _counted(method):
+    def wrapper(self, *args, **kwargs):
+        counter = getattr(_active, 'counter', None)
+        if counter is None:
+            return method(self, *args, **kwargs)
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            counter.add(time.time() - start)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
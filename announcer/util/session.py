@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import threading
+
+_active = threading.local()
+
+class SessionSnapshot(object):
+    """Session attributes of all sessions taking part in one announcement.
+
+    While a snapshot is active in the current thread, `get_session_attribute`
+    serves lookups from it.  Attributes are loaded for whole batches of
+    sessions with a few `IN (...)` queries, so subscribers, filters and
+    resolvers can look up settings for every recipient without a query per
+    recipient.  Sessions added with `preload()` are fetched together with
+    the next lookup of a session that is not loaded yet.
+    """
+
+    chunk_size = 100
+
+    def __init__(self, env):
+        self.env = env
+        self._attrs = {}
+        self._pending = set()
+        self._previous = None
+
+    def activate(self):
+        self._previous = getattr(_active, 'snapshot', None)
+        _active.snapshot = self
+        return self
+
+    def deactivate(self):
+        _active.snapshot = self._previous
+        self._previous = None
+
+    def preload(self, sids):
+        for sid in sids:
+            if sid and sid not in self._attrs:
+                self._pending.add(sid)
+
+    def discard(self, sids):
+        """Forgets the attributes of sessions no longer needed."""
+        for sid in sids:
+            self._attrs.pop(sid, None)
+            self._pending.discard(sid)
+
+    def get(self, sid, name, authenticated=None):
+        """Returns a tuple of (value, authenticated) or None if the session
+        has no such attribute.  If `authenticated` is None, the attribute of
+        the authenticated session is preferred.
+        """
+        if not sid:
+            return None
+        if sid not in self._attrs:
+            self._pending.add(sid)
+            self._fetch()
+        attrs = self._attrs[sid]
+        if authenticated is None:
+            candidates = (1, 0)
+        else:
+            candidates = (authenticated and 1 or 0,)
+        for auth in candidates:
+            if (auth, name) in attrs:
+                return attrs[(auth, name)], auth
+        return None
+
+    def _fetch(self):
+        sids = list(self._pending)
+        self._pending.clear()
+        for sid in sids:
+            self._attrs[sid] = {}
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        for i in xrange(0, len(sids), self.chunk_size):
+            chunk = sids[i:i + self.chunk_size]
+            cursor.execute("""
+                SELECT sid, authenticated, name, value
+                  FROM session_attribute
+                 WHERE sid IN (%s)
+            """ % ','.join(['%s'] * len(chunk)), chunk)
+            for sid, authenticated, name, value in cursor.fetchall():
+                self._attrs[sid][(int(authenticated), name)] = value
+
+
+def get_snapshot(env):
+    """Returns the session snapshot active in this thread for `env`."""
+    snapshot = getattr(_active, 'snapshot', None)
+    if snapshot is not None and snapshot.env is env:
+        return snapshot
+
+def preload_sessions(env, sids):
+    """Adds sessions to the active snapshot, if there is one."""
+    snapshot = get_snapshot(env)
+    if snapshot is not None:
+        snapshot.preload(sids)
+
+def get_session_attribute(env, sid, name, authenticated=None):
+    """Returns a tuple of (value, authenticated) for a session attribute, or
+    None if it is not set.  If `authenticated` is None, the attribute is
+    looked up for any session with that id.
+    """
+    snapshot = get_snapshot(env)
+    if snapshot is not None:
+        return snapshot.get(sid, name, authenticated)
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    if authenticated is None:
+        cursor.execute("""
+            SELECT value, authenticated
+              FROM session_attribute
+             WHERE sid=%s
+               AND name=%s
+        """, (sid, name))
+    else:
+        cursor.execute("""
+            SELECT value, authenticated
+              FROM session_attribute
+             WHERE sid=%s
+               AND authenticated=%s
+               AND name=%s
+        """, (sid, authenticated and 1 or 0, name))
+    row = cursor.fetchone()
+    if row:
+        return row[0], int(row[1])
+    return None
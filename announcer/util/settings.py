@@ -28,19 +28,107 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
-import pickle
+import pickletools
+
+from trac.util.text import to_unicode
 
 from announcer.api import istrue
+from announcer.util.session import get_session_attribute
+
+# Settings are stored as '1:<dist>,<dist>:<value>'.  The leading version
+# number allows changing the format later, and the value comes last so it
+# may contain any character.  A value of None is stored without the
+# trailing ':<value>' part.  The database can filter on the value, e.g.
+# enabled boolean settings match "LIKE '1:%:1'".
+VERSION_PREFIX = '1:'
+
+def tokenize(value):
+    """Splits a setting value into the tokens stored in the subscription
+    index, i.e. the stripped parts of a comma separated list.
+
+    >>> tokenize(u'bob, ann,,')
+    [u'bob', u'ann']
+    """
+    if not value:
+        return []
+    return [t.strip() for t in value.split(',') if t.strip()]
+
+def encode(dists, value):
+    """Encodes distributors and value of a subscription setting.
 
-def encode(*args):
-    return pickle.dumps(args)
+    >>> encode(('email',), u'bob, ann')
+    u'1:email:bob, ann'
+    >>> encode(('email', 'xmpp'), None)
+    u'1:email,xmpp'
+    """
+    text = VERSION_PREFIX + ','.join(dists)
+    if value is not None:
+        text += ':' + to_unicode(value)
+    return to_unicode(text)
 
 def decode(v):
+    """Decodes a subscription setting into a tuple of (dists, value).
+
+    Settings that were stored as pickles by earlier versions are read
+    without unpickling them.
+
+    >>> decode(u'1:email,xmpp:a:b')
+    (('email', 'xmpp'), u'a:b')
+    >>> decode(u'1:email')
+    (('email',), None)
+    >>> decode("((S'email'\\np0\\ntp1\\nS'1'\\np2\\ntp3\\n.")
+    (('email',), '1')
+    """
+    if v and v.startswith(VERSION_PREFIX):
+        parts = v[len(VERSION_PREFIX):].split(':', 1)
+        dists = tuple([str(d) for d in parts[0].split(',') if d])
+        if len(parts) > 1:
+            return dists, parts[1]
+        return dists, None
     try:
-        return pickle.loads(str(v))
+        return _decode_legacy(v)
     except Exception, e:
         return (tuple(),None)
 
+_LEGACY_LITERALS = ('STRING', 'BINSTRING', 'SHORT_BINSTRING', 'UNICODE',
+                    'BINUNICODE', 'INT', 'BININT', 'BININT1', 'BININT2',
+                    'NONE', 'NEWTRUE', 'NEWFALSE')
+
+def _decode_legacy(v):
+    """Interprets a pickled `(dists, value)` tuple, allowing only the
+    opcodes for tuples, strings, numbers and None, so a crafted value can
+    not execute code.
+    """
+    stack = []
+    marks = []
+    memo = {}
+    for opcode, arg, pos in pickletools.genops(str(v)):
+        name = opcode.name
+        if name in _LEGACY_LITERALS:
+            stack.append(arg)
+        elif name == 'MARK':
+            marks.append(len(stack))
+        elif name == 'TUPLE':
+            start = marks.pop()
+            stack[start:] = [tuple(stack[start:])]
+        elif name == 'EMPTY_TUPLE':
+            stack.append(())
+        elif name in ('TUPLE1', 'TUPLE2', 'TUPLE3'):
+            n = int(name[-1])
+            stack[-n:] = [tuple(stack[-n:])]
+        elif name in ('PUT', 'BINPUT', 'LONG_BINPUT'):
+            memo[arg] = stack[-1]
+        elif name in ('GET', 'BINGET', 'LONG_BINGET'):
+            stack.append(memo[arg])
+        elif name == 'PROTO':
+            pass
+        elif name == 'STOP':
+            break
+        else:
+            raise ValueError('Unsupported opcode %s' % name)
+    dists, value = stack.pop()
+    return tuple(dists), value
+
 class SubscriptionSetting(object):
     """Encapsulate user text subscription and filter settings.
     
@@ -58,22 +146,15 @@ class SubscriptionSetting(object):
         self.name = name
 
     def set_user_setting(self, session, value=None, dists=('email',), save=True):
-        """Sets session attribute."""
+        """Sets session attribute.  A session that is not saved here should
+        be saved with `save_session()`, to update the subscription index."""
         session[self._attr_name()] = encode(dists,value)
         if save:
-            session.save()
+            save_session(self.env, session)
 
     def get_user_setting(self, sid):
         """Returns tuple of (value, authenticated)."""
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT value, authenticated
-              FROM session_attribute
-             WHERE sid=%s
-               AND name=%s
-        """, (sid, self._attr_name()))
-        row = cursor.fetchone()
+        row = get_session_attribute(self.env, sid, self._attr_name())
         if row:
             pair = decode(row[0])
             authenticated = istrue(row[1])
@@ -85,22 +166,32 @@ class SubscriptionSetting(object):
         # properly and without confusion.
         return pair + (authenticated,)
 
-    def get_subscriptions(self, match):
+    def get_subscriptions(self, match=None, token=None):
         """Generates tuples of (distributor, sid, authenticated, email).  
 
         `match` should is passed the string value of the setting and should
         return true or false depending on whether the subscription matches.
 
+        If `token` is given instead, the subscription index is used to find
+        the settings whose comma separated value contains `token`.
+
         Tuples are suitable for yielding from IAnnouncementSubscriber's 
         subscriptions method.
         """
+        if token is not None:
+            for result in get_indexed_subscriptions(self.env,
+                                                    self._attr_name(), token):
+                yield result
+            return
         db = self.env.get_db_cnx()
         cursor = db.cursor()
+        # Settings without a value never match.
         cursor.execute("""
             SELECT sid, authenticated, value
               FROM session_attribute
              WHERE name=%s
-        """, (self._attr_name(),))
+               AND value LIKE %s
+        """, (self._attr_name(), VERSION_PREFIX + '%:_%'))
         for result in cursor.fetchall():
             dists, val = decode(result[2])
             for dist in dists:
@@ -129,13 +220,13 @@ class BoolSubscriptionSetting(object):
         self.name = name
 
     def set_user_setting(self, session, value=None, dists=('email',), save=True):
-        """Sets session attribute to 1 or 0."""
-        if istrue(value):
-            session[self._attr_name()] = encode(dists, '1')
-        else:
-            session[self._attr_name()] = encode(dists, '0')
+        """Sets session attribute to 1 or 0.  A session that is not saved
+        here should be saved with `save_session()`, to update the
+        subscription index."""
+        value = istrue(value) and '1' or '0'
+        session[self._attr_name()] = encode(dists, value)
         if save:
-            session.save()
+            save_session(self.env, session)
 
     def get_user_setting(self, sid):
         """Returns tuple of (value, authenticated).  
@@ -143,15 +234,7 @@ class BoolSubscriptionSetting(object):
         Value is always True or None.  This will work with Genshi template
         checkbox logic.
         """
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT value, authenticated
-              FROM session_attribute
-             WHERE sid=%s
-               AND name=%s
-        """, (sid, self._attr_name()))
-        row = cursor.fetchone()
+        row = get_session_attribute(self.env, sid, self._attr_name())
         if row:
             dists, v = decode(row[0])
             value = istrue(v)
@@ -171,20 +254,117 @@ class BoolSubscriptionSetting(object):
         Tuples are suitable for yielding from IAnnouncementSubscriber's 
         subscriptions method.
         """
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT sid, authenticated, value
-              FROM session_attribute
-             WHERE name=%s
-        """, (self._attr_name(),))
-        for result in cursor.fetchall():
-            dists, val = decode(result[2])
-            for dist in dists:
-                if istrue(val):
-                    authenticated = istrue(result[1])
-                    yield  (dist, result[0], authenticated, None)
+        return get_indexed_subscriptions(self.env, self._attr_name(), '1')
 
     def _attr_name(self):
         return "sub_%s"%(self.name)
 
+
+
+def upgrade_legacy_settings(env, db):
+    """Rewrites subscription settings stored as pickles by earlier versions
+    in the current encoding.  Returns the number of rewritten settings."""
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT sid, authenticated, name, value
+          FROM session_attribute
+         WHERE name %s
+    """ % db.like(), (db.like_escape('sub_') + '%',))
+    rows = []
+    for sid, authenticated, name, value in cursor.fetchall():
+        if not value or value.startswith(VERSION_PREFIX):
+            continue
+        try:
+            dists, val = _decode_legacy(value)
+        except Exception, e:
+            env.log.warning("Can not convert subscription setting %s of "
+                            "%s: %s", name, sid, e)
+            continue
+        rows.append((encode(dists, val), sid, authenticated, name))
+    cursor.executemany("""
+        UPDATE session_attribute
+           SET value=%s
+         WHERE sid=%s
+           AND authenticated=%s
+           AND name=%s
+    """, rows)
+    return len(rows)
+
+def save_session(env, session):
+    """Saves `session`, and replaces the subscription index entries of its
+    session in the same transaction."""
+    @env.with_transaction()
+    def do_save(db):
+        update_setting_index(env, session, db)
+        session.save()
+
+def update_setting_index(env, session, db):
+    """Replaces the subscription index entries of `session` by those of
+    its current subscription settings, without committing."""
+    authenticated = session.authenticated and 1 or 0
+    cursor = db.cursor()
+    cursor.execute("""
+        DELETE FROM subscription_index
+         WHERE sid=%s
+           AND authenticated=%s
+    """, (session.sid, authenticated))
+    rows = []
+    for name, value in session.items():
+        if not name.startswith('sub_'):
+            continue
+        dists, val = decode(value)
+        for token in tokenize(val):
+            for dist in dists:
+                rows.append((name, token, session.sid, authenticated, dist))
+    if rows:
+        cursor.executemany("""
+            INSERT INTO subscription_index
+                        (name, token, sid, authenticated, transport)
+                 VALUES (%s, %s, %s, %s, %s)
+        """, rows)
+
+def get_indexed_subscriptions(env, name, token):
+    """Generates tuples of (distributor, sid, authenticated, email) for the
+    settings `name` containing `token`.
+
+    The join with session_attribute skips index entries of sessions that
+    have since been removed.
+    """
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT i.transport, i.sid, i.authenticated
+          FROM subscription_index i
+          JOIN session_attribute a
+            ON (a.sid=i.sid AND a.authenticated=i.authenticated
+                AND a.name=i.name)
+         WHERE i.name=%s
+           AND i.token=%s
+    """, (name, token))
+    for transport, sid, authenticated in cursor.fetchall():
+        yield (transport, sid, istrue(authenticated), None)
+
+def rebuild_setting_index(env, db):
+    """Rebuilds the subscription index from the session attributes.
+    Returns the number of indexed settings."""
+    cursor = db.cursor()
+    cursor.execute("DELETE FROM subscription_index")
+    cursor.execute("""
+        SELECT sid, authenticated, name, value
+          FROM session_attribute
+         WHERE name %s
+           AND value LIKE %%s
+    """ % db.like(), (db.like_escape('sub_') + '%', VERSION_PREFIX + '%:_%'))
+    rows = []
+    settings = cursor.fetchall()
+    for sid, authenticated, name, value in settings:
+        dists, val = decode(value)
+        for token in tokenize(val):
+            for dist in dists:
+                rows.append((name, token, sid, authenticated, dist))
+    cursor.executemany("""
+        INSERT INTO subscription_index
+                    (name, token, sid, authenticated, transport)
+             VALUES (%s, %s, %s, %s, %s)
+    """, rows)
+    return len(settings)
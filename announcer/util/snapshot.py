@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+from datetime import datetime
+
+from trac.util.datefmt import from_utimestamp, to_utimestamp
+from trac.wiki.model import WikiPage
+
+from announcer.api import AnnouncementSystem
+from announcer.util.diff import LineDiff, line_diff
+
+def _encode(values):
+    values = dict(values)
+    for key, value in values.items():
+        if isinstance(value, datetime):
+            values[key] = {'utimestamp': to_utimestamp(value)}
+    return values
+
+def _decode(values):
+    values = dict(values)
+    for key, value in values.items():
+        if isinstance(value, dict) and 'utimestamp' in value:
+            values[key] = from_utimestamp(value['utimestamp'])
+    return values
+
+
+class Snapshot(object):
+    """Base class of snapshots.  Datetimes are stored as timestamps when
+    pickled or converted to a dict, as Trac's time zones can't be
+    pickled."""
+
+    def to_dict(self):
+        return _encode(self.__dict__)
+
+    def from_dict(cls, data):
+        snapshot = cls.__new__(cls)
+        snapshot.__setstate__(data)
+        return snapshot
+    from_dict = classmethod(from_dict)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__dict__.update(_decode(state))
+
+
+class TicketSnapshot(Snapshot):
+    """The id and field values of a ticket, read like a `Ticket`.
+
+    Events hold snapshots taken when they are produced instead of the
+    model objects, so they need no queries for them when announced and
+    can be pickled or converted to a dict with `to_dict()`.
+
+    >>> ticket = TicketSnapshot(42, {'summary': u'Crash', 'cc': ''})
+    >>> ticket.id, ticket['summary'], ticket['owner']
+    (42, u'Crash', None)
+    >>> TicketSnapshot.from_dict(ticket.to_dict())['summary']
+    u'Crash'
+    """
+
+    realm = 'ticket'
+
+    def __init__(self, id, values):
+        self.id = id
+        self.values = values
+
+    def from_ticket(cls, ticket):
+        if isinstance(ticket, cls):
+            return ticket
+        return cls(ticket.id, dict(ticket.values))
+    from_ticket = classmethod(from_ticket)
+
+    def __getitem__(self, name):
+        return self.values.get(name)
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    time_created = property(lambda self: self.values.get('time'))
+    time_changed = property(lambda self: self.values.get('changetime'))
+
+    def to_dict(self):
+        return {'id': self.id, 'values': _encode(self.values)}
+
+    def __setstate__(self, state):
+        self.id = state['id']
+        self.values = _decode(state['values'])
+
+
+class WikiPageSnapshot(Snapshot):
+    """The name and version of a wiki page, with the diff from the previous
+    version.
+
+    The diff is computed once when the snapshot is taken, from the text of
+    the page at hand and the previous version, and limited like all diffs
+    in announcements.  It is kept as a dict of the attributes of the
+    `LineDiff`, so snapshots can be converted to a dict.
+    """
+
+    realm = 'wiki'
+
+    def __init__(self, name, version, time=None, author=None, comment=None,
+                 diff=None):
+        self.name = name
+        self.version = version
+        self.time = time
+        self.author = author
+        self.comment = comment
+        self.diff = diff
+
+    def from_page(cls, page):
+        if isinstance(page, cls):
+            return page
+        snapshot = cls(page.name, page.version, page.time, page.author,
+                       page.comment)
+        if page.version:
+            if page.version > 1:
+                old_text = WikiPage(page.env, page.name,
+                                    page.version - 1).text
+            else:
+                old_text = u''
+            announcer = AnnouncementSystem(page.env)
+            diff = line_diff(old_text, page.text, context=3,
+                             max_size=announcer.diff_max_size,
+                             max_lines=announcer.diff_max_lines)
+            snapshot.diff = dict(lines=diff.lines, changed=diff.changed,
+                                 omitted=diff.omitted)
+        return snapshot
+    from_page = classmethod(from_page)
+
+    def get_diff(self):
+        """Returns the `LineDiff` between the previous and this version of
+        the page, or None if there is no previous version."""
+        if not self.diff:
+            return None
+        return LineDiff(**self.diff)
+
+    exists = property(lambda self: bool(self.version))
+
+
+class AttachmentSnapshot(Snapshot):
+    """The metadata of an attachment.
+
+    >>> attachment = AttachmentSnapshot('ticket', '1', 'log.txt', size=10)
+    >>> AttachmentSnapshot.from_dict(attachment.to_dict()).filename
+    'log.txt'
+    """
+
+    def __init__(self, parent_realm, parent_id, filename, description=None,
+                 size=None, date=None, author=None):
+        self.parent_realm = parent_realm
+        self.parent_id = parent_id
+        self.filename = filename
+        self.description = description
+        self.size = size
+        self.date = date
+        self.author = author
+
+    def from_attachment(cls, attachment):
+        if attachment is None or isinstance(attachment, cls):
+            return attachment
+        return cls(attachment.parent_realm, attachment.parent_id,
+                   attachment.filename, attachment.description,
+                   attachment.size, attachment.date, attachment.author)
+    from_attachment = classmethod(from_attachment)
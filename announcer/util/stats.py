@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import threading
+import time
+
+from announcer.util.queries import get_counter
+
+class Histogram(object):
+    """Rolling window over the last `size` samples of a measurement.
+
+    >>> h = Histogram(size=4)
+    >>> for v in (1, 2, 3, 4, 5):
+    ...     h.add(v)
+    >>> h.count, h.total
+    (5, 15)
+    >>> h.percentile(50), h.percentile(100)
+    (3, 5)
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.samples = []
+        self.pos = 0
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            self.samples[self.pos] = value
+            self.pos = (self.pos + 1) % self.size
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0
+        ordered = sorted(self.samples)
+        index = int(round(p / 100.0 * (len(ordered) - 1)))
+        return ordered[index]
+
+    def summary(self):
+        """Returns a dict of the total count and sum, and the mean,
+        percentiles and maximum of the samples in the window."""
+        samples = self.samples
+        return dict(
+            count=self.count,
+            total=self.total,
+            mean=samples and float(sum(samples)) / len(samples) or 0,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+            max=samples and max(samples) or 0,
+        )
+
+
+class PipelineStats(object):
+    """Timings and counters of the announcement pipeline, kept in memory
+    by the process and keyed by pipeline stage and component name.
+
+    Stages are 'event', 'subscriber', 'filter', 'distributor', 'resolver',
+    'format', 'decorate' and 'send'.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.timings = {}
+            self.counters = {}
+            self.gauges = {}
+            self.since = time.time()
+        finally:
+            self._lock.release()
+
+    def record(self, stage, component, seconds):
+        """Adds a timing sample, in seconds."""
+        self._add(self.timings, (stage, component), seconds)
+
+    def count(self, counter, component, n=1):
+        """Adds `n` to a counter, keeping each event's value as a sample."""
+        self._add(self.counters, (counter, component), n)
+
+    def sample(self, gauge, component, value):
+        """Adds a reading of a level, like a queue depth, whose sum has no
+        meaning."""
+        self._add(self.gauges, (gauge, component), value)
+
+    def timer(self, stage, component):
+        return StageTimer(self, stage, component)
+
+    def snapshot(self):
+        """Returns a dict with sorted lists of timing, counter and gauge
+        summaries, suitable for rendering or serializing."""
+        self._lock.acquire()
+        try:
+            timings = [dict(stage=k[0], component=k[1], **h.summary())
+                       for k, h in self.timings.items()]
+            counters = [dict(counter=k[0], component=k[1], **h.summary())
+                        for k, h in self.counters.items()]
+            gauges = [dict(gauge=k[0], component=k[1], **h.summary())
+                      for k, h in self.gauges.items()]
+        finally:
+            self._lock.release()
+        timings.sort(key=lambda t: (t['stage'], -t['total']))
+        counters.sort(key=lambda c: (c['counter'], c['component']))
+        gauges.sort(key=lambda g: (g['gauge'], g['component']))
+        return dict(since=self.since, window=self.window, timings=timings,
+                    counters=counters, gauges=gauges)
+
+    def _add(self, table, key, value):
+        self._lock.acquire()
+        try:
+            histogram = table.get(key)
+            if histogram is None:
+                histogram = table[key] = Histogram(self.window)
+            histogram.add(value)
+        finally:
+            self._lock.release()
+
+
+class StageTimer(object):
+    """Measures the time spent in one component between `start()` and
+    `stop()`, which may be called repeatedly to sum up interleaved work
+    like consuming a generator.
+
+    While a query counter is active, the queries issued in between are
+    attributed to the timer's stage and component.
+    """
+
+    def __init__(self, stats, stage, component):
+        self.stats = stats
+        self.stage = stage
+        self.component = component
+        self.elapsed = 0.0
+        self._started = None
+
+    def start(self):
+        counter = get_counter()
+        if counter is not None:
+            counter.enter((self.stage, self.component))
+        self._started = time.time()
+        return self
+
+    def stop(self):
+        if self._started is not None:
+            self.elapsed += time.time() - self._started
+            self._started = None
+            counter = get_counter()
+            if counter is not None:
+                counter.leave((self.stage, self.component))
+        return self
+
+    def record(self):
+        self.stop()
+        self.stats.record(self.stage, self.component, self.elapsed)
+        return self.elapsed
+
+
+def timed_iter(timer, iterable):
+    """Yields the items of `iterable`, adding the time spent producing
+    them to `timer`."""
+    timer.start()
+    try:
+        iterator = iter(iterable)
+    finally:
+        timer.stop()
+    while True:
+        timer.start()
+        try:
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+        finally:
+            timer.stop()
+        yield item
+
+
+def component_name(component):
+    return component.__class__.__name__
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Robert Corsaro
+# 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <ORGANIZATION> nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+import threading
+
+from genshi.template import MarkupTemplate, NewTextTemplate, TemplateLoader
+from trac.web.chrome import Chrome
+
+from announcer.util.cache import LRUCache
+
+_text_templates = LRUCache(64)
+
+def text_template(source):
+    """Returns a compiled `NewTextTemplate` of `source`, like the subject
+    templates configured in trac.ini.  Templates are cached by their text,
+    so a changed option is compiled again the next time it is used.
+
+    >>> text_template('#${id}') is text_template('#${id}')
+    True
+    >>> text_template('#${id}').generate(id=1).render()
+    '#1'
+    """
+    template = _text_templates.get(source)
+    if template is None:
+        template = _text_templates[source] = NewTextTemplate(source)
+    return template
+
+class TemplateCache(object):
+    """Loads the templates of announcements for one environment.
+
+    The Genshi loader is created with the first template loaded and keeps
+    the parsed templates, so each template file is read and parsed once
+    per process rather than once per message.  With `[trac] auto_reload`
+    enabled, the loader checks the modification time of a template on
+    every load and parses it again when it changed.
+
+    The cache lives as long as the `AnnouncementSystem` of the environment,
+    so changing trac.ini, which makes Trac reload the environment, starts
+    with an empty cache.  Without `auto_reload`, edited template files are
+    only read again after a restart.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self._loader = None
+        self._lock = threading.Lock()
+
+    def load(self, filename, cls=MarkupTemplate):
+        return self.get_loader().load(filename, cls=cls)
+
+    def get_loader(self):
+        loader = self._loader
+        if loader is None:
+            self._lock.acquire()
+            try:
+                if self._loader is None:
+                    chrome = Chrome(self.env)
+                    dirs = []
+                    for provider in chrome.template_providers:
+                        dirs += provider.get_templates_dirs()
+                    self._loader = TemplateLoader(dirs,
+                        auto_reload=chrome.auto_reload,
+                        variable_lookup='lenient')
+                loader = self._loader
+            finally:
+                self._lock.release()
+        return loader
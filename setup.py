@@ -73,7 +73,7 @@ setup(
         ]
     },
     install_requires = [
-        'trac>=0.11',
+        'trac>=0.12',
     ],
     extras_require={
         'acct_mgr': 'TracAccountManager',
@@ -82,7 +82,9 @@ setup(
     },
     entry_points = {
         'trac.plugins': [
+            'announcer.admin = announcer.admin',
             'announcer.api = announcer.api',
+            'announcer.distributors.digest = announcer.distributors.digest',
             'announcer.distributors.mail = announcer.distributors.mail',
             'announcer.email_decorators.generic = announcer.email_decorators.generic',
             'announcer.email_decorators.ticket = announcer.email_decorators.ticket',